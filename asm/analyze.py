@@ -0,0 +1,935 @@
+#!/usr/bin/env python3
+
+"""
+Analyze: static control flow graph of an assembled LS-8 program.
+
+The LS-8 only jumps through registers, so the graph is built together with
+a constant propagation over the registers. A JMP, Jcc or CALL whose
+register holds the same value on every path to it (usually from an LDI a
+few instructions before) gets a static target. Calls are followed into
+their subroutines, and a return site only forgets the registers the
+subroutine can write. Handlers stored into the interrupt vectors with ST
+are analyzed too.
+
+From the graph come the reachable code, the data around it, basic blocks,
+loop nests and the deepest the stack can get. The emulator takes the
+resolved targets through CPU.prelink(), and asm.py -D reports the
+instructions nothing reaches.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import asm
+
+# Opcode -> instruction name and length
+NAMES = {int(info["code"], 2): name for name, info in asm.OPCODES.items()}
+LENGTHS = {opcode: asm.instruction_length(name)
+           for opcode, name in NAMES.items()}
+
+JUMPS = {"JMP", "JEQ", "JNE", "JGT", "JLT", "JGE", "JLE"}
+ENDS_BLOCK = JUMPS | {"CALL"}
+
+# Interrupt vector table, and the empty stack
+INTERRUPT_VECTORS = 0xf8
+STACK_START = 0xf4
+
+# Bytes an interrupt pushes: the PC, the flag and R0-R6
+INTERRUPT_FRAME = 9
+
+# Stack depths past this count as unbounded
+MAX_DEPTH = 256
+
+# Entry state: only the stack pointer is known
+ENTRY_STATE = (None,) * 7 + (STACK_START,)
+UNKNOWN_STATE = (None,) * 8
+
+# Results of ALU instructions on known values, None when they fault
+ALU = {
+    "ADD": lambda a, b: (a + b) & 0xff,
+    "SUB": lambda a, b: (a - b) & 0xff,
+    "MUL": lambda a, b: (a * b) & 0xff,
+    "DIV": lambda a, b: a // b if b else None,
+    "MOD": lambda a, b: a % b if b else None,
+    "AND": lambda a, b: a & b,
+    "OR": lambda a, b: a | b,
+    "XOR": lambda a, b: a ^ b,
+    "SHL": lambda a, b: (a << b) & 0xff,
+    "SHR": lambda a, b: a >> b,
+    "INC": lambda a, b: (a + 1) & 0xff,
+    "DEC": lambda a, b: (a - 1) & 0xff,
+    "NOT": lambda a, b: ~a & 0xff,
+}
+
+# One-operand ALU instructions
+UNARY = {"INC", "DEC", "NOT"}
+
+# Bytes that read as text in a data region
+PRINTABLE = set(range(0x20, 0x7f)) | {0x09, 0x0a, 0x0d}
+
+# Label comment the assembler writes into .ls8 files
+REGEX_LS8_LABEL = re.compile(r"#\s*(\w+) \(address (\d+)\):")
+
+
+def decode(ram, address):
+    """
+    Decode the instruction at address as (name, a, b, length), or None if
+    it would fault.
+    """
+
+    opcode = ram[address]
+    name = NAMES.get(opcode)
+
+    if name is None:
+        return None
+
+    length = LENGTHS[opcode]
+    a = ram[(address + 1) & 0xff]
+    b = ram[(address + 2) & 0xff]
+
+    # register operands past R7 fault
+    if length > 1 and a > 7 or length > 2 and name != "LDI" and b > 7:
+        return None
+
+    return name, a, b, length
+
+
+def label_for(symbols, address):
+    """Name address as the closest label at or before it plus an offset."""
+
+    best = None
+
+    for name, label_address in symbols.items():
+        if label_address <= address and (
+                best is None or label_address > symbols[best]):
+            best = name
+
+    if best is None:
+        return f"{address:02X}"
+
+    offset = address - symbols[best]
+    return best if offset == 0 else f"{best}+{offset}"
+
+
+def join(old, new):
+    """Registers known in both states, if they agree."""
+
+    return tuple(a if a == b else None for a, b in zip(old, new))
+
+
+class Function:
+    """A subroutine, interrupt handler or the main program."""
+
+    def __init__(self, entry, kind):
+        self.entry = entry
+        # "main", "subroutine" or "interrupt"
+        self.kind = kind
+        # instruction addresses reached without following calls
+        self.body = set()
+        # entries of the subroutines it calls
+        self.calls = set()
+        # mask of registers it or its callees can write
+        self.writes = 0
+        # starts of its basic blocks
+        self.blocks = set()
+        # most bytes it and its callees push, None if unbounded
+        self.depth = None
+
+
+class Block:
+    """A basic block: instructions from start up to, not including, end."""
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.instructions = []
+        self.successors = []
+
+
+class Loop:
+    """A natural loop: its header block and the blocks in its body."""
+
+    def __init__(self, function, header, body):
+        # entry of the function it's in
+        self.function = function
+        self.header = header
+        self.body = body
+        self.parent = None
+        self.depth = 1
+
+
+class Analysis:
+    """Everything analyze() finds out about a program."""
+
+    def __init__(self, ram, entry=0, symbols=None, length=None):
+        self.ram = bytes(ram[:256]).ljust(256, b"\0")
+        self.entry = entry
+        # name -> address
+        self.symbols = symbols or {}
+        self.length = length if length is not None else (
+            len(self.ram.rstrip(b"\0")))
+
+        # address -> (name, a, b, length)
+        self.instructions = {}
+        # address -> register values known before it, None if unknown
+        self.states = {}
+        # address -> addresses that can run next, not counting calls
+        self.successors = {}
+        # jump or call address -> its static target
+        self.branch_targets = {}
+        # call address -> its subroutine
+        self.calls = {}
+        # jumps, calls and vector stores with an unknown target
+        self.unresolved = set()
+        # interrupt number -> handler
+        self.vectors = {}
+        # ST address -> address it writes, None if unknown
+        self.stores = {}
+        # addresses of instructions that fault
+        self.faults = set()
+        # where the stack can differ between paths, or RET/IRET can find
+        # something other than the return address on top
+        self.unbalanced = set()
+
+        self.functions = {}
+        self.blocks = {}
+        self.loops = []
+        self.reachable = set()
+        # bytes covered by reachable instructions
+        self.code = bytearray(256)
+        # (start, end, "string" or "data")
+        self.data = []
+        self.max_stack_depth = None
+
+    def run(self):
+        """Analyze the program to a fixed point."""
+
+        writes = {}
+
+        # A return site only forgets the registers its subroutine writes,
+        # which is only known after propagating, so go again until the
+        # write sets stop growing
+        while True:
+            self.propagate(writes)
+            self.find_functions()
+
+            new = dict(writes)
+            for entry, function in self.functions.items():
+                new[entry] = function.writes | writes.get(entry, 0)
+
+            if new == writes:
+                break
+
+            writes = new
+
+        self.find_blocks()
+        self.find_loops()
+        self.find_depths()
+        self.find_data()
+
+        return self
+
+    def propagate(self, writes):
+        """Find the register values known before every reachable address."""
+
+        self.states = {}
+        self.successors = {}
+        self.branch_targets = {}
+        self.calls = {}
+        self.unresolved = set()
+        self.vectors = {}
+        self.stores = {}
+        self.faults = set()
+        self.instructions = {}
+
+        pending = []
+
+        def merge(address, state):
+            old = self.states.get(address)
+            new = state if old is None else join(old, state)
+
+            if new != old:
+                self.states[address] = new
+                pending.append(address)
+
+        merge(self.entry, ENTRY_STATE)
+
+        while pending:
+            address = pending.pop()
+            self.step(address, self.states[address], writes, merge)
+
+        # A target found while a register was still constant can lose it
+        # when a later path joins in, so rebuild the edges from the final
+        # states and drop what only the stale edges reached
+        for address, state in self.states.items():
+            self.step(address, state, writes, lambda address, state: None)
+
+        self.prune()
+
+    def step(self, address, state, writes, merge):
+        """Record the instruction at address and pass its state on."""
+
+        instruction = decode(self.ram, address)
+        self.successors[address] = successors = []
+        self.calls.pop(address, None)
+        self.branch_targets.pop(address, None)
+        self.unresolved.discard(address)
+
+        if instruction is None:
+            self.faults.add(address)
+            return
+
+        self.faults.discard(address)
+        self.instructions[address] = instruction
+        name, a, b, length = instruction
+        regs = list(state)
+        following = (address + length) & 0xff
+
+        if name == "LDI":
+            regs[a] = b
+
+        elif name in ALU:
+            value = regs[a]
+            other = 0 if name in UNARY else regs[b]
+            if value is None or other is None:
+                regs[a] = None
+            else:
+                regs[a] = ALU[name](value, other)
+
+        elif name == "LD":
+            regs[a] = None
+
+        elif name == "PUSH":
+            regs[7] = None if regs[7] is None else (regs[7] - 1) & 0xff
+
+        elif name == "POP":
+            sp = regs[7]
+            regs[a] = None
+            if a != 7:
+                regs[7] = None if sp is None else (sp + 1) & 0xff
+
+        elif name == "ST":
+            target = regs[a]
+            self.stores[address] = target
+
+            if target is not None and target >= INTERRUPT_VECTORS:
+                handler = regs[b]
+                if handler is None:
+                    self.unresolved.add(address)
+                else:
+                    self.vectors[target - INTERRUPT_VECTORS] = handler
+                    merge(handler, UNKNOWN_STATE)
+
+        elif name in JUMPS:
+            target = regs[a]
+
+            if target is None:
+                self.unresolved.add(address)
+            else:
+                self.branch_targets[address] = target
+                successors.append(target)
+                merge(target, tuple(regs))
+
+            if name == "JMP":
+                return
+
+        elif name == "CALL":
+            # the register is read after the return address is pushed
+            if regs[7] is not None:
+                regs[7] = (regs[7] - 1) & 0xff
+
+            target = regs[a]
+
+            if target is None:
+                self.unresolved.add(address)
+                regs = list(UNKNOWN_STATE)
+            else:
+                self.branch_targets[address] = target
+                self.calls[address] = target
+                merge(target, tuple(regs))
+
+                mask = writes.get(target, 0)
+                regs = [None if mask & 1 << r else value
+                        for r, value in enumerate(state)]
+
+        elif name in ("RET", "IRET", "HLT"):
+            return
+
+        successors.append(following)
+        merge(following, tuple(regs))
+
+    def prune(self):
+        """Keep only what's reachable over the final edges."""
+
+        roots = [self.entry] + list(self.vectors.values())
+        reachable = set()
+
+        while roots:
+            address = roots.pop()
+            if address in reachable or address not in self.states:
+                continue
+
+            reachable.add(address)
+            roots += self.successors[address]
+            if address in self.calls:
+                roots.append(self.calls[address])
+
+        self.reachable = reachable
+
+        for table in (self.states, self.successors, self.instructions,
+                      self.branch_targets, self.calls, self.stores):
+            for address in list(table):
+                if address not in reachable:
+                    del table[address]
+
+        self.unresolved &= reachable
+        self.faults &= reachable
+
+        vectors = {}
+        for address, target in self.stores.items():
+            if target is not None and target >= INTERRUPT_VECTORS:
+                value = self.states[address][self.instructions[address][2]]
+                if value is not None:
+                    vectors[target - INTERRUPT_VECTORS] = value
+
+        self.vectors = vectors
+
+    def find_functions(self):
+        """Group the reachable instructions into functions."""
+
+        self.functions = {self.entry: Function(self.entry, "main")}
+
+        for target in self.calls.values():
+            if target not in self.functions:
+                self.functions[target] = Function(target, "subroutine")
+
+        for handler in self.vectors.values():
+            if handler not in self.functions:
+                self.functions[handler] = Function(handler, "interrupt")
+
+        for function in self.functions.values():
+            pending = [function.entry]
+
+            while pending:
+                address = pending.pop()
+                if address in function.body or address not in self.states:
+                    continue
+
+                function.body.add(address)
+                pending += self.successors[address]
+
+                name, a, b, length = self.instructions.get(
+                    address, (None, 0, 0, 1))
+
+                if name in asm.WRITES_A:
+                    function.writes |= 1 << a
+
+                if address in self.calls:
+                    function.calls.add(self.calls[address])
+
+                elif name == "CALL":
+                    # an unknown subroutine can write anything
+                    function.writes |= 0xff
+
+        # add in what callees write
+        changed = True
+
+        while changed:
+            changed = False
+
+            for function in self.functions.values():
+                writes = function.writes
+                for callee in function.calls:
+                    writes |= self.functions[callee].writes
+
+                if writes != function.writes:
+                    function.writes = writes
+                    changed = True
+
+    def find_blocks(self):
+        """Split the reachable instructions into basic blocks."""
+
+        predecessors = {address: [] for address in self.reachable}
+
+        for address, successors in self.successors.items():
+            for successor in successors:
+                predecessors[successor].append(address)
+
+        leaders = set(self.functions)
+
+        for address in self.reachable:
+            preds = predecessors[address]
+
+            # jumps and calls end a block
+            if len(preds) != 1 or len(self.successors[preds[0]]) != 1 or (
+                    self.instructions.get(preds[0], ("",))[0] in ENDS_BLOCK):
+                leaders.add(address)
+
+        self.blocks = {}
+
+        for start in sorted(leaders):
+            block = Block(start)
+            address = start
+
+            while True:
+                block.instructions.append(address)
+                successors = self.successors[address]
+                name = self.instructions.get(address, ("",))[0]
+
+                if (len(successors) != 1 or successors[0] in leaders or
+                        name in ENDS_BLOCK):
+                    break
+
+                address = successors[0]
+
+            block.end = (address + self.instructions.get(
+                address, (None, 0, 0, 1))[3]) & 0xff
+            block.successors = list(successors)
+            self.blocks[start] = block
+
+        for function in self.functions.values():
+            function.blocks = {start for start in self.blocks
+                               if start in function.body}
+
+        for address in self.reachable:
+            name, a, b, length = self.instructions.get(
+                address, (None, 0, 0, 1))
+            for i in range(length):
+                self.code[(address + i) & 0xff] = 1
+
+    def find_loops(self):
+        """Find the natural loops in each function and how they nest."""
+
+        self.loops = []
+
+        for function in self.functions.values():
+            blocks = function.blocks
+            predecessors = {start: [] for start in blocks}
+
+            for start in blocks:
+                for successor in self.blocks[start].successors:
+                    if successor in blocks:
+                        predecessors[successor].append(start)
+
+            # dominators
+            dominators = {start: set(blocks) for start in blocks}
+            dominators[function.entry] = {function.entry}
+            changed = True
+
+            while changed:
+                changed = False
+
+                for start in sorted(blocks):
+                    if start == function.entry:
+                        continue
+
+                    preds = [dominators[p] for p in predecessors[start]]
+                    new = set.intersection(*preds) if preds else set()
+                    new.add(start)
+
+                    if new != dominators[start]:
+                        dominators[start] = new
+                        changed = True
+
+            loops = {}
+
+            for start in blocks:
+                for successor in self.blocks[start].successors:
+                    if successor not in dominators[start]:
+                        continue
+
+                    # a back edge: the loop is everything that reaches
+                    # start without going through the header
+                    body = loops.setdefault(successor, {successor})
+                    pending = [start]
+
+                    while pending:
+                        block = pending.pop()
+                        if block not in body:
+                            body.add(block)
+                            pending += predecessors[block]
+
+            self.loops += [Loop(function.entry, header, body)
+                           for header, body in sorted(loops.items())]
+
+        # the parent of a loop is the smallest other loop in its function
+        # containing it
+        for loop in self.loops:
+            outer = [other for other in self.loops
+                     if other is not loop and other.function == loop.function
+                     and loop.header in other.body and loop.body <= other.body]
+
+            if outer:
+                loop.parent = min(outer, key=lambda other: len(other.body))
+
+        for loop in self.loops:
+            parent = loop.parent
+            while parent is not None:
+                loop.depth += 1
+                parent = parent.parent
+
+    def find_depths(self):
+        """Find the most bytes each function pushes, callees included."""
+
+        self.unbalanced = set()
+        active = set()
+        done = set()
+
+        def depth(function):
+            if function.entry in active:
+                # recursion
+                return None
+
+            if function.entry not in done:
+                active.add(function.entry)
+                function.depth = self.function_depth(function, depth)
+                active.discard(function.entry)
+                done.add(function.entry)
+
+            return function.depth
+
+        for function in self.functions.values():
+            depth(function)
+
+        main = self.functions[self.entry].depth
+        handlers = [self.functions[handler].depth
+                    for handler in set(self.vectors.values())]
+
+        if main is None or None in handlers:
+            self.max_stack_depth = None
+        else:
+            # an interrupt can come in at the deepest point of the program,
+            # but not during another handler
+            self.max_stack_depth = main + max(
+                (INTERRUPT_FRAME + handler for handler in handlers), default=0)
+
+    def function_depth(self, function, depth):
+        """
+        Push and pop through function's body, taking the deepest path.
+        Returns None if it's unbounded.
+        """
+
+        pushed = {function.entry: 0}
+        pending = [function.entry]
+        deepest = 0
+
+        # what RET and IRET return to is only known if they find the stack
+        # as the function was entered with it
+        returns = {"subroutine": "RET", "interrupt": "IRET"}.get(function.kind)
+
+        while pending:
+            address = pending.pop()
+            current = pushed[address]
+            name = self.instructions.get(address, ("",))[0]
+            after = current
+
+            if name == "PUSH":
+                after = current + 1
+                deepest = max(deepest, after)
+
+            elif name == "POP":
+                after = current - 1
+                if after < 0:
+                    self.unbalanced.add(address)
+
+            elif name in ("RET", "IRET"):
+                if name != returns or current != 0:
+                    self.unbalanced.add(address)
+
+            elif name == "CALL":
+                callee = self.calls.get(address)
+                if callee is None:
+                    return None
+
+                callee_depth = depth(self.functions[callee])
+                if callee_depth is None:
+                    return None
+
+                deepest = max(deepest, current + 1 + callee_depth)
+
+            if deepest > MAX_DEPTH:
+                return None
+
+            for successor in self.successors[address]:
+                if successor in pushed and pushed[successor] != after:
+                    self.unbalanced.add(successor)
+
+                if successor in pushed and pushed[successor] >= after:
+                    continue
+
+                pushed[successor] = after
+                pending.append(successor)
+
+        return deepest
+
+    def find_data(self):
+        """Classify the bytes of the program that aren't code."""
+
+        self.data = []
+        start = None
+
+        for address in range(self.length + 1):
+            if address < self.length and not self.code[address]:
+                if start is None:
+                    start = address
+                continue
+
+            if start is not None:
+                text = self.ram[start:address].rstrip(b"\0")
+                kind = ("string" if len(text) > 1 and
+                        all(byte in PRINTABLE for byte in text) else "data")
+                self.data.append((start, address, kind))
+                start = None
+
+    @property
+    def complete(self):
+        """
+        True if every jump, call and return target is known, and nothing
+        can write over the code or the return addresses on the stack, so
+        the targets hold for the whole run.
+        """
+
+        if (self.unresolved or self.unbalanced or
+                self.max_stack_depth is None):
+            return False
+
+        # only PUSH, POP, CALL and RET may move the stack pointer
+        if any(function.writes & 1 << 7
+               for function in self.functions.values()):
+            return False
+
+        stack_low = STACK_START - self.max_stack_depth
+
+        for target in self.stores.values():
+            if target is None or self.code[target] or (
+                    stack_low <= target < STACK_START):
+                return False
+
+        return not any(self.code[stack_low:STACK_START])
+
+    def label_for(self, address):
+        return label_for(self.symbols, address)
+
+    def disassemble(self, address):
+        """The instruction at address as text."""
+
+        name, a, b, length = self.instructions[address]
+
+        if length == 1:
+            return name
+        if name == "LDI":
+            return f"LDI R{a},{b:02X}h"
+        if length == 2:
+            return f"{name} R{a}"
+
+        return f"{name} R{a},R{b}"
+
+
+def analyze(ram, entry=0, symbols=None, length=None):
+    """
+    Analyze the program in ram, which starts running at entry. length is
+    how many bytes the program covers, by default up to the last nonzero
+    byte. Returns an Analysis.
+    """
+
+    return Analysis(ram, entry, symbols, length).run()
+
+
+def machine_code(sym, code):
+    """Machine code from linked pass 1 code."""
+
+    machine = bytearray()
+
+    for c in code:
+        if c[0] == "#":
+            continue
+
+        if c[:4] == "sym:":
+            machine.append(sym[c[4:].strip()] & 0xff)
+        else:
+            machine.append(int(c.split()[0], 2))
+
+    return bytes(machine)
+
+
+def dead_code(sym, code):
+    """
+    Find the instructions in linked pass 1 code that can never run.
+    Returns a list of (address, label, instruction text) and the Analysis.
+    """
+
+    machine = machine_code(sym, code)
+    analysis = analyze(machine, symbols=sym, length=len(machine))
+    dead = []
+    address = 0
+
+    for item in asm.parse_code(code):
+        if item[0] == "op":
+            if address not in analysis.reachable:
+                text = f"{item[1]} {','.join(item[2])}".rstrip()
+                dead.append((address, analysis.label_for(address), text))
+
+            address += asm.instruction_length(item[1])
+
+        elif item[0] == "data":
+            address += 1
+
+    return dead, analysis
+
+
+def format_dead_code(name, dead, analysis):
+    """Report the dead instructions found by dead_code()."""
+
+    lines = [f"{name}: {len(dead)} unreachable instructions"
+             f"{'' if analysis.complete else ' (analysis incomplete)'}"]
+
+    for address, label, text in dead:
+        lines.append(f"  {address:02X}  {label:<20} {text}")
+
+    return "\n".join(lines)
+
+
+def load(filename):
+    """Read a .asm, .ls8 or .ls8b program as (ram, symbols, length)."""
+
+    if filename.endswith(".asm"):
+        with open(filename) as f:
+            code, symbols = asm.assemble_stream(
+                f, base=os.path.dirname(filename))
+
+        return code, symbols, len(code)
+
+    if filename.endswith(".ls8b"):
+        with open(filename, "rb") as f:
+            image = f.read()
+
+        (_, _, entry, load_address, length, count,
+         _) = asm.IMAGE_HEADER.unpack_from(image)
+        offset = asm.IMAGE_HEADER.size
+        ram = bytearray(256)
+        ram[load_address:load_address + length] = image[offset:offset + length]
+
+        symbols = {}
+        offset += length
+
+        for _ in range(count):
+            address, size = image[offset], image[offset + 1]
+            symbols[image[offset + 2:offset + 2 + size].decode()] = address
+            offset += 2 + size
+
+        return ram, symbols, load_address + length
+
+    ram = bytearray()
+    symbols = {}
+
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+
+            m = REGEX_LS8_LABEL.match(line)
+            if m is not None:
+                symbols[m.group(1)] = int(m.group(2))
+                continue
+
+            line = line.split("#", 1)[0].strip()
+            if line:
+                ram.append(int(line, 2))
+
+    return ram, symbols, len(ram)
+
+
+def report(analysis, file=sys.stdout):
+    """Print the blocks, functions, loops, data and stack depth."""
+
+    label = analysis.label_for
+
+    print(f"Reachable: {len(analysis.reachable)} instructions, "
+          f"{sum(analysis.code)} bytes in {len(analysis.blocks)} blocks",
+          file=file)
+
+    depth = analysis.max_stack_depth
+    print(f"Max stack depth: "
+          f"{'unbounded' if depth is None else f'{depth} bytes'}", file=file)
+
+    print(f"Static branch targets: {len(analysis.branch_targets)}, "
+          f"unresolved: {len(analysis.unresolved)}"
+          f"{'' if analysis.complete else ' (not safe to prelink)'}",
+          file=file)
+
+    if analysis.unbalanced:
+        print("Unbalanced stack at: " + " ".join(
+            label(address) for address in sorted(analysis.unbalanced)),
+            file=file)
+
+    print("\nFunctions:", file=file)
+
+    for entry, function in sorted(analysis.functions.items()):
+        writes = ",".join(f"R{r}" for r in range(8) if function.writes >> r & 1)
+        depth = "unbounded" if function.depth is None else function.depth
+        print(f"  {entry:02X}  {label(entry):<20} {function.kind:<10} "
+              f"stack {depth}, writes {writes or '-'}", file=file)
+
+    print("\nBlocks:", file=file)
+
+    for start, block in sorted(analysis.blocks.items()):
+        successors = " ".join(label(s) for s in block.successors)
+        print(f"  {start:02X}-{block.end - 1 & 0xff:02X}  {label(start):<20} "
+              f"-> {successors or '(end)'}", file=file)
+
+        for address in block.instructions:
+            if address in analysis.instructions:
+                text = analysis.disassemble(address)
+            else:
+                text = "(faults)"
+
+            target = analysis.branch_targets.get(address)
+            note = f"  ; -> {label(target)}" if target is not None else ""
+            if address in analysis.unresolved:
+                note = "  ; unresolved"
+
+            print(f"        {address:02X}  {text}{note}", file=file)
+
+    if analysis.loops:
+        print("\nLoops:", file=file)
+
+        for loop in analysis.loops:
+            print(f"  {'  ' * (loop.depth - 1)}{label(loop.header)}: "
+                  f"{len(loop.body)} blocks, depth {loop.depth}", file=file)
+
+    if analysis.data:
+        print("\nData:", file=file)
+
+        for start, end, kind in analysis.data:
+            region = analysis.ram[start:end]
+            text = (f" {region.rstrip(bytes(1)).decode()!r}"
+                    if kind == "string" else "")
+            print(f"  {start:02X}-{end - 1:02X}  {label(start):<20} "
+                  f"{kind}{text}", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="analyze.py",
+        description="Statically analyze an LS-8 program.")
+    parser.add_argument("program", help=".asm, .ls8 or .ls8b file")
+    parser.add_argument("--entry", type=lambda s: int(s, 0), default=0,
+                        help="address the program starts at (default 0)")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        ram, symbols, length = load(args.program)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 2
+    except SystemExit as e:
+        return e.code
+
+    report(analyze(ram, args.entry, symbols, length))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -14,8 +14,11 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import os
 import sys
 import re
+import struct
+import zlib
 
 # Opcodes
 OPCODES = {
@@ -55,18 +58,38 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
+# Binary image (.ls8b) layout, all little-endian:
+#
+#   header   magic "LS8B", version, entry point, load address, code length,
+#            symbol count, CRC-32 of the code followed by the symbols
+#   code     code length bytes, loaded into RAM at the load address
+#   symbols  symbol count entries of address, name length, name
+IMAGE_MAGIC = b"LS8B"
+IMAGE_VERSION = 2
+IMAGE_HEADER = struct.Struct("<4sBBBHHI")
+
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+REGEX = re.compile(
+    r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?")
 
 # Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+REGEX_DS = re.compile(r"(?:(\w+?):)?\s*DS\s*(.+)", re.IGNORECASE)
+REGEX_DB = re.compile(r"(?:(\w+?):)?\s*DB\s*(.+)", re.IGNORECASE)
+
+# Regex for register operands
+REGEX_REG = re.compile(r"R([0-7])")
+
+# Regex for .include "file.asm" lines
+REGEX_INCLUDE = re.compile(r"\.include\s+\"?([^\"]+?)\"?$", re.IGNORECASE)
+
+# Regex for the label comments pass 1 puts in the code
+REGEX_LABEL = re.compile(r"# (\w+) \(address \d+\):")
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [-D] [inputfile] [outputfile]
     """
 
     if len(argv) == 1:
@@ -82,7 +105,8 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [-D] [infile.asm] [outfile.ls8]",
+              file=sys.stderr)
         sys.exit(1)
 
     return inputfile, outputfile
@@ -91,7 +115,8 @@ def parse_commandline(argv):
 def open_files(inputfile, outputfile):
     """
     Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    stdin or stdout is returned as appropriate. Output files ending in .ls8b
+    are opened in binary mode for a binary image.
     """
 
     if inputfile == "-":
@@ -101,6 +126,8 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
@@ -127,7 +154,7 @@ def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def pass1(inputfile, sym, code, lines=None):
     """
     Pass 1
 
@@ -135,6 +162,9 @@ def pass1(inputfile, sym, code):
     * Parse labels, opcodes, and operands
     * Record label offsets
     * Emit machine code
+
+    If lines is a dict, it gets the source line number and text of every
+    instruction and data directive, keyed by address.
     """
 
     # Source line number
@@ -148,7 +178,7 @@ def pass1(inputfile, sym, code):
 
         nonlocal line_num
 
-        m = re.match(r"R([0-7])", op)
+        m = REGEX_REG.match(op)
 
         if m is None:
             if fatal:
@@ -220,7 +250,7 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        m = REGEX_DS.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line_num}: missing argument to DS", file=sys.stderr)
@@ -245,7 +275,7 @@ def pass1(inputfile, sym, code):
 
         nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+        m = REGEX_DB.match(line)
 
         if m is None or m.group(2) is None:
             print(f"line {line}: missing argument to DB", file=sys.stderr)
@@ -328,9 +358,16 @@ def pass1(inputfile, sym, code):
         if input == '':
             continue
 
+        # Mark where another file's code goes, for link()
+        m = REGEX_INCLUDE.match(line)
+
+        if m is not None:
+            code.append(f"include:{m.group(1)}")
+            continue
+
         # print(line)  # debug
 
-        m = re.match(REGEX, line)
+        m = REGEX.match(line)
 
         if m is not None:
             label, opcode, op_a, op_b = normalize_line(m.groups())
@@ -344,6 +381,10 @@ def pass1(inputfile, sym, code):
                 code.append(f'# {label} (address {addr}):')
 
             if opcode is not None:
+                # Track source line
+                if lines is not None:
+                    lines[addr] = (line_num, line)
+
                 if opcode == 'DS':
                     handle_ds(line)
                 elif opcode == 'DB':
@@ -361,6 +402,481 @@ def pass1(inputfile, sym, code):
             sys.exit(3)
 
 
+def resolve_includes(code, filename):
+    """
+    Make the .include paths in code from filename relative to the current
+    directory instead of to filename.
+    """
+
+    base = os.path.dirname(filename)
+    result = []
+
+    for c in code:
+        if c[:8] == 'include:':
+            c = f"include:{os.path.normpath(os.path.join(base, c[8:]))}"
+
+        result.append(c)
+
+    return result
+
+
+def includes(code):
+    """Get the files code includes."""
+
+    return [c[8:] for c in code if c[:8] == 'include:']
+
+
+def link(units, root):
+    """
+    Lay out the code of root and every file it includes, in place of the
+    .include lines, and give each label its final address. units maps file
+    names to their pass 1 code, with includes resolved.
+
+    Returns the symbol table and code for pass 2.
+    """
+
+    sym = {}
+    code = []
+    addr = 0
+
+    def place(name, including):
+        nonlocal addr
+
+        if name in including:
+            print(f"{name}: circular include", file=sys.stderr)
+            sys.exit(2)
+
+        if name not in units:
+            print(f"{including[-1]}: can't include {name}", file=sys.stderr)
+            sys.exit(2)
+
+        for c in units[name]:
+            if c[:8] == 'include:':
+                place(c[8:], including + [name])
+                continue
+
+            m = REGEX_LABEL.match(c)
+
+            if m is not None:
+                label = m.group(1)
+
+                if label in sym:
+                    print(f"{name}: duplicate label {label}", file=sys.stderr)
+                    sys.exit(2)
+
+                sym[label] = addr
+                code.append(f'# {label} (address {addr}):')
+                continue
+
+            code.append(c)
+            addr += 1
+
+    place(root, [])
+
+    return sym, code
+
+
+# Rough cycle cost of an instruction for the optimizer report: one cycle
+# per byte fetched, plus the multiply and divide circuits
+SLOW_CYCLES = {"MUL": 8, "DIV": 16, "MOD": 16}
+
+# Instructions that write their first operand register
+WRITES_A = {"ADD", "AND", "DEC", "DIV", "INC", "LD", "LDI", "MOD", "MUL",
+            "NOT", "OR", "POP", "SHL", "SHR", "SUB", "XOR"}
+
+# Instructions that write their first operand without reading it
+ONLY_WRITES_A = {"LD", "LDI", "POP"}
+
+# Instructions after which the next one only runs if it's jumped to
+NO_FALL_THROUGH = {"HLT", "IRET", "JMP", "RET"}
+
+# Instructions after which nothing is known about the registers
+CLOBBERS_ALL = {"CALL", "INT", "IRET", "RET"}
+
+# Instructions that move the stack pointer
+MOVES_SP = {"CALL", "INT", "IRET", "POP", "PUSH", "RET"}
+
+
+def instruction_length(name):
+    op_type = OPCODES[name]["type"]
+    return 3 if op_type == 8 else op_type + 1
+
+
+def instruction_cycles(name):
+    return instruction_length(name) + SLOW_CYCLES.get(name, 0)
+
+
+def parse_code(code):
+    """
+    Group pass 1 code into items for the optimizer: ["label", name],
+    ["op", name, operands, code lines] or ["data", code line].
+    """
+
+    items = []
+    i = 0
+
+    while i < len(code):
+        c = code[i]
+
+        m = REGEX_LABEL.match(c)
+
+        if m is not None:
+            items.append(["label", m.group(1)])
+            i += 1
+            continue
+
+        bits, _, comment = c.partition(" # ")
+        words = comment.split()
+        name = words[0] if words else None
+
+        if name in OPCODES and OPCODES[name]["code"] == bits:
+            operands = words[1].split(",") if len(words) > 1 else []
+            length = instruction_length(name)
+            items.append(["op", name, operands, code[i:i + length]])
+            i += length
+        else:
+            items.append(["data", c])
+            i += 1
+
+    return items
+
+
+def make_op(name, operands):
+    """Make an instruction item, with code lines like pass 1's."""
+
+    lines = [f"{OPCODES[name]['code']} # {name} {','.join(operands)}".rstrip()]
+
+    for i, operand in enumerate(operands):
+        if i == 1 and name == "LDI":
+            try:
+                lines.append(p8(int(operand, 0) & 0xff))
+            except ValueError:
+                lines.append(f"sym:{operand}")
+        else:
+            lines.append(p8(int(operand[1:])))
+
+    return ["op", name, operands, lines]
+
+
+def constant(operand):
+    """Get a key for the value of an LDI operand."""
+
+    try:
+        return int(operand, 0) & 0xff
+    except ValueError:
+        return operand
+
+
+def reads(item, reg):
+    """True if the instruction item reads register reg."""
+
+    name, operands = item[1], item[2]
+
+    for i, operand in enumerate(operands):
+        if i == 1 and name == "LDI":
+            continue
+
+        if operand == reg and not (i == 0 and name in ONLY_WRITES_A):
+            return True
+
+    return False
+
+
+def dead_after(items, start, reg):
+    """
+    True if register reg is written before it's read by the straight-line
+    code from items[start] on.
+    """
+
+    for item in items[start:]:
+        if item[0] != "op":
+            return False
+
+        if reads(item, reg):
+            return False
+
+        if item[1] in WRITES_A and item[2][0] == reg:
+            return True
+
+        if item[1] == "HLT":
+            return True
+
+        # it may be read wherever control goes
+        if item[1][0] == "J" or item[1] in MOVES_SP | CLOBBERS_ALL:
+            return False
+
+    return False
+
+
+def code_at(items, label):
+    """Get the index of the first instruction at label, or None."""
+
+    for i, item in enumerate(items):
+        if item[0] == "label" and item[1] == label:
+            for j in range(i + 1, len(items)):
+                if items[j][0] == "op":
+                    return j
+
+                if items[j][0] == "data":
+                    return None
+
+    return None
+
+
+def labels_after(items, start):
+    """Get the labels directly before the next instruction or data."""
+
+    labels = set()
+
+    for item in items[start:]:
+        if item[0] != "label":
+            break
+
+        labels.add(item[1])
+
+    return labels
+
+
+def optimize_jumps(items, stats):
+    """
+    Follow jumps to LDI+JMP of the same register to their end, and drop
+    jumps to the very next instruction.
+    """
+
+    changed = False
+
+    for i in range(len(items) - 1):
+        ldi, jump = items[i], items[i + 1]
+
+        if (ldi[0] != "op" or ldi[1] != "LDI" or jump[0] != "op"
+                or jump[1] not in ("JMP", "CALL")
+                or jump[2][0] != ldi[2][0]):
+            continue
+
+        reg, target = ldi[2]
+        seen = {target}
+
+        while True:
+            j = code_at(items, target)
+
+            if (j is None or j + 1 >= len(items)
+                    or items[j][1] != "LDI" or items[j][2][0] != reg
+                    or items[j + 1][0] != "op" or items[j + 1][1] != "JMP"
+                    or items[j + 1][2][0] != reg
+                    or items[j][2][1] in seen):
+                break
+
+            target = items[j][2][1]
+            seen.add(target)
+
+        if target != ldi[2][1]:
+            items[i] = make_op("LDI", [reg, target])
+            stats["jump chains"] += 1
+            changed = True
+
+    i = 0
+
+    while i < len(items) - 1:
+        ldi, jump = items[i], items[i + 1]
+
+        if (ldi[0] == "op" and ldi[1] == "LDI" and jump[0] == "op"
+                and jump[1] == "JMP" and jump[2][0] == ldi[2][0]
+                and ldi[2][1] in labels_after(items, i + 2)):
+            del items[i + 1]
+            stats["jumps to next"] += 1
+            changed = True
+
+        i += 1
+
+    return changed
+
+
+def optimize_dead_code(items, stats):
+    """Drop unlabelled instructions after ones that never fall through."""
+
+    changed = False
+    dead = False
+    i = 0
+
+    while i < len(items):
+        item = items[i]
+
+        if item[0] != "op":
+            dead = False
+
+        elif dead:
+            del items[i]
+            stats["dead code"] += 1
+            changed = True
+            continue
+
+        elif item[1] in NO_FALL_THROUGH:
+            dead = True
+
+        i += 1
+
+    return changed
+
+
+def optimize_stack(items, stats):
+    """Drop PUSH Rx directly followed by POP Rx."""
+
+    changed = False
+    i = 0
+
+    while i < len(items) - 1:
+        push, pop = items[i], items[i + 1]
+
+        if (push[0] == "op" and push[1] == "PUSH" and pop[0] == "op"
+                and pop[1] == "POP" and push[2] == pop[2]):
+            del items[i:i + 2]
+            stats["push/pop pairs"] += 1
+            changed = True
+            continue
+
+        i += 1
+
+    return changed
+
+
+def optimize_constants(items, stats):
+    """
+    Drop LDIs of values registers already hold, and turn multiplies by
+    powers of two into shifts.
+    """
+
+    changed = False
+    # register -> constant it holds
+    known = {}
+    i = 0
+
+    while i < len(items):
+        item = items[i]
+
+        if item[0] != "op":
+            known.clear()
+            i += 1
+            continue
+
+        name, operands = item[1], item[2]
+
+        if name == "LDI":
+            reg, value = operands
+
+            if known.get(reg) == constant(value):
+                del items[i]
+                stats["redundant LDI"] += 1
+                changed = True
+                continue
+
+            multiply = items[i + 1] if i + 1 < len(items) else None
+            power = constant(value)
+
+            if (multiply is not None and multiply[0] == "op"
+                    and multiply[1] == "MUL" and multiply[2][1] == reg
+                    and multiply[2][0] != reg and isinstance(power, int)
+                    and power > 0 and power & (power - 1) == 0
+                    and dead_after(items, i + 2, reg)):
+                shift = str(power.bit_length() - 1)
+                items[i] = make_op("LDI", [reg, shift])
+                items[i + 1] = make_op("SHL", multiply[2])
+                stats["multiplies to shifts"] += 1
+                changed = True
+                continue
+
+            known[reg] = constant(value)
+
+        elif name in CLOBBERS_ALL or name in NO_FALL_THROUGH:
+            known.clear()
+
+        elif name in WRITES_A:
+            known.pop(operands[0], None)
+
+        if name in MOVES_SP:
+            known.pop("R7", None)
+
+        i += 1
+
+    return changed
+
+
+def measure(items):
+    """Count the instructions, bytes and cycles in items."""
+
+    ops = [item[1] for item in items if item[0] == "op"]
+
+    return {
+        "instructions": len(ops),
+        "bytes": sum(instruction_length(name) for name in ops)
+        + sum(1 for item in items if item[0] == "data"),
+        "cycles": sum(instruction_cycles(name) for name in ops),
+    }
+
+
+def optimize(code):
+    """
+    Peephole optimizer: rewrite linked pass 1 code
+
+    * Drop LDIs of constants the register already holds
+    * Drop PUSH Rx/POP Rx pairs
+    * Send LDI+JMP/CALL through chains of LDI+JMP straight to the end
+    * Drop jumps to the very next instruction
+    * Drop unlabelled code after HLT, JMP, RET and IRET
+    * Turn MUL by a power of two into SHL
+
+    Addresses move, so programs must only get code addresses from labels.
+    Returns the symbol table, the new code and a report of the savings.
+    """
+
+    items = parse_code(code)
+    before = measure(items)
+    stats = dict.fromkeys(["redundant LDI", "push/pop pairs", "jump chains",
+                           "jumps to next", "dead code",
+                           "multiplies to shifts"], 0)
+
+    changed = True
+
+    while changed:
+        changed = optimize_jumps(items, stats)
+        changed |= optimize_dead_code(items, stats)
+        changed |= optimize_stack(items, stats)
+        changed |= optimize_constants(items, stats)
+
+    code = []
+
+    for item in items:
+        if item[0] == "label":
+            code.append(f"# {item[1]} (address 0):")
+        elif item[0] == "op":
+            code += item[3]
+        else:
+            code.append(item[1])
+
+    # give the labels their new addresses
+    sym, code = link({None: code}, None)
+
+    after = measure(items)
+    report = {"before": before, "after": after, "rewrites": stats}
+
+    return sym, code, report
+
+
+def format_report(name, report):
+    """Summarize an optimizer report in a line."""
+
+    before, after = report["before"], report["after"]
+    rewrites = ", ".join(f"{count} {rewrite}"
+                         for rewrite, count in report["rewrites"].items()
+                         if count)
+
+    return (f"{name}: saved "
+            f"{before['instructions'] - after['instructions']} of "
+            f"{before['instructions']} instructions, "
+            f"{before['bytes'] - after['bytes']} bytes, "
+            f"{before['cycles'] - after['cycles']} cycles"
+            f"{' (' + rewrites + ')' if rewrites else ''}")
+
+
 def pass2(outputfile, sym, code):
     """
     Output the code, substituting in any symbols.
@@ -381,13 +897,234 @@ def pass2(outputfile, sym, code):
         outputfile.write(f"{c}\n")
 
 
+def pass2_image(outputfile, sym, code):
+    """
+    Output the code as a binary .ls8b image, substituting in any symbols.
+    """
+
+    machine_code = bytearray()
+
+    for c in code:
+        # Skip label comments
+        if c[0] == '#':
+            continue
+
+        # Replace symbols
+        if c[:4] == 'sym:':
+            s = c[4:].strip()
+
+            if s in sym:
+                machine_code.append(sym[s])
+
+            else:
+                print(f"unknown symbol: {s}", file=sys.stderr)
+                sys.exit(2)
+
+        else:
+            machine_code.append(int(c.split()[0], 2))
+
+    write_image(outputfile, sym, machine_code)
+
+
+def write_image(outputfile, sym, machine_code):
+    """Write machine code and its symbol table as a binary .ls8b image."""
+
+    symbols = bytearray()
+
+    for name, addr in sym.items():
+        encoded = name.encode()
+        symbols += bytes((addr & 0xff, len(encoded))) + encoded
+
+    header = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, 0, 0,
+                               len(machine_code), len(sym),
+                               zlib.crc32(symbols, zlib.crc32(machine_code)))
+
+    outputfile.write(header + machine_code + symbols)
+
+
+def assemble_stream(lines, size=256, base="."):
+    """
+    Assemble in a single pass, straight to machine code
+
+    * Read source lines from any iterable, one at a time
+    * Write each instruction's bytes into a size byte buffer
+    * Record references to labels that aren't defined yet in a fixup table
+    * Patch the fixups once every label is known
+
+    .include paths are relative to base. Returns the machine code and the
+    symbol table.
+    """
+
+    image = bytearray(size)
+    sym = {}
+    # (address, label, line number) of each forward reference
+    fixups = []
+    addr = 0
+    line_num = 0
+
+    # opcode -> (type, machine code)
+    opcodes = {name: (info["type"], int(info["code"], 2))
+               for name, info in OPCODES.items()}
+
+    def fail(message, status):
+        print(f"Line {line_num}: {message}", file=sys.stderr)
+        sys.exit(status)
+
+    def reserve(length):
+        if addr + length > size:
+            fail(f"program doesn't fit in {size} bytes", 2)
+
+    def get_reg(op):
+        m = REGEX_REG.match(op)
+
+        if m is None:
+            fail(f"unknown register {op}", 1)
+
+        return int(m.group(1))
+
+    def assemble_lines(lines, base):
+        nonlocal addr, line_num
+
+        for line_num, line in enumerate(lines, 1):
+            # Strip comments
+            comment_index = line.find(';')
+            if comment_index != -1:
+                line = line[:comment_index]
+
+            line = line.strip()
+
+            if line == '':
+                continue
+
+            m = REGEX_INCLUDE.match(line)
+
+            if m is not None:
+                name = os.path.join(base, m.group(1))
+
+                try:
+                    f = open(name)
+                except OSError:
+                    fail(f"can't include {name}", 2)
+
+                # the included file counts its own lines
+                outer_line_num = line_num
+
+                with f:
+                    assemble_lines(f, os.path.dirname(name))
+
+                line_num = outer_line_num
+                continue
+
+            label, opcode, op_a, op_b = REGEX.match(line).groups()
+
+            if label is not None:
+                sym[label.upper()] = addr
+
+            if opcode is None:
+                continue
+
+            opcode = opcode.upper()
+
+            if opcode == 'DS':
+                m = REGEX_DS.match(line)
+
+                if m is None or m.group(2) is None:
+                    fail("missing argument to DS", 2)
+
+                data = m.group(2).encode()
+                reserve(len(data))
+                image[addr:addr + len(data)] = data
+                addr += len(data)
+                continue
+
+            if opcode == 'DB':
+                m = REGEX_DB.match(line)
+
+                if m is None or m.group(2) is None:
+                    fail("missing argument to DB", 2)
+
+                try:
+                    val = int(m.group(2), 0)
+                except ValueError:
+                    fail("invalid integer argument to DB", 2)
+
+                reserve(1)
+                image[addr] = val & 0xff
+                addr += 1
+                continue
+
+            if opcode not in opcodes:
+                fail(f"unknown opcode {opcode}", 2)
+
+            op_type, machine_code = opcodes[opcode]
+            operands = (op_a is not None) + (op_b is not None)
+            desired = 2 if op_type == 8 else op_type
+
+            if operands < desired:
+                fail(f"missing operand to {opcode}", 1)
+            elif operands > desired:
+                fail(f"unexpected operand to {opcode}", 1)
+
+            reserve(operands + 1)
+            image[addr] = machine_code
+
+            if operands > 0:
+                image[addr + 1] = get_reg(op_a.upper())
+
+            if op_type == 2:
+                image[addr + 2] = get_reg(op_b.upper())
+
+            elif op_type == 8:
+                try:
+                    image[addr + 2] = int(op_b, 0) & 0xff
+
+                except ValueError:
+                    # a label, which may not be defined yet
+                    target = op_b.upper()
+
+                    if target in sym:
+                        image[addr + 2] = sym[target] & 0xff
+                    else:
+                        fixups.append((addr + 2, target, line_num))
+
+            addr += operands + 1
+
+    assemble_lines(lines, base)
+
+    # Backpatch the forward references
+    for fixup_addr, target, line_num in fixups:
+        if target not in sym:
+            print(f"unknown symbol: {target}", file=sys.stderr)
+            sys.exit(2)
+
+        image[fixup_addr] = sym[target] & 0xff
+
+    return image[:addr], sym
+
+
 def main(argv):
+    # Run the peephole optimizer?
+    optimizing = "-O" in argv
+    # Report unreachable code?
+    reporting = "-D" in argv
+    argv = [arg for arg in argv if arg not in ("-O", "-D")]
+
     # Parse command line
     inputfile, outputfile = parse_commandline(argv)
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
 
+    binary = getattr(outputfile, "mode", None) == "wb"
+
+    # Binary images don't need the text listing, so assemble them in one
+    # pass
+    if binary and not optimizing and not reporting:
+        base = os.path.dirname(getattr(inputfile, "name", ""))
+        machine_code, sym = assemble_stream(inputfile, base=base)
+        write_image(outputfile, sym, machine_code)
+        return 0
+
     # Set up the symbol table
     sym = {}
 
@@ -396,7 +1133,48 @@ def main(argv):
 
     # Assemble
     pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+
+    # Link in included files
+    if includes(code):
+        root = getattr(inputfile, "name", "-")
+        units = {root: resolve_includes(code, root)}
+        pending = includes(units[root])
+
+        while pending:
+            name = pending.pop()
+
+            if name not in units:
+                try:
+                    f = open(name)
+                except OSError:
+                    print(f"can't include {name}", file=sys.stderr)
+                    sys.exit(2)
+
+                with f:
+                    unit = []
+                    pass1(f, {}, unit)
+
+                units[name] = resolve_includes(unit, name)
+                pending += includes(units[name])
+
+        sym, code = link(units, root)
+
+    if optimizing:
+        sym, code, report = optimize(code)
+        print(format_report(getattr(inputfile, "name", "-"), report),
+              file=sys.stderr)
+
+    if reporting:
+        import analyze
+
+        dead, analysis = analyze.dead_code(sym, code)
+        print(analyze.format_dead_code(getattr(inputfile, "name", "-"), dead,
+                                       analysis), file=sys.stderr)
+
+    if binary:
+        pass2_image(outputfile, sym, code)
+    else:
+        pass2(outputfile, sym, code)
 
     return 0
 
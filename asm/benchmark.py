@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark: the single-pass streaming assembler against pass 1 + pass 2 on
+a large generated source.
+"""
+
+import argparse
+import io
+import sys
+import time
+
+import asm
+
+# Straight-line code repeated to make up the source, with calls back to the
+# subroutines at the top
+BLOCK = """\
+    LDI R0,{i}
+    LDI R1,0x{j:02x}
+    ADD R0,R1
+    MUL R0,R1 ; a comment
+    CMP R0,R1
+    PUSH R0
+    POP R2
+    LDI R3,Double
+    CALL R3
+    DB 0b{j:08b}
+"""
+
+
+def generate(blocks):
+    """Yield the lines of a source with blocks copies of BLOCK."""
+
+    # a forward reference, so the streaming assembler has a fixup to patch
+    yield "    LDI R4,Main\n"
+    yield "    JMP R4\n"
+    yield "Double:\n"
+    yield "    ADD R0,R0\n"
+    yield "    RET\n"
+    yield "Message: DS Hello, world\n"
+    yield "Main:\n"
+
+    for i in range(blocks):
+        yield from BLOCK.format(i=i & 0xff, j=(i * 7) & 0xff).splitlines(True)
+
+    yield "    HLT\n"
+
+
+def two_pass(lines):
+    """Assemble with pass 1 and pass 2, to .ls8 text."""
+
+    sym = {}
+    code = []
+    asm.pass1(lines, sym, code)
+
+    output = io.StringIO()
+    asm.pass2(output, sym, code)
+
+    return output.getvalue()
+
+
+def streaming(lines, size):
+    """Assemble in one pass, straight from the line generator."""
+
+    machine_code, sym = asm.assemble_stream(lines, size)
+
+    return machine_code
+
+
+def text_to_bytes(text):
+    """Get the machine code in .ls8 text."""
+
+    return bytes(int(line.split()[0], 2) for line in text.splitlines()
+                 if line != "" and line[0] != "#")
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Compare the streaming and two-pass assemblers.")
+    parser.add_argument(
+        "-b", "--blocks", type=int, default=20000,
+        help="copies of the generated block (10 lines each)")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="runs of each assembler; the best time counts")
+    args = parser.parse_args(argv[1:])
+
+    lines = sum(1 for _ in generate(args.blocks))
+    # the streaming buffer has to hold the whole generated program
+    size = 32 + args.blocks * 25
+
+    best = {}
+
+    for name, run in (("two-pass", lambda: two_pass(generate(args.blocks))),
+                      ("streaming",
+                       lambda: streaming(generate(args.blocks), size))):
+        times = []
+
+        for _ in range(args.repeat):
+            image, seconds = timed(run)
+            times.append(seconds)
+
+        best[name] = (min(times), image)
+
+    if text_to_bytes(best["two-pass"][1]) != best["streaming"][1]:
+        print("images differ!", file=sys.stderr)
+        return 1
+
+    print(f"{lines} lines, {len(best['streaming'][1])} bytes of code")
+
+    for name, (seconds, _) in best.items():
+        print(f"{name:>10}: {seconds:.3f}s  {lines / seconds:,.0f} lines/s")
+
+    speedup = best["two-pass"][0] / best["streaming"][0]
+    print(f"streaming is {speedup:.2f}x the two-pass speed")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,96 @@
+; Conformance test for the LS-8 instructions that set the PC
+;
+; Checks every conditional jump against less than, greater than and equal
+; compares, then CALL/RET and INT/IRET. Jumps that go the wrong way end up
+; at Fail, which prints 99.
+;
+; Expected output:
+; 1
+; 42
+; 3
+; 2
+
+; Branches
+
+    LDI R4,Fail
+
+    LDI R0,1
+    LDI R1,2
+    CMP R0,R1        ; less than
+    JEQ R4
+    JGT R4
+    JGE R4
+    LDI R2,Less1
+    JLT R2
+    JMP R4
+Less1:
+    LDI R2,Less2
+    JLE R2
+    JMP R4
+Less2:
+    LDI R2,Less3
+    JNE R2
+    JMP R4
+Less3:
+
+    CMP R1,R0        ; greater than
+    JEQ R4
+    JLT R4
+    JLE R4
+    LDI R2,Greater1
+    JGT R2
+    JMP R4
+Greater1:
+    LDI R2,Greater2
+    JGE R2
+    JMP R4
+Greater2:
+
+    CMP R0,R0        ; equal
+    JNE R4
+    JLT R4
+    JGT R4
+    LDI R2,Equal1
+    JEQ R2
+    JMP R4
+Equal1:
+    LDI R2,Equal2
+    JGE R2
+    JMP R4
+Equal2:
+    LDI R2,Equal3
+    JLE R2
+    JMP R4
+Equal3:
+    LDI R0,1
+    PRN R0           ; 1
+
+; Subroutines and interrupts
+
+    LDI R2,Sub
+    CALL R2
+    PRN R0           ; 42
+
+    LDI R0,0xFA      ; vector for I2
+    LDI R1,IntHandler
+    ST R0,R1
+    LDI R5,4         ; unmask I2
+    LDI R0,2
+    INT R0
+    PRN R0           ; 2, put back by IRET
+
+    HLT
+
+Sub:
+    LDI R0,42
+    RET
+
+IntHandler:
+    LDI R0,3
+    PRN R0           ; 3
+    IRET
+
+Fail:
+    LDI R0,99
+    PRN R0
+    HLT
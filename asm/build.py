@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Incremental build: assemble a directory of .asm files into .ls8 files,
+reusing cached object units for sources that haven't changed.
+
+Each source file's pass 1 output is an object unit. Labels in it are
+placed by link(), so a unit doesn't depend on where it ends up. Units are
+cached on disk under a hash of the source and of the assembler itself.
+Only new or changed units are assembled, in parallel on a process pool,
+and then every program is linked with the units it .includes.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import asm
+
+# Hash of the assembler, so a changed assembler invalidates the cache
+with open(asm.__file__, "rb") as f:
+    ASSEMBLER_HASH = hashlib.sha256(f.read()).hexdigest()
+
+
+def unit_key(source):
+    """Cache key for the object unit of source (bytes)."""
+
+    return hashlib.sha256(ASSEMBLER_HASH.encode() + source).hexdigest()
+
+
+def assemble(job):
+    """
+    Run pass 1 over one source in a worker. Returns (filename, code), or
+    (filename, None) if the source has errors, which pass 1 has printed.
+    """
+
+    filename, source = job
+    code = []
+
+    try:
+        asm.pass1(io.StringIO(source.decode()), {}, code)
+    except SystemExit:
+        return filename, None
+
+    return filename, code
+
+
+class Cache:
+    """Object units on disk, one JSON file per unit key."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, code):
+        temporary = f"{self.path(key)}.{os.getpid()}.tmp"
+
+        with open(temporary, "w") as f:
+            json.dump(code, f)
+
+        os.replace(temporary, self.path(key))
+
+
+def load_units(roots, cache, workers=None):
+    """
+    Get the pass 1 code of roots and every file they include, from the
+    cache or by assembling them. Returns (units, assembled count), or
+    (None, count) if anything failed to assemble.
+    """
+
+    units = {}
+    pending = list(roots)
+    assembled = 0
+    failed = False
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending:
+            jobs = []
+            keys = {}
+
+            for name in pending:
+                if name in units or name in keys:
+                    continue
+
+                try:
+                    with open(name, "rb") as f:
+                        source = f.read()
+                except OSError:
+                    print(f"can't read {name}", file=sys.stderr)
+                    failed = True
+                    continue
+
+                keys[name] = unit_key(source)
+                code = cache.get(keys[name])
+
+                if code is None:
+                    jobs.append((name, source))
+                else:
+                    units[name] = asm.resolve_includes(code, name)
+
+            for name, code in executor.map(assemble, jobs):
+                assembled += 1
+
+                if code is None:
+                    print(f"{name}: failed to assemble", file=sys.stderr)
+                    failed = True
+                    continue
+
+                cache.put(keys[name], code)
+                units[name] = asm.resolve_includes(code, name)
+
+            # the next round assembles the includes found in this one
+            pending = [included for name in keys if name in units
+                       for included in asm.includes(units[name])
+                       if included not in units]
+
+    return (None if failed else units), assembled
+
+
+def write_if_changed(filename, data):
+    """Write data to filename unless it already holds it. True if written."""
+
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+
+    with open(filename, "wb") as f:
+        f.write(data)
+
+    return True
+
+
+def build(sources, outdir, cache, image=False, workers=None,
+          optimizing=False):
+    """
+    Assemble and link sources into outdir, running the peephole optimizer
+    over each program if optimizing. Returns the number of programs
+    written, or None if anything failed.
+    """
+
+    units, assembled = load_units(sources, cache, workers)
+
+    print(f"assembled {assembled} of {len(units or ())} units",
+          file=sys.stderr)
+
+    if units is None:
+        return None
+
+    written = 0
+    extension = ".ls8b" if image else ".ls8"
+
+    for source in sources:
+        sym, code = asm.link(units, source)
+
+        if optimizing:
+            sym, code, report = asm.optimize(code)
+            print(asm.format_report(source, report), file=sys.stderr)
+
+        name = os.path.splitext(os.path.basename(source))[0] + extension
+
+        if image:
+            output = io.BytesIO()
+            asm.pass2_image(output, sym, code)
+            data = output.getvalue()
+        else:
+            output = io.StringIO()
+            asm.pass2(output, sym, code)
+            data = output.getvalue().encode()
+
+        if write_if_changed(os.path.join(outdir, name), data):
+            written += 1
+
+    return written
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Assemble every .asm file in a directory, incrementally.")
+    parser.add_argument(
+        "srcdir", nargs="?", default=".", help="directory of .asm files")
+    parser.add_argument(
+        "outdir", nargs="?", default=os.path.join("..", "ls8", "examples"),
+        help="directory for the assembled programs")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: one per core)")
+    parser.add_argument(
+        "--cache", default=None,
+        help="object unit cache directory (default: SRCDIR/.asmcache)")
+    parser.add_argument(
+        "--image", action="store_true",
+        help="write .ls8b binary images instead of .ls8 text")
+    parser.add_argument(
+        "-O", "--optimize", action="store_true",
+        help="run the peephole optimizer and report what it saved")
+    args = parser.parse_args(argv[1:])
+
+    sources = sorted(
+        os.path.normpath(os.path.join(args.srcdir, name))
+        for name in os.listdir(args.srcdir) if name.endswith(".asm"))
+
+    cache = Cache(args.cache or os.path.join(args.srcdir, ".asmcache"))
+    os.makedirs(args.outdir, exist_ok=True)
+
+    written = build(sources, args.outdir, cache, args.image, args.jobs,
+                    args.optimize)
+
+    if written is None:
+        return 1
+
+    print(f"wrote {written} of {len(sources)} programs", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
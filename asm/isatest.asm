@@ -0,0 +1,105 @@
+; Conformance test for the LS-8 ALU, memory and stack instructions
+;
+; Runs each of them, including 8-bit wraparound on the ALU results. See
+; branchtest.asm for the instructions that set the PC.
+;
+; Expected output:
+; 44
+; 254
+; 4
+; 14
+; 2
+; 8
+; 14
+; 6
+; 243
+; 4
+; 48
+; 0
+; 255
+; 77
+; 11
+; A
+
+    NOP
+
+; ALU
+
+    LDI R0,200
+    LDI R1,100
+    ADD R0,R1        ; 300 wraps to 44
+    PRN R0
+
+    LDI R0,5
+    LDI R1,7
+    SUB R0,R1        ; -2 wraps to 254
+    PRN R0
+
+    LDI R0,20
+    LDI R1,13
+    MUL R0,R1        ; 260 wraps to 4
+    PRN R0
+
+    LDI R0,100
+    LDI R1,7
+    DIV R0,R1        ; 14
+    PRN R0
+
+    LDI R0,100
+    MOD R0,R1        ; 2
+    PRN R0
+
+    LDI R0,0b1100
+    LDI R1,0b1010
+    AND R0,R1        ; 8
+    PRN R0
+
+    LDI R0,0b1100
+    OR R0,R1         ; 14
+    PRN R0
+
+    LDI R0,0b1100
+    XOR R0,R1        ; 6
+    PRN R0
+
+    LDI R0,0b1100
+    NOT R0           ; 243
+    PRN R0
+
+    LDI R0,0b11000001
+    LDI R1,2
+    SHL R0,R1        ; 4
+    PRN R0
+
+    LDI R0,0b11000001
+    SHR R0,R1        ; 48
+    PRN R0
+
+    LDI R0,255
+    INC R0           ; 256 wraps to 0
+    PRN R0
+    DEC R0           ; -1 wraps to 255
+    PRN R0
+
+; Memory and stack
+
+    LDI R0,Data
+    LDI R1,77
+    ST R0,R1
+    LD R2,R0
+    PRN R2           ; 77
+
+    LDI R0,11
+    PUSH R0
+    POP R3
+    PRN R3           ; 11
+
+    LDI R0,65
+    PRA R0           ; A
+    LDI R0,10
+    PRA R0           ; newline
+
+    HLT
+
+Data:
+    DB 0
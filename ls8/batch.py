@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""Batch runner: run many LS-8 programs across a pool of processes."""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import (CPU, CaptureOutput, CPUError, HALTED, IDLE, IDLE_RETURN,
+                 LoadError)
+
+
+def find_programs(target):
+    """
+    Get the list of .ls8/.ls8b files to run from a directory, a manifest
+    file (one path per line, relative to the manifest) or a single program.
+    """
+
+    if os.path.isdir(target):
+        return sorted(
+            os.path.join(target, name)
+            for name in os.listdir(target)
+            if name.endswith((".ls8", ".ls8b")))
+
+    if target.endswith((".ls8", ".ls8b")):
+        return [target]
+
+    base = os.path.dirname(target)
+    programs = []
+
+    with open(target) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+
+            if line != "":
+                programs.append(os.path.join(base, line))
+
+    return programs
+
+
+def read_seeds(filename):
+    """
+    Read initial machine states from a JSON lines file. Each line looks like
+    {"registers": {"0": 10}, "ram": {"200": 7}}; both keys are optional.
+    """
+
+    seeds = []
+
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+
+            if line != "":
+                seeds.append(json.loads(line))
+
+    return seeds
+
+
+def apply_seed(cpu, seed):
+    """
+    Set the registers and RAM given in seed on a loaded CPU. Raises
+    LoadError for a register or address the machine doesn't have.
+    """
+
+    for index, value in seed.get("registers", {}).items():
+        if not 0 <= int(index) <= 7:
+            raise LoadError(f"Invalid seed: no register R{index}")
+
+        cpu.register[int(index)] = value & 0xff
+
+    for address, value in seed.get("ram", {}).items():
+        if not 0 <= int(address) <= 0xff:
+            raise LoadError(f"Invalid seed: RAM address {address} out of "
+                            f"range")
+
+        cpu.ram_write(int(address), value & 0xff)
+
+
+def run_job(job):
+    """Run one program with one seed and return its result as a dict."""
+
+    program, seed_index, seed, max_steps = job
+
+    cpu = CPU()
+    output = CaptureOutput()
+    cpu.set_output(output)
+    # hand spin loops back instead of sleeping through them
+    cpu.idle_policy = IDLE_RETURN
+    status = None
+    steps = 0
+    error = None
+
+    try:
+        cpu.load(program)
+
+        if seed is not None:
+            apply_seed(cpu, seed)
+
+        result = cpu.run(max_steps=max_steps)
+        steps = result.steps
+
+        # nobody watches a batch run, so a program spinning until the timer
+        # skips ahead to its deadline; it's only done when nothing can
+        # wake it
+        while result.status == IDLE and cpu.wake_delay() is not None:
+            cpu.next_timer = time.monotonic()
+            result = cpu.run(
+                max_steps=None if max_steps is None else max_steps - steps)
+            steps += result.steps
+
+        status = result.status
+
+        if result.fault is not None:
+            error = str(result.fault)
+
+    except CPUError as e:
+        error = str(e)
+
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    return {
+        "program": program,
+        "seed": seed_index,
+        "output": output.text().splitlines(),
+        "status": status,
+        "steps": steps,
+        "error": error,
+        "halted": status == HALTED,
+        "pc": cpu.program_counter,
+        "flag": cpu.flag,
+        "registers": list(cpu.register),
+        "ram": list(cpu.ram),
+    }
+
+
+def make_jobs(programs, seeds, max_steps=None):
+    """Pair every program with every seed (or with no seed)."""
+
+    for program in programs:
+        if seeds is None:
+            yield (program, None, None, max_steps)
+        else:
+            for seed_index, seed in enumerate(seeds):
+                yield (program, seed_index, seed, max_steps)
+
+
+def run_batch(programs, seeds=None, workers=None, chunksize=16,
+              max_steps=None):
+    """
+    Run every job on a process pool and yield the results in job order as
+    they finish.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(
+            run_job, make_jobs(programs, seeds, max_steps),
+            chunksize=chunksize)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run LS-8 programs in parallel, one JSON line per run.")
+    parser.add_argument(
+        "target", help="directory of programs, manifest file or one program")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None,
+        help="number of worker processes (default: one per core)")
+    parser.add_argument(
+        "-s", "--seeds",
+        help="JSON lines file of initial registers/RAM to run each program with")
+    parser.add_argument(
+        "-c", "--chunksize", type=int, default=16,
+        help="jobs handed to a worker at a time")
+    parser.add_argument(
+        "-m", "--max-steps", type=int, default=None,
+        help="stop each run after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    programs = find_programs(args.target)
+    seeds = read_seeds(args.seeds) if args.seeds else None
+
+    for result in run_batch(programs, seeds, args.workers,
+                            args.chunksize, args.max_steps):
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
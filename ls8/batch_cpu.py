@@ -0,0 +1,410 @@
+"""Lockstep SIMD CPU: run many LS-8 machines at once on NumPy arrays."""
+
+import numpy as np
+
+from cpu import *
+
+# Lowest set bit of every byte, for picking the interrupt to service
+LOWEST_BIT = np.array([(value & -value).bit_length() - 1 if value else 0
+                       for value in range(256)], dtype=np.int64)
+
+
+class BatchCPU:
+    """
+    N independent LS-8 machines stepped together. Every machine has its own
+    RAM, registers, PC and flag, so lanes that branch differently never wait
+    on each other: each step groups the running lanes by the opcode at
+    their PC and runs each group as one vector operation.
+
+    Lanes run the same instructions as CPU and fault the same way. There is
+    no timer or keyboard, so interrupts only come from INT, and they are
+    serviced right after INT or IRET, where CPU polls for them.
+    """
+
+    def __init__(self, lanes):
+        """Construct lanes machines in the power on state."""
+        self.lanes = lanes
+        self.ram = np.zeros((lanes, 256), dtype=np.uint8)
+        self.register = np.zeros((lanes, 8), dtype=np.uint8)
+        self.register[:, 7] = 0xf4
+        self.program_counter = np.zeros(lanes, dtype=np.int64)
+        self.flag = np.zeros(lanes, dtype=np.uint8)
+        self.running = np.ones(lanes, dtype=bool)
+        self.fault = np.zeros(lanes, dtype=np.uint8)
+        self.interrupts_enabled = np.ones(lanes, dtype=bool)
+        self.steps = 0
+        # PRN and PRA output, the bytes CPU would write for each lane
+        self.output = [bytearray() for _ in range(lanes)]
+
+        self.dispatch_table = {}
+        self.dispatch_table[NOP] = self.handle_nop
+        self.dispatch_table[HLT] = self.handle_hlt
+        self.dispatch_table[LDI] = self.handle_ldi
+        self.dispatch_table[LD] = self.handle_ld
+        self.dispatch_table[ST] = self.handle_st
+        self.dispatch_table[PRN] = self.handle_prn
+        self.dispatch_table[PRA] = self.handle_pra
+        self.dispatch_table[INT] = self.handle_int
+        self.dispatch_table[IRET] = self.handle_iret
+        self.dispatch_table[ADD] = self.handle_add
+        self.dispatch_table[SUB] = self.handle_sub
+        self.dispatch_table[MUL] = self.handle_mul
+        self.dispatch_table[CMP] = self.handle_cmp
+        self.dispatch_table[PUSH] = self.handle_push
+        self.dispatch_table[POP] = self.handle_pop
+        self.dispatch_table[CALL] = self.handle_call
+        self.dispatch_table[RET] = self.handle_ret
+        self.dispatch_table[JMP] = self.handle_jmp
+        self.dispatch_table[JEQ] = self.handle_jeq
+        self.dispatch_table[JNE] = self.handle_jne
+        self.dispatch_table[JGT] = self.handle_jgt
+        self.dispatch_table[JLT] = self.handle_jlt
+        self.dispatch_table[JGE] = self.handle_jge
+        self.dispatch_table[JLE] = self.handle_jle
+        self.dispatch_table[AND] = self.handle_and
+        self.dispatch_table[OR] = self.handle_or
+        self.dispatch_table[XOR] = self.handle_xor
+        self.dispatch_table[NOT] = self.handle_not
+        self.dispatch_table[SHL] = self.handle_shl
+        self.dispatch_table[SHR] = self.handle_shr
+        self.dispatch_table[DIV] = self.handle_div
+        self.dispatch_table[MOD] = self.handle_mod
+        self.dispatch_table[INC] = self.handle_inc
+        self.dispatch_table[DEC] = self.handle_dec
+
+    def load(self, filename=None):
+        """Load the same program into every lane."""
+
+        cpu = CPU()
+        cpu.load(filename)
+        self.ram[:] = np.frombuffer(cpu.ram, dtype=np.uint8)
+
+    # Every handler gets the lane indices in its group and the operand bytes
+    # for those lanes, and returns the next PC for them.
+
+    def handle_unknown(self, lanes, a, b):
+        self.running[lanes] = False
+        self.fault[lanes] = FAULT_UNKNOWN_INSTRUCTION
+        return self.program_counter[lanes]
+
+    # Register operand above R7 (fault)
+    def handle_invalid_register(self, lanes, a, b):
+        self.running[lanes] = False
+        self.fault[lanes] = FAULT_INVALID_REGISTER
+        return self.program_counter[lanes]
+
+    # NOP (do nothing)
+    def handle_nop(self, lanes, a, b):
+        return self.program_counter[lanes] + 1
+
+    # HLT (halt the CPU and exit the emulator)
+    def handle_hlt(self, lanes, a, b):
+        self.running[lanes] = False
+        return self.program_counter[lanes] + 1
+
+    # LDI (set the value of a register to an integer)
+    def handle_ldi(self, lanes, a, b):
+        self.register[lanes, a] = b
+        return self.program_counter[lanes] + 3
+
+    # LD (load registerA with the value at the memory address stored in registerB)
+    def handle_ld(self, lanes, a, b):
+        self.register[lanes, a] = self.ram[lanes, self.register[lanes, b]]
+        return self.program_counter[lanes] + 3
+
+    # ST (store the value in registerB at the address stored in registerA)
+    def handle_st(self, lanes, a, b):
+        self.ram[lanes, self.register[lanes, a]] = self.register[lanes, b]
+        return self.program_counter[lanes] + 3
+
+    # PRN (print numeric value stored in the given register)
+    def handle_prn(self, lanes, a, b):
+        for lane, value in zip(lanes.tolist(), self.register[lanes, a].tolist()):
+            self.output[lane] += PRN_TEXT[value]
+
+        return self.program_counter[lanes] + 2
+
+    # PRA (print alpha character value stored in the given register)
+    def handle_pra(self, lanes, a, b):
+        for lane, value in zip(lanes.tolist(), self.register[lanes, a].tolist()):
+            self.output[lane] += PRA_TEXT[value]
+
+        return self.program_counter[lanes] + 2
+
+    # INT (issue the interrupt number stored in the given register)
+    def handle_int(self, lanes, a, b):
+        self.register[lanes, IS] |= (
+            1 << (self.register[lanes, a] & 0b00000111)).astype(np.uint8)
+        return self.program_counter[lanes] + 2
+
+    # IRET (return from an interrupt handler)
+    def handle_iret(self, lanes, a, b):
+        # pop R6-R0, the flag and the return address
+        for i in range(6, -1, -1):
+            self.register[lanes, i] = self.pop_value(lanes)
+
+        self.flag[lanes] = self.pop_value(lanes)
+        self.interrupts_enabled[lanes] = True
+        return self.pop_value(lanes)
+
+    def service_interrupts(self, lanes):
+        """
+        Service the lowest pending interrupt that is not masked on each of
+        the lanes, like CPU.poll().
+        """
+
+        pending = self.register[lanes, IM] & self.register[lanes, IS]
+        lanes = lanes[self.interrupts_enabled[lanes] & (pending != 0)]
+        if lanes.size == 0:
+            return
+
+        interrupt = LOWEST_BIT[self.register[lanes, IM]
+                               & self.register[lanes, IS]]
+
+        # disable further interrupts and clear this one
+        self.interrupts_enabled[lanes] = False
+        self.register[lanes, IS] &= ~(1 << interrupt).astype(np.uint8)
+
+        # save the machine state on the stack
+        self.push_value(lanes, self.program_counter[lanes] & 0xff)
+        self.push_value(lanes, self.flag[lanes])
+
+        for i in range(7):
+            self.push_value(lanes, self.register[lanes, i])
+
+        # jump to the handler
+        self.program_counter[lanes] = self.ram[
+            lanes, INTERRUPT_VECTORS + interrupt]
+
+    def push_value(self, lanes, values):
+        self.register[lanes, 7] -= 1
+        self.ram[lanes, self.register[lanes, 7]] = values
+
+    def pop_value(self, lanes):
+        values = self.ram[lanes, self.register[lanes, 7]]
+        self.register[lanes, 7] += 1
+        return values
+
+    def alu(self, lanes, a, b, result):
+        """Store an ALU result for the lanes, wrapped to 8 bits."""
+
+        self.register[lanes, a] = result & 0xff
+        return self.program_counter[lanes] + 3
+
+    def operands(self, lanes, a, b):
+        """Get the register values of both operands, widened for math."""
+
+        return (self.register[lanes, a].astype(np.int64),
+                self.register[lanes, b].astype(np.int64))
+
+    # ADD (add the value in two registers and store the result in registerA)
+    def handle_add(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a + value_b)
+
+    # SUB (subtract the value in the second register from the first, storing the result in registerA)
+    def handle_sub(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a - value_b)
+
+    # MUL (multiply the values in two registers together and store the result in registerA)
+    def handle_mul(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a * value_b)
+
+    # CMP (compare the values in two registers)
+    def handle_cmp(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        self.flag[lanes] = np.where(
+            value_a < value_b, 0b00000100,
+            np.where(value_a > value_b, 0b00000010, 0b00000001))
+        return self.program_counter[lanes] + 3
+
+    # AND (Bitwise-AND the values in registerA and registerB, then store the result in registerA)
+    def handle_and(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a & value_b)
+
+    # OR (perform a bitwise-OR between the values in registerA and registerB, storing the result in registerA)
+    def handle_or(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a | value_b)
+
+    # XOR (perform a bitwise-XOR between the values in registerA and registerB, storing the result in registerA)
+    def handle_xor(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, value_a ^ value_b)
+
+    # NOT (perform a bitwise-NOT on the value in a register, storing the result in the register)
+    def handle_not(self, lanes, a, b):
+        self.register[lanes, a] = ~self.register[lanes, a]
+        return self.program_counter[lanes] + 2
+
+    # SHL (shift the value in registerA left by the number of bits specified in registerB, filling the low bits with 0)
+    def handle_shl(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, np.where(value_b > 7, 0, value_a << np.minimum(value_b, 8)))
+
+    # SHR (shift the value in registerA right by the number of bits specified in registerB, filling the high bits with 0)
+    def handle_shr(self, lanes, a, b):
+        value_a, value_b = self.operands(lanes, a, b)
+        return self.alu(lanes, a, b, np.where(value_b > 7, 0, value_a >> np.minimum(value_b, 8)))
+
+    def divide(self, lanes, a, b, operation):
+        """DIV or MOD, faulting the lanes that divide by 0."""
+
+        value_a, value_b = self.operands(lanes, a, b)
+
+        # lanes dividing by 0 halt with a fault and stay on the instruction
+        zero = value_b == 0
+        self.running[lanes[zero]] = False
+        self.fault[lanes[zero]] = FAULT_DIVIDE_BY_ZERO
+
+        ok = ~zero
+        self.register[lanes[ok], a[ok]] = operation(value_a[ok], value_b[ok])
+        return self.program_counter[lanes] + np.where(zero, 0, 3)
+
+    # DIV (divide the value in the first register by the value in the second, storing the result in registerA)
+    def handle_div(self, lanes, a, b):
+        return self.divide(lanes, a, b, np.floor_divide)
+
+    # MOD (divide the value in the first register by the value in the second, storing the remainder of the result in registerA)
+    def handle_mod(self, lanes, a, b):
+        return self.divide(lanes, a, b, np.remainder)
+
+    # INC (increment the value in the given register)
+    def handle_inc(self, lanes, a, b):
+        self.register[lanes, a] += 1
+        return self.program_counter[lanes] + 2
+
+    # DEC (decrement the value in the given register)
+    def handle_dec(self, lanes, a, b):
+        self.register[lanes, a] -= 1
+        return self.program_counter[lanes] + 2
+
+    # PUSH (push the value in the given register on the stack)
+    def handle_push(self, lanes, a, b):
+        # like CPU, PUSH R7 pushes the already decremented stack pointer
+        self.register[lanes, 7] -= 1
+        self.ram[lanes, self.register[lanes, 7]] = self.register[lanes, a]
+        return self.program_counter[lanes] + 2
+
+    # POP (pop the value at the top of the stack into the given register)
+    def handle_pop(self, lanes, a, b):
+        # like CPU, POP R7 sets the stack pointer one past the popped value
+        self.register[lanes, a] = self.ram[lanes, self.register[lanes, 7]]
+        self.register[lanes, 7] += 1
+        return self.program_counter[lanes] + 2
+
+    # CALL (push the return address and jump to the address in the register)
+    def handle_call(self, lanes, a, b):
+        self.push_value(lanes, (self.program_counter[lanes] + 2) & 0xff)
+        return self.register[lanes, a]
+
+    # RET (return from subroutine)
+    def handle_ret(self, lanes, a, b):
+        return self.pop_value(lanes)
+
+    # JMP (jump to the address stored in the given register)
+    def handle_jmp(self, lanes, a, b):
+        return self.register[lanes, a]
+
+    # JEQ (if equal flag is true, jump to the address in the register)
+    def handle_jeq(self, lanes, a, b):
+        return np.where(self.flag[lanes] & 0b00000001,
+                        self.register[lanes, a],
+                        self.program_counter[lanes] + 2)
+
+    # JNE (if equal flag is false, jump to the address in the register)
+    def handle_jne(self, lanes, a, b):
+        return np.where(self.flag[lanes] & 0b00000001,
+                        self.program_counter[lanes] + 2,
+                        self.register[lanes, a])
+
+    def jump_if(self, lanes, a, flags):
+        """Jump the lanes whose flag has any of flags set."""
+
+        return np.where(self.flag[lanes] & flags,
+                        self.register[lanes, a],
+                        self.program_counter[lanes] + 2)
+
+    # JGT (if greater-than flag is true, jump to the address in the register)
+    def handle_jgt(self, lanes, a, b):
+        return self.jump_if(lanes, a, FLAG_GREATER)
+
+    # JLT (if less-than flag is true, jump to the address in the register)
+    def handle_jlt(self, lanes, a, b):
+        return self.jump_if(lanes, a, FLAG_LESS)
+
+    # JGE (if greater-than or equal flag is true, jump to the address in the register)
+    def handle_jge(self, lanes, a, b):
+        return self.jump_if(lanes, a, FLAG_GREATER | FLAG_EQUAL)
+
+    # JLE (if less-than or equal flag is true, jump to the address in the register)
+    def handle_jle(self, lanes, a, b):
+        return self.jump_if(lanes, a, FLAG_LESS | FLAG_EQUAL)
+
+    def step(self):
+        """Run one instruction on every running lane."""
+
+        lanes = np.flatnonzero(self.running)
+        if lanes.size == 0:
+            return 0
+
+        pc = self.program_counter[lanes]
+        instruction_register = self.ram[lanes, pc]
+        operand_a = self.ram[lanes, (pc + 1) & 0xff].astype(np.int64)
+        operand_b = self.ram[lanes, (pc + 2) & 0xff].astype(np.int64)
+
+        for opcode in np.unique(instruction_register).tolist():
+            group = instruction_register == opcode
+            group_lanes = lanes[group]
+            a = operand_a[group]
+            b = operand_b[group]
+            handler = self.dispatch_table.get(opcode)
+
+            if handler is None:
+                self.program_counter[group_lanes] = self.handle_unknown(
+                    group_lanes, a, b)
+                continue
+
+            # the first operand is always a register, and so is the second
+            # except for LDI's immediate value
+            operand_count = opcode >> 6
+            invalid = np.zeros(group_lanes.size, dtype=bool)
+            if operand_count > 0:
+                invalid |= a > 7
+            if operand_count > 1 and opcode != LDI:
+                invalid |= b > 7
+
+            if invalid.any():
+                self.handle_invalid_register(group_lanes[invalid], a, b)
+                valid = ~invalid
+                group_lanes, a, b = group_lanes[valid], a[valid], b[valid]
+
+            self.program_counter[group_lanes] = handler(
+                group_lanes, a, b) & 0xff
+
+            # CPU polls for interrupts right after these
+            if opcode == INT or opcode == IRET:
+                self.service_interrupts(
+                    group_lanes[self.running[group_lanes]])
+
+        self.steps += lanes.size
+        return lanes.size
+
+    def run(self, max_steps=None):
+        """
+        Run every lane until it halts or faults, or until max_steps lockstep
+        steps have gone by. Returns the number of lockstep steps.
+        """
+
+        count = 0
+
+        while max_steps is None or count < max_steps:
+            if self.step() == 0:
+                break
+
+            count += 1
+
+        return count
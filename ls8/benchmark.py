@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark: throughput of the emulator and the assembler on a fixed corpus,
+with JSON output and comparison against a saved baseline.
+
+The corpus is every program in examples/, every source in ../asm and a set
+of synthetic kernels that each lean on one part of the CPU. Every timing is
+the best of --repeat runs, and each run repeats its work until it has
+lasted long enough to time.
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from cpu import *
+import programs
+
+asm = programs.asm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ASM_DIR = os.path.join(HERE, "..", "asm")
+
+# Instruction budget for example programs, some of which never halt
+EXAMPLE_STEPS = 200000
+
+# Minimum work in one timed run
+MIN_SECONDS = 0.2
+
+# Synthetic kernels. R5 and R6 are left alone so no interrupts fire.
+KERNELS = {
+    # tight CMP/JNE loops
+    "loop": """
+        LDI R2,250
+        LDI R3,Inner
+        LDI R4,Outer
+        LDI R0,0
+    Outer:
+        LDI R1,0
+    Inner:
+        INC R1
+        CMP R1,R2
+        JNE R3
+        INC R0
+        CMP R0,R2
+        JNE R4
+        HLT
+    """,
+
+    # deep CALL/RET recursion
+    "recursion": """
+        LDI R2,Down
+        LDI R3,0
+        LDI R4,250
+    Again:
+        LDI R0,100
+        CALL R2
+        DEC R4
+        LDI R1,Again
+        CMP R4,R3
+        JNE R1
+        HLT
+    Down:
+        CMP R0,R3
+        LDI R1,Return
+        JEQ R1
+        DEC R0
+        CALL R2
+    Return:
+        RET
+    """,
+
+    # PUSH/POP heavy
+    "stack": """
+        LDI R2,250
+        LDI R3,Inner
+        LDI R4,Outer
+        LDI R0,0
+    Outer:
+        LDI R1,0
+    Inner:
+        PUSH R0
+        PUSH R1
+        PUSH R2
+        POP R2
+        POP R1
+        POP R0
+        INC R1
+        CMP R1,R2
+        JNE R3
+        INC R0
+        CMP R0,R2
+        JNE R4
+        HLT
+    """,
+
+    # PRN heavy
+    "output": """
+        LDI R2,40
+        LDI R3,Inner
+        LDI R4,Outer
+        LDI R0,0
+    Outer:
+        LDI R1,0
+    Inner:
+        PRN R1
+        INC R1
+        CMP R1,R2
+        JNE R3
+        INC R0
+        CMP R0,R2
+        JNE R4
+        HLT
+    """,
+}
+
+# Whether a bigger number is better for each metric
+HIGHER_IS_BETTER = {
+    "instructions_per_second": True,
+    "lines_per_second": True,
+    "seconds": False,
+    "peak_kib": False,
+}
+
+
+def best_rate(work, repeat):
+    """
+    Time work(), which returns how many units it did, repeating it until
+    each run lasts MIN_SECONDS. Returns the best units per second.
+    """
+
+    best = 0
+
+    for _ in range(repeat):
+        units = 0
+        start = time.perf_counter()
+
+        while True:
+            units += work()
+            elapsed = time.perf_counter() - start
+
+            if elapsed >= MIN_SECONDS:
+                break
+
+        best = max(best, units / elapsed)
+
+    return best
+
+
+def peak_memory(work):
+    """Get the peak memory traced while work() runs once, in KiB."""
+
+    tracemalloc.start()
+
+    try:
+        work()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(cpu, max_steps, repeat):
+    """Measure CPU.run on a loaded CPU, starting over from its state."""
+
+    state = cpu.snapshot()
+    devnull = open(os.devnull, "wb")
+    cpu.set_output(BufferedOutput(devnull))
+    # measure spin loops as spin loops, rather than sleeping through them
+    cpu.idle_policy = None
+
+    def work():
+        cpu.restore(state)
+        cpu.next_timer = None
+        return cpu.run(max_steps=max_steps).steps
+
+    try:
+        return {
+            "instructions_per_second": best_rate(work, repeat),
+            "peak_kib": peak_memory(work),
+        }
+    finally:
+        cpu.output.flush()
+        devnull.close()
+
+
+def load_benchmark(filename, repeat):
+    """Measure CPU.load on a program file."""
+
+    cpu = CPU()
+
+    def work():
+        cpu.load(filename)
+        return 1
+
+    return {"seconds": 1 / best_rate(work, repeat)}
+
+
+def assembler_benchmark(assemble, sources, repeat):
+    """Measure an assembler over every source, in lines per second."""
+
+    texts = []
+
+    for filename in sources:
+        with open(filename) as f:
+            texts.append(f.read())
+
+    lines = sum(text.count("\n") + 1 for text in texts)
+
+    def work():
+        for text in texts:
+            assemble(text)
+
+        return lines
+
+    return {
+        "lines_per_second": best_rate(work, repeat),
+        "peak_kib": peak_memory(work),
+    }
+
+
+def two_pass(text):
+    sym = {}
+    code = []
+    asm.pass1(text.splitlines(), sym, code)
+    asm.pass2(io.StringIO(), sym, code)
+
+
+def streaming(text):
+    asm.assemble_stream(text.splitlines())
+
+
+def run_all(repeat, only=None):
+    """Run the whole suite and return {benchmark name: metrics}."""
+
+    results = {}
+
+    def wanted(name):
+        return only is None or any(part in name for part in only)
+
+    examples = sorted(glob.glob(os.path.join(HERE, "examples", "*.ls8"))
+                      + glob.glob(os.path.join(HERE, "examples", "*.ls8b")))
+
+    for filename in examples:
+        name = os.path.basename(filename)
+
+        if wanted(f"run/{name}"):
+            cpu = CPU()
+            cpu.load(filename)
+            results[f"run/{name}"] = run_benchmark(cpu, EXAMPLE_STEPS,
+                                                   repeat)
+
+        if wanted(f"load/{name}"):
+            results[f"load/{name}"] = load_benchmark(filename, repeat)
+
+    for name, source in KERNELS.items():
+        if wanted(f"run/kernel/{name}"):
+            cpu = CPU()
+            programs.assemble_uncached(source).load(cpu)
+            results[f"run/kernel/{name}"] = run_benchmark(cpu, None, repeat)
+
+    sources = sorted(glob.glob(os.path.join(ASM_DIR, "*.asm")))
+
+    for name, assemble in (("two-pass", two_pass), ("streaming", streaming)):
+        if wanted(f"asm/{name}"):
+            results[f"asm/{name}"] = assembler_benchmark(assemble, sources,
+                                                         repeat)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each metric against the baseline and return the names of the
+    ones that got worse by more than threshold (a fraction).
+    """
+
+    regressions = []
+
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+
+            if not old:
+                continue
+
+            change = value / old - 1
+
+            if not HIGHER_IS_BETTER[metric]:
+                change = -change
+
+            worse = change < -threshold
+            if worse:
+                regressions.append(f"{name} {metric}")
+
+            print(f"{name:<32} {metric:<24} {old:>14.6g} -> {value:<14.6g} "
+                  f"{change:+7.1%}{'  REGRESSION' if worse else ''}")
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the LS-8 emulator and assembler.")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5,
+        help="timed runs per benchmark; the best one counts")
+    parser.add_argument(
+        "-o", "--output", help="write the results to this JSON file")
+    parser.add_argument(
+        "-b", "--baseline", help="compare against this JSON results file")
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.10,
+        help="slowdown that counts as a regression (default: 0.10)")
+    parser.add_argument(
+        "only", nargs="*",
+        help="only run benchmarks whose names contain one of these")
+    args = parser.parse_args(argv[1:])
+
+    results = run_all(args.repeat, args.only or None)
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline["results"], args.threshold)
+
+        if regressions:
+            print(f"\n{len(regressions)} regressions", file=sys.stderr)
+            return 1
+
+        return 0
+
+    for name, metrics in results.items():
+        print(f"{name:<32} " + "  ".join(
+            f"{metric} {value:.6g}" for metric, value in metrics.items()))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
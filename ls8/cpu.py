@@ -1,6 +1,14 @@
 """CPU functionality."""
 
+import io
+import os
+import selectors
+import struct
 import sys
+import time
+import zlib
+from collections import OrderedDict
+from itertools import repeat
 
 HLT = 0b00000001  # 1
 LDI = 0b10000010  # 130
@@ -23,6 +31,665 @@ NOT = 0b01101001  # 105
 SHL = 0b10101100  # 172
 SHR = 0b10101101  # 173
 MOD = 0b10100100  # 164
+LD = 0b10000011  # 131
+ST = 0b10000100  # 132
+PRA = 0b01001000  # 72
+INT = 0b01010010  # 82
+IRET = 0b00010011  # 19
+DIV = 0b10100011  # 163
+INC = 0b01100101  # 101
+DEC = 0b01100110  # 102
+NOP = 0b00000000  # 0
+JGT = 0b01010111  # 87
+JLT = 0b01011000  # 88
+JLE = 0b01011001  # 89
+JGE = 0b01011010  # 90
+
+# ALU operations on two 8-bit register values, by opcode. The result goes
+# in registerA.
+ALU_OPERATIONS = {
+    # ADD (add the value in two registers)
+    ADD: lambda a, b: (a + b) & 0xff,
+    # SUB (subtract the value in the second register from the first)
+    SUB: lambda a, b: (a - b) & 0xff,
+    # MUL (multiply the values in two registers together)
+    MUL: lambda a, b: (a * b) & 0xff,
+    # AND (bitwise-AND the values in registerA and registerB)
+    AND: lambda a, b: a & b,
+    # OR (bitwise-OR the values in registerA and registerB)
+    OR: lambda a, b: a | b,
+    # XOR (bitwise-XOR the values in registerA and registerB)
+    XOR: lambda a, b: a ^ b,
+    # SHL (shift registerA left by registerB bits, filling the low bits with 0)
+    SHL: lambda a, b: (a << b) & 0xff if b < 8 else 0,
+    # SHR (shift registerA right by registerB bits, filling the high bits with 0)
+    SHR: lambda a, b: a >> b,
+}
+
+# ALU operations on one register, as precomputed tables of the result for
+# every 8-bit value
+ALU_TABLES = {
+    # INC (increment the value in the given register)
+    INC: [(value + 1) & 0xff for value in range(256)],
+    # DEC (decrement the value in the given register)
+    DEC: [(value - 1) & 0xff for value in range(256)],
+    # NOT (bitwise-NOT the value in the given register)
+    NOT: [~value & 0xff for value in range(256)],
+}
+
+# Flag bits
+FLAG_LESS = 0b00000100
+FLAG_GREATER = 0b00000010
+FLAG_EQUAL = 0b00000001
+
+# Registers reserved for the interrupt mask and interrupt status
+IM = 5
+IS = 6
+
+# Interrupt vector table and the key pressed address
+INTERRUPT_VECTORS = 0xf8
+KEY_PRESSED = 0xf4
+
+# Interrupt numbers
+TIMER_INTERRUPT = 0
+KEYBOARD_INTERRUPT = 1
+
+# Fault codes, for a program that did something the CPU can't do
+FAULT_NONE = 0
+FAULT_UNKNOWN_INSTRUCTION = 1
+FAULT_DIVIDE_BY_ZERO = 2
+FAULT_INVALID_REGISTER = 3
+
+# How a call to run() ended
+HALTED = "halted"
+BUDGET_EXHAUSTED = "budget exhausted"
+BREAKPOINT = "breakpoint"
+FAULTED = "fault"
+IDLE = "idle"
+
+# What run() does when the program spins waiting for an interrupt: sleep
+# until the timer or a key press can wake it, or return IDLE to the host
+IDLE_SLEEP = "sleep"
+IDLE_RETURN = "return"
+
+# Most instructions run looking for a spin loop
+IDLE_PROBE_STEPS = 64
+
+# How often run_async() looks for a key press while idle
+IDLE_WAIT_SLICE = 0.01
+
+# Instructions a second a spin loop is counted as running while run() sleeps
+# through it with a step budget, so the budget runs out without spinning
+IDLE_STEP_RATE = 1000000
+
+# Longest pair of instructions run() fuses into one handler, in bytes
+MAX_FUSED_LENGTH = 5
+
+# Whether each jump is taken, by opcode and then flag value. IRET and
+# restore() can load any byte into the flag, so every byte has an entry.
+JUMP_TAKEN = {
+    JMP: [True] * 256,
+    JEQ: [bool(flag & FLAG_EQUAL) for flag in range(256)],
+    JNE: [not flag & FLAG_EQUAL for flag in range(256)],
+    JGT: [bool(flag & FLAG_GREATER) for flag in range(256)],
+    JLT: [bool(flag & FLAG_LESS) for flag in range(256)],
+    JGE: [bool(flag & (FLAG_GREATER | FLAG_EQUAL)) for flag in range(256)],
+    JLE: [bool(flag & (FLAG_LESS | FLAG_EQUAL)) for flag in range(256)],
+}
+
+# How many instructions run between checks of the timer, the keyboard and
+# pending interrupts. INT, IRET and HLT force a check right away.
+POLL_INTERVAL = 1024
+
+# Python source the block translator inlines for each instruction, with the
+# registers held in the locals r0-r7 and the flag in fl. {leave} writes the
+# locals back to the CPU and must come right before every return. A jump
+# back to the block's own {entry} loops inside the generated function, at
+# most POLL_INTERVAL times before it returns so interrupts get checked.
+BLOCK_TEMPLATES = {
+    LDI: "r{a} = {b}",
+    PRN: "write(PRN_TEXT[r{a}])",
+    ADD: "r{a} = (r{a} + r{b}) & 0xff",
+    SUB: "r{a} = (r{a} - r{b}) & 0xff",
+    MUL: "r{a} = (r{a} * r{b}) & 0xff",
+    CMP: "fl = 4 if r{a} < r{b} else 2 if r{a} > r{b} else 1",
+    AND: "r{a} &= r{b}",
+    OR: "r{a} |= r{b}",
+    XOR: "r{a} ^= r{b}",
+    NOT: "r{a} ^= 0xff",
+    SHL: "r{a} = (r{a} << r{b}) & 0xff if r{b} < 8 else 0",
+    SHR: "r{a} >>= r{b}",
+    INC: "r{a} = (r{a} + 1) & 0xff",
+    DEC: "r{a} = (r{a} - 1) & 0xff",
+    DIV: "if r{b} == 0:\n"
+         "    {leave}cpu.program_counter = {pc}; cpu.divide_by_zero()\n"
+         "r{a} //= r{b}",
+    MOD: "if r{b} == 0:\n"
+         "    {leave}cpu.program_counter = {pc}; cpu.divide_by_zero()\n"
+         "r{a} %= r{b}",
+    NOP: "pass",
+    LD: "r{a} = ram[r{b}]",
+    ST: "ram[r{a}] = r{b}\n"
+        "if code_map[r{a}]:\n"
+        "    invalidate(r{a})\n"
+        "    {leave}return {next}",
+    PRA: "write(PRA_TEXT[r{a}])",
+    PUSH: "r7 = (r7 - 1) & 0xff\n"
+          "ram[r7] = r{a}\n"
+          "if code_map[r7]:\n"
+          "    invalidate(r7)\n"
+          "    {leave}return {next}",
+    POP: "r{a} = ram[r7]\n"
+         "r7 = (r7 + 1) & 0xff",
+    # the instructions below end a block
+    HLT: "cpu.running = False\n"
+         "cpu.poll_now = True\n"
+         "cpu.output.flush()\n"
+         "{leave}return {next}",
+    JMP: "target = r{a}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JEQ: "target = r{a} if fl & 1 else {next}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JNE: "target = {next} if fl & 1 else r{a}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JGT: "target = r{a} if fl & 2 else {next}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JLT: "target = r{a} if fl & 4 else {next}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JGE: "target = r{a} if fl & 3 else {next}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    JLE: "target = r{a} if fl & 5 else {next}\n"
+         "if target != {entry}:\n"
+         "    {leave}return target",
+    CALL: "r7 = (r7 - 1) & 0xff\n"
+          "ram[r7] = {next} & 0xff\n"
+          "if code_map[r7]:\n"
+          "    invalidate(r7)\n"
+          "{leave}return r{a}",
+    RET: "target = ram[r7]\n"
+         "r7 = (r7 + 1) & 0xff\n"
+         "{leave}return target",
+}
+
+BLOCK_ENDS = {HLT, JMP, JEQ, JNE, JGT, JLT, JGE, JLE, CALL, RET}
+
+# Instructions that only change registers, the flag and the PC. A loop of
+# them that comes back around to the same state does nothing but wait for
+# an interrupt. LD only counts away from KEY_PRESSED, which poll() writes
+# even while the keyboard interrupt is masked.
+SPIN_SAFE = bytearray(256)
+
+for opcode in (NOP, LDI, LD, CMP, JMP, JEQ, JNE, JGT, JLT, JGE, JLE, ADD, SUB,
+               MUL, AND, OR, XOR, NOT, SHL, SHR, INC, DEC):
+    SPIN_SAFE[opcode] = 1
+
+# Subroutine memoization: how many results to keep, how many calls a
+# subroutine gets before a poor hit rate turns memoization off for it, and
+# the most instructions a call can run while it's being checked, which is
+# also the most one run() batch spends checking calls
+MEMO_CACHE_SIZE = 4096
+MEMO_TRIAL_CALLS = 64
+MEMO_MIN_HIT_RATE = 0.25
+MEMO_MAX_STEPS = POLL_INTERVAL
+
+# Instructions a memoized subroutine may run. On their own they only read
+# and write registers, the flag and the stack; the memo checks the stack
+# and LD addresses as they run.
+MEMO_SAFE = bytearray(256)
+
+for opcode in (NOP, LDI, LD, CMP, JMP, JEQ, JNE, JGT, JLT, JGE, JLE, ADD, SUB,
+               MUL, DIV, MOD, AND, OR, XOR, NOT, SHL, SHR, INC, DEC, PUSH, POP,
+               CALL, RET):
+    MEMO_SAFE[opcode] = 1
+
+# Instructions that write their first operand register
+WRITES_REGISTER_A = {LDI, LD, POP, ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, NOT,
+                     SHL, SHR, INC, DEC}
+
+# What memoized instructions read: their first operand register, their
+# second, or the flag (as bit MEMO_FLAG of an input mask)
+MEMO_FLAG = 1 << 8
+MEMO_READS_A = bytearray(256)
+MEMO_READS_FLAG = [0] * 256
+
+for opcode in (ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, NOT, SHL, SHR, INC, DEC,
+               CMP, PUSH, CALL, JMP, JEQ, JNE, JGT, JLT, JGE, JLE):
+    MEMO_READS_A[opcode] = 1
+
+for opcode in (JEQ, JNE, JGT, JLT, JGE, JLE):
+    MEMO_READS_FLAG[opcode] = MEMO_FLAG
+
+MEMO_READS_B = {ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, SHL, SHR, CMP, LD}
+
+BLOCK_LEAVE = "reg[:] = r0, r1, r2, r3, r4, r5, r6, r7; cpu.flag = fl; "
+
+# What PRN and PRA write for each register value
+PRN_TEXT = [b"%d\n" % value for value in range(256)]
+PRA_TEXT = [bytes((value,)) for value in range(256)]
+
+# Bytes the buffered output holds before it writes them out, and the most
+# seconds it holds them for
+OUTPUT_BUFFER_SIZE = 8192
+OUTPUT_FLUSH_INTERVAL = 0.05
+
+# Binary image (.ls8b) header, see asm/asm.py for the full layout
+IMAGE_MAGIC = b"LS8B"
+IMAGE_VERSION = 2
+IMAGE_HEADER = struct.Struct("<4sBBBHHI")
+
+# Layout of a snapshot(): RAM, then R0-R7, then the PC, flag, running and
+# interrupts enabled bytes
+STATE_RAM = 0
+STATE_REGISTERS = 256
+STATE_PC = 264
+STATE_FLAG = 265
+STATE_RUNNING = 266
+STATE_INTERRUPTS = 267
+STATE_SIZE = 268
+
+# Checkpoint file header, followed by a snapshot()
+CHECKPOINT_MAGIC = b"LS8C"
+CHECKPOINT_VERSION = 1
+
+
+class CPUError(Exception):
+    """Base class for errors from the emulator."""
+
+
+class LoadError(CPUError):
+    """A program or checkpoint could not be loaded."""
+
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        # exit status for the command line
+        self.code = code
+
+
+class Fault(CPUError):
+    """The running program did something the CPU can't do."""
+
+    code = FAULT_NONE
+
+    def __init__(self, pc, message):
+        super().__init__(message)
+        self.pc = pc
+
+
+class UnknownInstruction(Fault):
+    code = FAULT_UNKNOWN_INSTRUCTION
+
+
+class DivideByZero(Fault):
+    code = FAULT_DIVIDE_BY_ZERO
+
+
+class InvalidRegister(Fault):
+    code = FAULT_INVALID_REGISTER
+
+
+class RunResult:
+    """
+    How a call to run() ended: status is HALTED, BUDGET_EXHAUSTED,
+    BREAKPOINT, FAULTED or IDLE, steps is the number of instructions it ran, pc
+    is where it stopped and fault is the Fault if there was one.
+    """
+
+    def __init__(self, status, steps, pc, fault=None):
+        self.status = status
+        self.steps = steps
+        self.pc = pc
+        self.fault = fault
+
+    def __repr__(self):
+        fault = "" if self.fault is None else f", fault={self.fault!r}"
+        return (f"RunResult({self.status!r}, steps={self.steps}, "
+                f"pc={self.pc}{fault})")
+
+
+class BufferedOutput:
+    """
+    Output sink that collects PRN/PRA output in a buffer and writes it to a
+    stream when the buffer fills, when the CPU halts or every
+    flush_interval seconds. The stream defaults to whatever sys.stdout is
+    at the time of the write.
+    """
+
+    def __init__(self, stream=None, size=OUTPUT_BUFFER_SIZE,
+                 flush_interval=OUTPUT_FLUSH_INTERVAL):
+        self.stream = stream
+        self.size = size
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.last_flush = time.monotonic()
+
+    def write(self, data):
+        self.buffer += data
+
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def tick(self, now):
+        """Flush if the output has been held for long enough."""
+
+        if self.buffer and now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+
+        if not self.buffer:
+            return
+
+        stream = self.stream if self.stream is not None else sys.stdout
+
+        # keep the output in order with anything print()ed before it
+        stream.flush()
+
+        if hasattr(stream, "buffer"):
+            stream.buffer.write(self.buffer)
+            stream.buffer.flush()
+        elif isinstance(stream, io.TextIOBase):
+            stream.write(self.buffer.decode("latin-1"))
+            stream.flush()
+        else:
+            stream.write(self.buffer)
+            stream.flush()
+
+        self.buffer.clear()
+
+
+class CaptureOutput:
+    """Output sink that keeps all PRN/PRA output in memory."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+
+    def tick(self, now):
+        pass
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        """Get the output as bytes."""
+
+        return bytes(self.buffer)
+
+    def text(self):
+        """Get the output as text."""
+
+        return self.buffer.decode("latin-1")
+
+
+class SubroutineMemo:
+    """
+    Results of pure subroutines, for CPU.enable_memoization().
+
+    On a miss the subroutine runs to its RET under watch. It's only cached
+    if it touched nothing but registers, the flag and its own stack frame,
+    and read no stack byte it didn't write. The key is the subroutine
+    address and the values of what it read before writing: those
+    registers, the flag if it was read, and always R7, which fixes where
+    the stack frame is. The result is the registers and flag it wrote and
+    the final values of the stack bytes it wrote. A later call that agrees
+    on the key would have taken the same path, so a hit leaves the machine
+    exactly as running it would have. Interrupts aren't serviced during a
+    watched call, only after it.
+    """
+
+    def __init__(self, size=MEMO_CACHE_SIZE):
+        self.size = size
+        # (address, input mask, input values) -> (written registers as
+        # (register, value) pairs, flag or None, stack writes as (address,
+        # value) pairs, instructions), least recently used first
+        self.results = OrderedDict()
+        # address -> input masks seen, as (mask, registers, reads flag)
+        self.inputs = {}
+        # address -> [calls, hits]
+        self.subroutines = {}
+        # address -> why it isn't memoized
+        self.skipped = {}
+        # address -> addresses of the code it ran, to drop its results
+        # when the code changes
+        self.code = {}
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+
+    def call(self, cpu, address):
+        """Handle cpu having just called the subroutine at address."""
+
+        self.calls += 1
+
+        if address in self.skipped:
+            return
+
+        register = cpu.register
+        counts = self.subroutines.setdefault(address, [0, 0])
+        counts[0] += 1
+
+        for mask, registers, reads_flag in self.inputs.get(address, ()):
+            values = bytes(register[r] for r in registers)
+            if reads_flag:
+                values += bytes((cpu.flag,))
+
+            key = (address, mask, values)
+            result = self.results.get(key)
+
+            if result is not None:
+                self.results.move_to_end(key)
+                counts[1] += 1
+                self.hits += 1
+
+                outputs, flag, writes, steps = result
+                frame = register[7]
+
+                for write_address, value in writes:
+                    cpu.ram_write(write_address, value)
+
+                for r, value in outputs:
+                    register[r] = value
+
+                if flag is not None:
+                    cpu.flag = flag
+
+                # pop the return address
+                register[7] = (frame + 1) & 0xff
+                cpu.program_counter = cpu.ram[frame]
+                self.saved += steps
+                return
+
+        if (counts[0] > MEMO_TRIAL_CALLS
+                and counts[1] < counts[0] * MEMO_MIN_HIT_RATE):
+            self.skipped[address] = "low hit rate"
+            return
+
+        self.misses += 1
+
+        # a call that couldn't be checked doesn't count towards the trial
+        if not self.watch(cpu, address):
+            counts[0] -= 1
+
+    def watch(self, cpu, address):
+        """
+        Run the subroutine cpu just called up to its RET, and cache the
+        result if it's pure. Anything impure stops the watch right before
+        it, leaving the rest of the call to the caller's loop. So does
+        running out of cpu.watch_budget, a breakpoint or a poll, but then
+        it returns False without giving up on the subroutine.
+        """
+
+        ram = cpu.ram
+        register = cpu.register
+        decoded = cpu.decoded
+        entry_registers = bytes(register)
+        entry_flag = cpu.flag
+        # the return address is at the top of the stack frame
+        frame = register[7]
+        # registers (and MEMO_FLAG) read before they're written, and written
+        inputs = 1 << 7
+        outputs = 0
+        written = set()
+        code = set()
+        depth = 0
+        steps = 0
+        limit = min(MEMO_MAX_STEPS, cpu.watch_budget)
+
+        while steps < limit:
+            pc = cpu.program_counter
+            opcode = ram[pc]
+
+            if pc in cpu.breakpoints or cpu.poll_now:
+                return False
+
+            if not MEMO_SAFE[opcode]:
+                self.skipped[address] = f"runs {opcode:08b} at {pc:02X}"
+                return True
+
+            entry = decoded[pc]
+            if entry is None:
+                entry = cpu.decode(pc)
+
+            handler, operand_a, operand_b, next_pc = entry
+
+            # let invalid registers fault as usual
+            if handler is not cpu.handle_invalid_register:
+                sp = register[7]
+                impure = None
+
+                if opcode in WRITES_REGISTER_A and operand_a == 7:
+                    impure = "moves the stack pointer"
+
+                elif opcode == PUSH or opcode == CALL:
+                    top = (sp - 1) & 0xff
+                    if top >= frame or cpu.code_map[top]:
+                        impure = "writes outside its stack frame"
+                    written.add(top)
+
+                elif opcode == RET and depth == 0:
+                    if sp != frame:
+                        impure = "returns without its return address"
+
+                elif opcode == POP or opcode == RET:
+                    if sp not in written:
+                        impure = "reads the stack outside its frame"
+
+                elif opcode == LD and register[operand_b] not in written:
+                    impure = "reads memory"
+
+                if impure is not None:
+                    self.skipped[address] = impure
+                    return True
+
+                reads = MEMO_READS_FLAG[opcode]
+                if MEMO_READS_A[opcode]:
+                    reads |= 1 << operand_a
+                if opcode in MEMO_READS_B:
+                    reads |= 1 << operand_b
+
+                inputs |= reads & ~outputs
+
+                if opcode in WRITES_REGISTER_A:
+                    outputs |= 1 << operand_a
+                elif opcode == CMP:
+                    outputs |= MEMO_FLAG
+
+            for offset in range((opcode >> 6) + 1):
+                code.add((pc + offset) & 0xff)
+
+            # counted first: if it faults, run() leaves out one instruction
+            steps += 1
+            cpu.fused_steps += 1
+            cpu.watch_budget -= 1
+
+            # a CALL inside the subroutine is watched as part of it
+            if opcode == CALL:
+                cpu.handle_call(operand_a, operand_b)
+                depth += 1
+            else:
+                handler(operand_a, operand_b)
+                if next_pc is not None:
+                    cpu.program_counter = next_pc
+
+            if opcode == RET:
+                if depth == 0:
+                    break
+
+                depth -= 1
+
+        else:
+            if limit < MEMO_MAX_STEPS:
+                return False
+
+            self.skipped[address] = "too long"
+            return True
+
+        registers = tuple(r for r in range(8) if inputs >> r & 1)
+        reads_flag = bool(inputs & MEMO_FLAG)
+        values = bytes(entry_registers[r] for r in registers)
+        if reads_flag:
+            values += bytes((entry_flag,))
+
+        masks = self.inputs.setdefault(address, [])
+        if (inputs, registers, reads_flag) not in masks:
+            masks.append((inputs, registers, reads_flag))
+
+        self.results[(address, inputs, values)] = (
+            tuple((r, register[r]) for r in range(7) if outputs >> r & 1),
+            cpu.flag if outputs & MEMO_FLAG else None,
+            tuple((write_address, ram[write_address])
+                  for write_address in sorted(written)),
+            steps)
+        self.code.setdefault(address, set()).update(code)
+
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+        return True
+
+    def invalidate(self, address):
+        """Drop the results of every subroutine whose code is at address."""
+
+        stale = {subroutine for subroutine, code in self.code.items()
+                 if address in code}
+
+        if stale:
+            for key in [key for key in self.results if key[0] in stale]:
+                del self.results[key]
+
+            for subroutine in stale:
+                del self.code[subroutine]
+                del self.inputs[subroutine]
+
+    def clear(self):
+        self.results.clear()
+        self.inputs.clear()
+        self.code.clear()
+        self.subroutines.clear()
+        self.skipped.clear()
+
+    def report(self):
+        """Summarize the cache statistics in a line."""
+
+        calls = self.calls
+        rate = 100 * self.hits / calls if calls else 0.0
+        pure = len([address for address in self.code
+                    if address not in self.skipped])
+
+        return (f"memo: {calls} calls, {self.hits} hits ({rate:.1f}%), "
+                f"{self.saved} instructions saved, {pure} pure "
+                f"subroutines, {len(self.skipped)} not memoized, "
+                f"{len(self.results)} results cached")
 
 
 class CPU:
@@ -30,35 +697,93 @@ class CPU:
 
     def __init__(self):
         """Construct a new CPU."""
-        self.ram = [0] * 256
-        self.register = [0] * 8
+        # memory and registers are bytes, so every value stored in them has
+        # to be in the 8-bit range 0-255
+        self.ram = bytearray(256)
+        self.register = bytearray(8)
         self.program_counter = 0
         self.stack_pointer = 7
         self.flag = 0b00000000
         self.register[self.stack_pointer] = 0xf4
         self.running = False
-        self.dispatch_table = {}
+        # where PRN and PRA output goes
+        self.output = BufferedOutput()
+        # interrupts are checked every poll_interval instructions, or after
+        # the current instruction when poll_now is set
+        self.poll_interval = POLL_INTERVAL
+        self.poll_now = False
+        # instructions SubroutineMemo.watch() may still run in this batch
+        self.watch_budget = 0
+        self.interrupts_enabled = True
+        self.next_timer = None
+        # what run() does with a program spinning until an interrupt:
+        # IDLE_SLEEP, IDLE_RETURN or None to let it spin
+        self.idle_policy = IDLE_SLEEP
+        # seconds spent asleep instead of spinning
+        self.idle_time = 0.0
+        # whether run() last returned IDLE
+        self.idle = False
+        # registers and flag at the last poll, to spot a spin loop
+        self.poll_state = None
+        # selector watching the keyboard input stream, if there is one
+        self.keyboard = None
+        # key presses from feed_keys() that haven't been raised yet
+        self.pending_keys = bytearray()
+        # run() stops before the instruction at any of these addresses
+        self.breakpoints = set()
+        self.hit_breakpoint = False
+        # the breakpoint run() last stopped at, which it steps over when
+        # it carries on from there
+        self.break_pc = None
+        # labels from a binary image's symbol table, name -> address
+        self.symbols = {}
+        # decoded instruction cache: one (handler, operand_a, operand_b,
+        # next_pc) entry per address, filled in the first time it runs
+        self.decoded = [None] * 256
+        # the same for run(), with common pairs of instructions fused into
+        # one entry
+        self.fused = [None] * 256
+        # instructions run by fused entries beyond the first of each pair,
+        # and by memoized calls beyond the CALL
+        self.fused_steps = 0
+        # SubroutineMemo while memoization is on
+        self.memo = None
+        # nonzero for every address covered by a cached instruction
+        self.code_map = bytearray(256)
+        # translated basic blocks for run_blocks(), keyed by entry address
+        self.blocks = {}
+        self.block_ends = {}
+        # handlers by opcode, anything not filled in is an unknown instruction
+        self.dispatch_table = [self.handle_unknown] * 256
+        self.dispatch_table[NOP] = self.handle_nop
         self.dispatch_table[HLT] = self.handle_hlt
         self.dispatch_table[LDI] = self.handle_ldi
+        self.dispatch_table[LD] = self.handle_ld
+        self.dispatch_table[ST] = self.handle_st
         self.dispatch_table[PRN] = self.handle_prn
-        self.dispatch_table[ADD] = self.handle_add
-        self.dispatch_table[SUB] = self.handle_sub
-        self.dispatch_table[MUL] = self.handle_mul
+        self.dispatch_table[PRA] = self.handle_pra
         self.dispatch_table[CMP] = self.handle_cmp
+        self.dispatch_table[DIV] = self.handle_div
+        self.dispatch_table[MOD] = self.handle_mod
         self.dispatch_table[PUSH] = self.handle_push
         self.dispatch_table[POP] = self.handle_pop
         self.dispatch_table[CALL] = self.handle_call
         self.dispatch_table[RET] = self.handle_ret
+        self.dispatch_table[INT] = self.handle_int
+        self.dispatch_table[IRET] = self.handle_iret
         self.dispatch_table[JMP] = self.handle_jmp
         self.dispatch_table[JEQ] = self.handle_jeq
         self.dispatch_table[JNE] = self.handle_jne
-        self.dispatch_table[AND] = self.handle_and
-        self.dispatch_table[OR] = self.handle_or
-        self.dispatch_table[XOR] = self.handle_xor
-        self.dispatch_table[NOT] = self.handle_not
-        self.dispatch_table[SHL] = self.handle_shl
-        self.dispatch_table[SHR] = self.handle_shr
-        self.dispatch_table[MOD] = self.handle_mod
+        self.dispatch_table[JGT] = self.handle_jgt
+        self.dispatch_table[JLT] = self.handle_jlt
+        self.dispatch_table[JGE] = self.handle_jge
+        self.dispatch_table[JLE] = self.handle_jle
+
+        for opcode, operation in ALU_OPERATIONS.items():
+            self.dispatch_table[opcode] = self.alu_handler(operation)
+
+        for opcode, table in ALU_TABLES.items():
+            self.dispatch_table[opcode] = self.alu_table_handler(table)
 
     def ram_read(self, memory_address_register):
         memory_data_register = self.ram[memory_address_register]
@@ -67,83 +792,645 @@ class CPU:
     def ram_write(self, memory_address_register, memory_data_register):
         self.ram[memory_address_register] = memory_data_register
 
-    def load(self):
-        """Load a program into memory."""
+        # writing over cached code means it has to be decoded again
+        if self.code_map[memory_address_register]:
+            self.invalidate(memory_address_register)
 
-        address = 0
+    def decode(self, address):
+        """Decode the instruction at address and cache it."""
 
-        if len(sys.argv) != 2:
-            print("Usage: compy.py <program_name>")
-            sys.exit(1)
+        # a breakpoint decodes as an instruction that stops run()
+        if address in self.breakpoints:
+            entry = (self.handle_breakpoint, 0, 0, None)
+            self.decoded[address] = entry
+            self.code_map[address] = 1
+            return entry
 
-        try:
-            with open(sys.argv[1]) as f:
-                for line in f:
-                    line = line.strip()
+        entry = self.decode_instruction(address)
+        self.decoded[address] = entry
 
-                    if line == "" or line[0] == "#":
-                        continue
+        for offset in range((self.ram[address] >> 6) + 1):
+            self.code_map[(address + offset) & 0xff] = 1
 
-                    try:
-                        string_value = line.split("#")[0]
-                        value = int(string_value, 2)
+        return entry
 
-                    except ValueError:
-                        print(f"Invalid number: {string_value}")
-                        sys.exit(1)
+    def decode_instruction(self, address):
+        """
+        Decode the instruction at address into a (handler, operand_a,
+        operand_b, next_pc) entry without caching it.
+        """
 
-                    self.ram[address] = value
-                    address += 1
+        instruction_register = self.ram[address]
+        operand_a = self.ram[(address + 1) & 0xff]
+        operand_b = self.ram[(address + 2) & 0xff]
 
-        except FileNotFoundError:
-            print(f"File not found: {sys.argv[1]}")
-            sys.exit(2)
+        handler = self.dispatch_table[instruction_register]
 
-    def alu(self, op, reg_a, reg_b):
-        """ALU operations."""
+        operand_count = instruction_register >> 6
+        instruction_length = operand_count + 1
+
+        # the first operand is always a register, and so is the second
+        # except for LDI's immediate value
+        if handler != self.handle_unknown and (
+                (operand_count > 0 and operand_a > 7)
+                or (operand_count > 1 and instruction_register != LDI
+                    and operand_b > 7)):
+            handler = self.handle_invalid_register
+
+        # instructions that set the PC themselves don't get a next_pc
+        if instruction_register & 0b00010000:
+            next_pc = None
+        else:
+            next_pc = (address + instruction_length) & 0xff
+
+        return (handler, operand_a, operand_b, next_pc)
+
+    def fuse(self, address):
+        """
+        Decode the instruction at address for run(), fused with the next
+        one into a single handler if the two are one of the common pairs:
+        LDI Rx followed by a jump or CALL to Rx, CMP followed by a jump,
+        PUSH followed by CALL, and PUSH/PUSH or POP/POP. Anything else gets
+        the plain decode() entry. Fused handlers set the PC themselves.
+        """
 
-        if op == "ADD":
-            self.register[reg_a] += self.register[reg_b]
-        elif op == "SUB":
-            self.register[reg_a] -= self.register[reg_b]
-        elif op == "MUL":
-            self.register[reg_a] *= self.register[reg_b]
-        elif op == "CMP":
-            if self.register[reg_a] < self.register[reg_b]:
-                self.flag = 0b00000100
-            elif self.register[reg_a] > self.register[reg_b]:
-                self.flag = 0b00000010
+        entry = self.decoded[address]
+        if entry is None:
+            entry = self.decode(address)
+
+        first = self.ram[address]
+        second_address = address + (first >> 6) + 1
+        handler = None
+
+        # both halves have to be valid and there can't be a breakpoint
+        # between them; every second half is 2 bytes long
+        if (entry[0] is self.dispatch_table[first]
+                and second_address + 2 <= 256
+                and second_address not in self.breakpoints
+                and self.ram[second_address + 1] <= 7):
+            second = self.ram[second_address]
+            a, b = entry[1], entry[2]
+            c = self.ram[second_address + 1]
+
+            if first == LDI and second in JUMP_TAKEN and c == a:
+                handler = self.fuse_ldi_jump(address, a, b, JUMP_TAKEN[second])
+            elif (first == LDI and second == CALL and c == a
+                  and self.memo is None):
+                handler = self.fuse_ldi_call(address, a, b)
+            elif first == CMP and second in JUMP_TAKEN:
+                handler = self.fuse_cmp_jump(address, a, b, c,
+                                             JUMP_TAKEN[second])
+            elif first == PUSH and (second == PUSH or
+                                    second == CALL and self.memo is None):
+                handler = self.fuse_push(address, a, c, second == CALL)
+            elif first == POP and second == POP:
+                handler = self.fuse_pop_pop(address, a, c)
+
+        if handler is None:
+            self.fused[address] = entry
+            return entry
+
+        entry = (handler, 0, 0, None)
+        self.fused[address] = entry
+
+        for covered in range(address, second_address + 2):
+            self.code_map[covered] = 1
+
+        return entry
+
+    def fuse_ldi_jump(self, address, a, value, taken):
+        """LDI Ra,value then JMP/Jcc Ra."""
+
+        register = self.register
+        fall_through = (address + 5) & 0xff
+
+        def handle(_a, _b):
+            register[a] = value
+            self.program_counter = (value if taken[self.flag]
+                                    else fall_through)
+            self.fused_steps += 1
+
+        return handle
+
+    def fuse_ldi_call(self, address, a, value):
+        """LDI Ra,value then CALL Ra."""
+
+        register = self.register
+        return_address = address + 5
+
+        def handle(_a, _b):
+            register[a] = value
+            self.push_value(return_address)
+            # read after the push, in case Ra is the SP
+            self.program_counter = register[a]
+            self.fused_steps += 1
+
+        return handle
+
+    def fuse_cmp_jump(self, address, a, b, c, taken):
+        """CMP Ra,Rb then JMP/Jcc Rc."""
+
+        register = self.register
+        fall_through = (address + 5) & 0xff
+
+        def handle(_a, _b):
+            value_a = register[a]
+            value_b = register[b]
+            flag = (FLAG_LESS if value_a < value_b
+                    else FLAG_GREATER if value_a > value_b else FLAG_EQUAL)
+            self.flag = flag
+            self.program_counter = (register[c] if taken[flag]
+                                    else fall_through)
+            self.fused_steps += 1
+
+        return handle
+
+    def fuse_push(self, address, a, c, call):
+        """PUSH Ra then PUSH Rc, or CALL Rc if call."""
+
+        register = self.register
+        fused = self.fused
+        push = self.handle_push
+
+        def handle(_a, _b):
+            push(a, 0)
+
+            # the push wrote over this pair, so run the rest unfused
+            if fused[address] is None:
+                self.program_counter = address + 2
+                return
+
+            if call:
+                self.push_value(address + 4)
+                self.program_counter = register[c]
             else:
-                self.flag = 0b00000001
-        elif op == "AND":
-            self.register[reg_a] = self.register[reg_a] & self.register[reg_b]
-        elif op == "OR":
-            self.register[reg_a] = self.register[reg_a] | self.register[reg_b]
-        elif op == "XOR":
-            self.register[reg_a] = self.register[reg_a] ^ self.register[reg_b]
-        elif op == "NOT":
-            self.register[reg_a] = ~self.register[reg_a]
-        elif op == "SHL":
-            self.register[reg_a] = self.register[reg_a] << self.register[reg_b]
-        elif op == "SHR":
-            self.register[reg_a] = self.register[reg_a] >> self.register[reg_b]
-        elif op == "MOD":
-            if self.register[reg_b] == 0:
-                print("Can't divide by 0")
-                sys.exit(1)
+                push(c, 0)
+                self.program_counter = (address + 4) & 0xff
+
+            self.fused_steps += 1
+
+        return handle
+
+    def fuse_pop_pop(self, address, a, c):
+        """POP Ra then POP Rc."""
+
+        register = self.register
+        ram = self.ram
+        next_pc = (address + 4) & 0xff
+
+        def handle(_a, _b):
+            register[a] = ram[register[7]]
+            register[7] = (register[7] + 1) & 0xff
+            register[c] = ram[register[7]]
+            register[7] = (register[7] + 1) & 0xff
+            self.program_counter = next_pc
+            self.fused_steps += 1
+
+        return handle
+
+    def add_breakpoint(self, address):
+        """Make run() stop before running the instruction at address."""
+
+        self.breakpoints.add(address)
+        self.invalidate(address)
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.discard(address)
+        self.invalidate(address)
+
+    def invalidate(self, address):
+        """Drop every cached instruction that covers address."""
+
+        # an instruction is at most 3 bytes long, so only the entries
+        # starting at address - 2 through address can cover it
+        for start in range(address - 2, address + 1):
+            self.decoded[start & 0xff] = None
+
+        for start in range(address - MAX_FUSED_LENGTH + 1, address + 1):
+            self.fused[start & 0xff] = None
+
+        for start, end in list(self.block_ends.items()):
+            if start <= address < end:
+                del self.blocks[start]
+                del self.block_ends[start]
+
+        self.code_map[address] = 0
+
+        if self.memo is not None:
+            self.memo.invalidate(address)
+
+    def flush_decoded(self):
+        """Empty the decoded instruction and translated block caches."""
+
+        self.decoded[:] = [None] * 256
+        self.fused[:] = [None] * 256
+        self.code_map[:] = bytes(256)
+        self.blocks.clear()
+        self.block_ends.clear()
+
+        # writes to code that isn't cached any more can't be seen
+        if self.memo is not None:
+            self.memo.clear()
+
+    def enable_memoization(self, size=MEMO_CACHE_SIZE):
+        """
+        Skip calls to pure subroutines that were already made with the same
+        registers and flag, replaying their results from a SubroutineMemo
+        of size entries instead. RunResult steps only count the
+        instructions that actually run; memo.saved counts the rest.
+        """
+
+        self.memo = SubroutineMemo(size)
+        self.dispatch_table[CALL] = self.handle_memo_call
+        self.flush_decoded()
+
+    def disable_memoization(self):
+        self.memo = None
+        self.dispatch_table[CALL] = self.handle_call
+        self.flush_decoded()
+
+    def prelink(self, targets):
+        """
+        Decode the jumps and calls in targets, a dict of address -> the
+        address their register always holds there (from the assembler's
+        analyze.py), into entries that go straight to the target without
+        reading the register. Writing over them drops them like any other
+        decoded entry. Call after loading the program.
+        """
+
+        for address, target in targets.items():
+            opcode = self.ram[address]
+
+            if (address in self.breakpoints
+                    or self.ram[(address + 1) & 0xff] > 7):
+                continue
+
+            if opcode in JUMP_TAKEN:
+                handler = self.prelink_jump(address, target,
+                                            JUMP_TAKEN[opcode])
+            elif opcode == CALL and self.memo is None:
+                handler = self.prelink_call(address, target)
             else:
-                self.register[reg_a] = self.register[reg_a] // self.register[reg_b]
+                continue
+
+            self.decoded[address] = (handler, 0, 0, None)
+            self.fused[address] = None
+            self.code_map[address] = self.code_map[(address + 1) & 0xff] = 1
+
+    def prelink_jump(self, address, target, taken):
+        """JMP/Jcc to a known target."""
+
+        fall_through = (address + 2) & 0xff
+
+        def handle(_a, _b):
+            self.program_counter = target if taken[self.flag] else fall_through
+
+        return handle
+
+    def prelink_call(self, address, target):
+        """CALL to a known target."""
+
+        return_address = address + 2
+
+        def handle(_a, _b):
+            self.push_value(return_address)
+            self.program_counter = target
+
+        return handle
+
+    def set_output(self, output):
+        """
+        Send PRN/PRA output to a sink with write(data), flush() and
+        tick(now) methods, like BufferedOutput or CaptureOutput.
+        """
+
+        self.output.flush()
+        self.output = output
+
+        # translated blocks hold on to the old sink's write
+        self.blocks.clear()
+        self.block_ends.clear()
+
+    def ram_view(self):
+        """
+        Get a read-only memoryview of RAM, so tools can look at it through
+        the buffer protocol without copying it.
+        """
+
+        return memoryview(self.ram).toreadonly()
+
+    def snapshot(self):
+        """Get the whole machine state as STATE_SIZE bytes."""
+
+        state = bytearray(STATE_SIZE)
+        state[STATE_RAM:STATE_REGISTERS] = self.ram
+        state[STATE_REGISTERS:STATE_PC] = self.register
+        state[STATE_PC] = self.program_counter
+        state[STATE_FLAG] = self.flag
+        state[STATE_RUNNING] = self.running
+        state[STATE_INTERRUPTS] = self.interrupts_enabled
+
+        return bytes(state)
+
+    def restore(self, state):
+        """
+        Put the machine back in a state from snapshot(). RAM and registers
+        are updated in place, so views of them stay valid.
+        """
+
+        state = memoryview(state)
+        ram = state[STATE_RAM:STATE_REGISTERS]
+
+        # only cached code whose bytes actually change has to go
+        if self.ram != ram:
+            code_map = self.code_map
+
+            if any(code_map):
+                for address in range(256):
+                    if code_map[address] and self.ram[address] != ram[address]:
+                        self.invalidate(address)
+
+            self.ram[:] = ram
+
+        self.register[:] = state[STATE_REGISTERS:STATE_PC]
+        self.program_counter = state[STATE_PC]
+        self.flag = state[STATE_FLAG]
+        self.running = bool(state[STATE_RUNNING])
+        self.interrupts_enabled = bool(state[STATE_INTERRUPTS])
+
+    def clone(self):
+        """
+        Make a new CPU in the same state as this one, for running ahead
+        from here without touching this machine. The keyboard is not shared.
+        """
+
+        cpu = CPU()
+        cpu.restore(self.snapshot())
+        cpu.poll_interval = self.poll_interval
+        cpu.next_timer = self.next_timer
+        cpu.symbols = self.symbols
+
+        return cpu
+
+    def save_checkpoint(self, filename):
+        """Write the machine state to filename, replacing it atomically."""
+
+        # output printed before the checkpoint must not be lost if the
+        # program is resumed from it
+        self.output.flush()
+
+        temporary = f"{filename}.tmp"
+
+        with open(temporary, "wb") as f:
+            f.write(CHECKPOINT_MAGIC)
+            f.write(bytes((CHECKPOINT_VERSION,)))
+            f.write(self.snapshot())
+
+        os.replace(temporary, filename)
+
+    def load_checkpoint(self, filename):
+        """Restore the machine state saved in filename."""
+
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        header_size = len(CHECKPOINT_MAGIC) + 1
+
+        if (data[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC
+                or data[len(CHECKPOINT_MAGIC)] != CHECKPOINT_VERSION
+                or len(data) != header_size + STATE_SIZE):
+            raise LoadError(f"Invalid checkpoint: {filename}")
+
+        self.restore(memoryview(data)[header_size:])
+
+    def translate(self, address):
+        """
+        Translate the basic block starting at address into a Python function
+        that runs it and returns the address of the next block.
+        """
+
+        lines = []
+        pc = address
+        ends_block = False
+
+        while pc < 256 and not ends_block:
+            # a breakpoint is always the start of a block
+            if pc in self.breakpoints:
+                break
+
+            instruction_register = self.ram[pc]
+            operand_count = instruction_register >> 6
+            template = BLOCK_TEMPLATES.get(instruction_register)
+
+            # stop at anything the translator can't inline and let the
+            # interpreter run it, including calls to be memoized
+            if (template is None or pc + operand_count >= 256 or
+                    instruction_register == CALL and self.memo is not None):
+                break
+
+            operand_a = self.ram[pc + 1] if operand_count > 0 else 0
+            operand_b = self.ram[pc + 2] if operand_count > 1 else 0
+
+            if operand_a > 7 or (operand_b > 7 and instruction_register != LDI):
+                break
+
+            next_pc = pc + operand_count + 1
+            # the PC wraps around to 0 past the last byte, as in decode()
+            lines.append(template.format(
+                a=operand_a, b=operand_b, pc=pc, next=next_pc & 0xff,
+                entry=address, leave=BLOCK_LEAVE))
+            pc = next_pc
+            ends_block = instruction_register in BLOCK_ENDS
+
+        if not lines:
+            # nothing to translate, so the block is a single interpreted step
+            self.blocks[address] = self.step
+            self.block_ends[address] = address + 1
+            self.code_map[address] = 1
+            return self.step
+
+        if not ends_block:
+            lines.append(f"{BLOCK_LEAVE}return {pc & 0xff}")
+
+        body = "\n".join(lines).replace("\n", "\n            ")
+        source = (
+            "def make_block(cpu, reg, ram, code_map, invalidate, write):\n"
+            "    def block():\n"
+            "        r0, r1, r2, r3, r4, r5, r6, r7 = reg\n"
+            "        fl = cpu.flag\n"
+            f"        for _ in range({self.poll_interval}):\n"
+            f"            {body}\n"
+            f"        {BLOCK_LEAVE}return {address}\n"
+            "    return block\n"
+        )
+
+        namespace = {"PRN_TEXT": PRN_TEXT, "PRA_TEXT": PRA_TEXT}
+        exec(compile(source, f"<block {address:02X}>", "exec"), namespace)
+        block = namespace["make_block"](
+            self, self.register, self.ram, self.code_map, self.invalidate,
+            self.output.write)
+
+        self.blocks[address] = block
+        self.block_ends[address] = pc
+
+        for covered in range(address, pc):
+            self.code_map[covered] = 1
+
+        return block
+
+    def load(self, program=None):
+        """
+        Load a program into memory. program is the name of a text .ls8 file
+        or a binary .ls8b image, or the bytes of an image. Without one, the
+        file named on the command line is loaded.
+        """
+
+        if program is None:
+            if len(sys.argv) != 2:
+                raise LoadError("Usage: ls8.py <program_name>")
+
+            program = sys.argv[1]
+
+        if isinstance(program, (bytes, bytearray, memoryview)):
+            self.load_image(io.BytesIO(program))
 
         else:
+            try:
+                with open(program, "rb") as f:
+                    if f.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC:
+                        f.seek(0)
+                        self.load_image(f)
+                    else:
+                        self.load_text(program)
+
+            except FileNotFoundError:
+                raise LoadError(f"File not found: {program}", 2)
+
+        self.flush_decoded()
+
+    def load_text(self, filename):
+        """Load a program from a text .ls8 file of binary numbers."""
+
+        address = 0
+
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+
+                if line == "" or line[0] == "#":
+                    continue
+
+                try:
+                    string_value = line.split("#")[0]
+                    value = int(string_value, 2)
+
+                except ValueError:
+                    raise LoadError(f"Invalid number: {string_value}")
+
+                self.ram[address] = value & 0xff
+                address += 1
+
+    def load_image(self, f):
+        """Load a program from a binary .ls8b image file object."""
+
+        header = bytearray(IMAGE_HEADER.size)
+
+        if f.readinto(header) != IMAGE_HEADER.size:
+            raise LoadError("Invalid image: header is too short")
+
+        (magic, version, entry, load_address, length, symbol_count,
+         checksum) = IMAGE_HEADER.unpack(header)
+
+        if magic != IMAGE_MAGIC or version != IMAGE_VERSION:
+            raise LoadError(
+                f"Invalid image: not an LS-8 v{IMAGE_VERSION} image")
+
+        if load_address + length > 256:
+            raise LoadError("Invalid image: code does not fit in memory")
+
+        # read the code straight into RAM
+        code = memoryview(self.ram)[load_address:load_address + length]
+
+        if f.readinto(code) != length:
+            raise LoadError("Invalid image: code is truncated")
+
+        # the checksum covers the code and then the symbol table
+        crc = zlib.crc32(code)
+        symbols = []
+
+        for _ in range(symbol_count):
+            entry_bytes = f.read(2)
+            if len(entry_bytes) != 2:
+                raise LoadError("Invalid image: symbol table is truncated")
+
+            address, name_length = entry_bytes
+            name = f.read(name_length)
+            if len(name) != name_length:
+                raise LoadError("Invalid image: symbol table is truncated")
+
+            crc = zlib.crc32(entry_bytes + name, crc)
+            symbols.append((name, address))
+
+        if crc != checksum:
+            raise LoadError("Invalid image: code or symbols are corrupt")
+
+        self.symbols = {name.decode(): address for name, address in symbols}
+        self.program_counter = entry
+
+    def load_code(self, code, symbols=None, entry=0):
+        """
+        Load machine code that's already assembled, such as from
+        programs.assemble(), at address 0.
+        """
+
+        if len(code) > 256:
+            raise LoadError("Program does not fit in memory")
+
+        self.ram[:len(code)] = code
+        self.symbols = dict(symbols or {})
+        self.program_counter = entry
+        self.flush_decoded()
+
+    def alu(self, op, reg_a, reg_b):
+        """ALU operations."""
+
+        if not op & 0b00100000:
             raise Exception("Unsupported ALU operation")
 
+        self.dispatch_table[op](reg_a, reg_b)
+
+    def alu_handler(self, operation):
+        """Make the handler for a two register ALU operation."""
+
+        register = self.register
+
+        def handle(a, b):
+            register[a] = operation(register[a], register[b])
+
+        return handle
+
+    def alu_table_handler(self, table):
+        """Make the handler for a one register ALU operation table."""
+
+        register = self.register
+
+        def handle(a, b):
+            register[a] = table[register[a]]
+
+        return handle
+
+    def divide_by_zero(self):
+        """Fault on DIV or MOD by 0."""
+
+        raise DivideByZero(self.program_counter, "Can't divide by 0")
+
     def trace(self):
         """
         Handy function to print out the CPU state. You might want to call this
         from run() if you need help debugging.
         """
 
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
+        print(f"TRACE: %02X | %02X %02X %02X %02X |" % (
             self.program_counter,
             self.flag,
             # self.ie,
@@ -157,9 +1444,32 @@ class CPU:
 
         print()
 
+    # Unknown instruction (fault)
+    def handle_unknown(self, a, b):
+        raise UnknownInstruction(
+            self.program_counter,
+            f"Unknown instruction: {self.ram[self.program_counter]} at address {self.program_counter}")
+
+    # Register operand above R7 (fault)
+    def handle_invalid_register(self, a, b):
+        raise InvalidRegister(
+            self.program_counter,
+            f"Invalid register in instruction {self.ram[self.program_counter]} at address {self.program_counter}")
+
+    # Breakpoint (stop run() without running the instruction here)
+    def handle_breakpoint(self, a, b):
+        self.hit_breakpoint = True
+        self.poll_now = True
+
+    # NOP (do nothing)
+    def handle_nop(self, a, b):
+        pass
+
     # HLT (halt the CPU and exit the emulator)
     def handle_hlt(self, a, b):
         self.running = False
+        self.poll_now = True
+        self.output.flush()
 
     # LDI (set the value of a register to an integer)
     def handle_ldi(self, a, b):
@@ -167,35 +1477,39 @@ class CPU:
 
     # PRN (print numeric value stored in the given register)
     def handle_prn(self, a, b):
-        print(self.register[a])
+        self.output.write(PRN_TEXT[self.register[a]])
 
-    # ADD (add the value in two registers and store the result in registerA)
-    def handle_add(self, a, b):
-        self.alu("ADD", a, b)
+    # CMP (compare the values in two registers)
+    def handle_cmp(self, a, b):
+        value_a = self.register[a]
+        value_b = self.register[b]
 
-    # SUB (subtract the value in the second register from the first, storing the result in registerA)
-    def handle_sub(self, a, b):
-        self.alu("SUB", a, b)
+        if value_a < value_b:
+            self.flag = FLAG_LESS
+        elif value_a > value_b:
+            self.flag = FLAG_GREATER
+        else:
+            self.flag = FLAG_EQUAL
 
-    # MUL (multiply the values in two registers together and store the result in registerA)
-    def handle_mul(self, a, b):
-        self.alu("MUL", a, b)
+    # DIV (divide the value in the first register by the value in the second, storing the result in registerA)
+    def handle_div(self, a, b):
+        if self.register[b] == 0:
+            self.divide_by_zero()
 
-    # CMP (compare the values in two registers)
-    def handle_cmp(self, a, b):
-        self.alu("CMP", a, b)
+        self.register[a] //= self.register[b]
 
     # PUSH (push the value in the given register on the stack)
     def handle_push(self, a, b):
         # decrement the stack pointer
-        self.register[self.stack_pointer] -= 1
+        self.register[self.stack_pointer] = (
+            self.register[self.stack_pointer] - 1) & 0xff
 
         # grab the value out of the given register
         value = self.register[a]
 
         # copy the value onto the stack
         top_of_the_stack_address = self.register[self.stack_pointer]
-        self.ram[top_of_the_stack_address] = value
+        self.ram_write(top_of_the_stack_address, value)
 
     # POP (pop the value at the top of the stack into the given register)
     def handle_pop(self, a, b):
@@ -207,7 +1521,8 @@ class CPU:
         self.register[a] = value
 
         # increment the stack pointer
-        self.register[self.stack_pointer] += 1
+        self.register[self.stack_pointer] = (
+            self.register[self.stack_pointer] + 1) & 0xff
 
     def handle_call(self, a, b):
         # get the address of the next instruction after the call
@@ -222,6 +1537,11 @@ class CPU:
         # jump to it
         self.program_counter = subroutine_address
 
+    # CALL, with memoization on
+    def handle_memo_call(self, a, b):
+        self.handle_call(a, b)
+        self.memo.call(self, self.program_counter)
+
     # RET (return from subroutine)
     def handle_ret(self, a, b):
         # get return address from the top of the stack
@@ -244,10 +1564,10 @@ class CPU:
         jump_address = self.register[a]
 
         # if the equal flag is set to true, jump to that address
-        if (self.flag & 0b00000001) == 0b00000001:
+        if self.flag & FLAG_EQUAL:
             self.program_counter = jump_address
         else:
-            self.program_counter += 2
+            self.program_counter = (self.program_counter + 2) & 0xff
 
     # JNE (if equal flag is false, jump to the address in the register)
     def handle_jne(self, a, b):
@@ -255,46 +1575,324 @@ class CPU:
         jump_address = self.register[a]
 
         # if the equal flag is set to false, jump to that address
-        if (self.flag & 0b00000001) == 0b00000000:
+        if not self.flag & FLAG_EQUAL:
             self.program_counter = jump_address
         else:
-            self.program_counter += 2
+            self.program_counter = (self.program_counter + 2) & 0xff
 
-    # AND (Bitwise-AND the values in registerA and registerB, then store the result in registerA)
-    def handle_and(self, a, b):
-        self.alu("AND", a, b)
-
-    # OR (perform a bitwise-OR between the values in registerA and registerB, storing the result in registerA)
-    def handle_or(self, a, b):
-        self.alu("OR", a, b)
-
-    # XOR (perform a bitwise-XOR between the values in registerA and registerB, storing the result in registerA)
-    def handle_xor(self, a, b):
-        self.alu("XOR", a, b)
+    # JGT (if greater-than flag is true, jump to the address in the register)
+    def handle_jgt(self, a, b):
+        if self.flag & FLAG_GREATER:
+            self.program_counter = self.register[a]
+        else:
+            self.program_counter = (self.program_counter + 2) & 0xff
 
-    # NOT (perform a bitwise-NOT on the value in a register, storing the result in the register)
-    def handle_not(self, a, b):
-        self.alu("NOT", a, b)
+    # JLT (if less-than flag is true, jump to the address in the register)
+    def handle_jlt(self, a, b):
+        if self.flag & FLAG_LESS:
+            self.program_counter = self.register[a]
+        else:
+            self.program_counter = (self.program_counter + 2) & 0xff
 
-    # SHL (shift the value in registerA left by the number of bits specified in registerB, filling the low bits with 0)
-    def handle_shl(self, a, b):
-        self.alu("SHL", a, b)
+    # JGE (if greater-than or equal flag is true, jump to the address in the register)
+    def handle_jge(self, a, b):
+        if self.flag & (FLAG_GREATER | FLAG_EQUAL):
+            self.program_counter = self.register[a]
+        else:
+            self.program_counter = (self.program_counter + 2) & 0xff
 
-    # SHR (shift the value in registerA right by the number of bits specified in registerB, filling the high bits with 0)
-    def handle_shr(self, a, b):
-        self.alu("SHR", a, b)
+    # JLE (if less-than or equal flag is true, jump to the address in the register)
+    def handle_jle(self, a, b):
+        if self.flag & (FLAG_LESS | FLAG_EQUAL):
+            self.program_counter = self.register[a]
+        else:
+            self.program_counter = (self.program_counter + 2) & 0xff
 
     # MOD (divide the value in the first register by the value in the second, storing the remainder of the result in registerA)
     def handle_mod(self, a, b):
-        self.alu("MOD", a, b)
+        if self.register[b] == 0:
+            self.divide_by_zero()
+
+        self.register[a] %= self.register[b]
+
+    # LD (load registerA with the value at the memory address stored in registerB)
+    def handle_ld(self, a, b):
+        self.register[a] = self.ram[self.register[b]]
+
+    # ST (store the value in registerB at the address stored in registerA)
+    def handle_st(self, a, b):
+        self.ram_write(self.register[a], self.register[b])
+
+    # PRA (print alpha character value stored in the given register)
+    def handle_pra(self, a, b):
+        self.output.write(PRA_TEXT[self.register[a]])
+
+    # INT (issue the interrupt number stored in the given register)
+    def handle_int(self, a, b):
+        self.register[IS] |= 1 << (self.register[a] & 0b00000111)
+        self.program_counter = (self.program_counter + 2) & 0xff
+
+        # service it before the next instruction
+        self.poll_now = True
+
+    # IRET (return from an interrupt handler)
+    def handle_iret(self, a, b):
+        # pop R6-R0
+        for i in range(6, -1, -1):
+            self.register[i] = self.pop_value()
+
+        # pop the flag and the return address
+        self.flag = self.pop_value()
+        self.program_counter = self.pop_value()
+
+        # re-enable interrupts and service any that came in meanwhile
+        self.interrupts_enabled = True
+        self.poll_now = True
+
+    def enable_keyboard(self, stream=sys.stdin):
+        """
+        Raise the keyboard interrupt for every byte that arrives on stream.
+        The stream is polled without blocking.
+        """
+
+        # select() also takes regular files and /dev/null, which epoll
+        # refuses, and it's as fast as any other for a single stream
+        self.keyboard = selectors.SelectSelector()
+        self.keyboard.register(stream, selectors.EVENT_READ)
+
+    def feed_keys(self, data):
+        """
+        Queue bytes to be raised as keyboard interrupts, one at a time, for
+        hosts that don't have a stream to hand to enable_keyboard().
+        """
+
+        self.pending_keys += data
+        self.poll_now = True
+
+    def wake_sources(self):
+        """
+        What can wake a program spinning until an interrupt: the timer
+        deadline (or None if the timer can't) and whether a key press can.
+        """
+
+        if not self.interrupts_enabled:
+            return None, False
+
+        mask = self.register[IM]
+        deadline = self.next_timer if mask & (1 << TIMER_INTERRUPT) else None
+
+        return deadline, bool(mask & (1 << KEYBOARD_INTERRUPT))
+
+    def probe_spin(self, budget):
+        """
+        Run up to budget instructions, at most IDLE_PROBE_STEPS, while they
+        only change registers, the flag and the PC. Returns the number run
+        and whether the machine came back around to the state it started
+        in, in which case it will go on spinning until an interrupt.
+        """
+
+        ram = self.ram
+        register = self.register
+        decoded = self.decoded
+        start = (self.program_counter, bytes(register), self.flag)
+
+        for steps in range(min(budget, IDLE_PROBE_STEPS)):
+            pc = self.program_counter
+
+            if not SPIN_SAFE[ram[pc]] or pc in self.breakpoints:
+                return steps, False
+
+            entry = decoded[pc]
+            if entry is None:
+                entry = self.decode(pc)
+
+            handler, operand_a, operand_b, next_pc = entry
+
+            if handler == self.handle_invalid_register:
+                return steps, False
+
+            if ram[pc] == LD and register[operand_b] == KEY_PRESSED:
+                return steps, False
+
+            handler(operand_a, operand_b)
+
+            if next_pc is not None:
+                self.program_counter = next_pc
+
+            if (self.program_counter, register, self.flag) == start:
+                return steps + 1, True
+
+        return min(budget, IDLE_PROBE_STEPS), False
+
+    def wake_delay(self):
+        """
+        Seconds until something can wake a program spinning until an
+        interrupt: 0 if a key is waiting, the time left to the timer
+        deadline, or IDLE_WAIT_SLICE while only a key press can. None if
+        nothing can wake it.
+        """
+
+        deadline, keyboard = self.wake_sources()
+
+        if keyboard and self.pending_keys:
+            return 0
+
+        delays = []
+
+        if deadline is not None:
+            delays.append(max(deadline - time.monotonic(), 0))
+
+        if keyboard and self.keyboard is not None:
+            delays.append(IDLE_WAIT_SLICE)
+
+        return min(delays) if delays else None
+
+    def idle_wait(self, limit=None):
+        """
+        Sleep until the timer deadline or a key press, or for at most limit
+        seconds, for a program that's spinning until an interrupt. Returns
+        the seconds slept, or None without sleeping if the idle policy is
+        IDLE_RETURN or nothing can wake the program.
+        """
+
+        deadline, keyboard = self.wake_sources()
+
+        if keyboard and self.pending_keys:
+            self.poll_now = True
+            return 0.0
+
+        stream = self.keyboard if keyboard else None
+
+        if (self.idle_policy != IDLE_SLEEP
+                or (deadline is None and stream is None)):
+            return None
+
+        self.output.flush()
+        start = time.monotonic()
+        timeout = None if deadline is None else max(deadline - start, 0)
+
+        if limit is not None:
+            timeout = limit if timeout is None else min(timeout, limit)
+
+        if stream is not None:
+            stream.select(timeout)
+        else:
+            time.sleep(timeout)
+
+        slept = time.monotonic() - start
+        self.idle_time += slept
+
+        # see what woke it before running any more of the loop
+        self.poll_now = True
+
+        return slept
+
+    def idle_check(self, budget, credit=None):
+        """
+        Look for a spin loop if the registers and flag are back where they
+        were at the last poll, and sleep through it if there is one. With
+        credit, the sleep is counted as IDLE_STEP_RATE instructions a
+        second, up to credit instructions in all. Returns (instructions
+        run or counted, True if the program is idle and nothing woke it).
+        """
+
+        state = bytes(self.register) + bytes((self.flag,))
+
+        if state != self.poll_state:
+            self.poll_state = state
+            return 0, False
+
+        steps, spinning = self.probe_spin(budget)
+
+        if spinning:
+            limit = None
+            if credit is not None:
+                limit = max(credit - steps, 0) / IDLE_STEP_RATE
+
+            slept = self.idle_wait(limit)
+
+            if slept is None:
+                return steps, True
+
+            if credit is not None:
+                steps = min(credit, steps + round(slept * IDLE_STEP_RATE))
+
+        # the state after a wait can't be compared with the one before
+        self.poll_state = None
+
+        return steps, False
+
+    def poll(self):
+        """
+        Check the timer and the keyboard, and service the lowest pending
+        interrupt that is not masked.
+        """
+
+        self.poll_now = False
+
+        now = time.monotonic()
+        self.output.tick(now)
+
+        if self.next_timer is None:
+            self.next_timer = now + 1
+        elif now >= self.next_timer:
+            self.next_timer = now + 1
+            self.register[IS] |= 1 << TIMER_INTERRUPT
+
+        # leave the next key waiting until the last one has been handled
+        keyboard_pending = self.register[IS] & (1 << KEYBOARD_INTERRUPT)
+
+        if not keyboard_pending:
+            if self.pending_keys:
+                self.ram_write(KEY_PRESSED, self.pending_keys.pop(0))
+                self.register[IS] |= 1 << KEYBOARD_INTERRUPT
+
+            elif self.keyboard is not None and self.keyboard.select(0):
+                stream = self.keyboard.get_map()[0]
+                key = os.read(stream.fd, 1)
+
+                if key:
+                    self.ram_write(KEY_PRESSED, key[0])
+                    self.register[IS] |= 1 << KEYBOARD_INTERRUPT
+                else:
+                    # end of input
+                    self.keyboard.close()
+                    self.keyboard = None
+
+        if not self.interrupts_enabled:
+            return
+
+        masked_interrupts = self.register[IM] & self.register[IS]
+
+        if masked_interrupts == 0:
+            return
+
+        for interrupt in range(8):
+            if masked_interrupts & (1 << interrupt):
+                break
+
+        # disable further interrupts and clear this one
+        self.interrupts_enabled = False
+        self.register[IS] &= ~(1 << interrupt) & 0xff
+
+        # save the machine state on the stack
+        self.push_value(self.program_counter)
+        self.push_value(self.flag)
+
+        for i in range(7):
+            self.push_value(self.register[i])
+
+        # jump to the handler
+        self.program_counter = self.ram[INTERRUPT_VECTORS + interrupt]
 
     def push_value(self, value):
         # decrement the stack pointer
-        self.register[self.stack_pointer] -= 1
+        self.register[self.stack_pointer] = (
+            self.register[self.stack_pointer] - 1) & 0xff
 
         # copy the value onto the stack
         top_of_the_stack_address = self.register[self.stack_pointer]
-        self.ram[top_of_the_stack_address] = value
+        self.ram_write(top_of_the_stack_address, value & 0xff)
 
     def pop_value(self):
         # grab the value from the top of the stack
@@ -302,36 +1900,284 @@ class CPU:
         value = self.ram[top_of_the_stack_address]
 
         # increment the stack pointer
-        self.register[self.stack_pointer] += 1
+        self.register[self.stack_pointer] = (
+            self.register[self.stack_pointer] + 1) & 0xff
 
         return value
 
-    def run(self):
-        """Run the CPU."""
+    def step(self):
+        """Run the instruction at the PC and return the new PC."""
+
+        entry = self.decoded[self.program_counter]
+        if entry is None:
+            entry = self.decode(self.program_counter)
+
+        handler, operand_a, operand_b, next_pc = entry
+        handler(operand_a, operand_b)
+
+        if next_pc is not None:
+            self.program_counter = next_pc
+
+        return self.program_counter
+
+    def step_over_breakpoint(self):
+        """
+        Run the real instruction at the PC if run() last stopped at the
+        breakpoint there. Returns the number of instructions run.
+        """
+
+        pc = self.program_counter
+        stopped_here = pc == self.break_pc and pc in self.breakpoints
+        self.break_pc = None
+
+        if not stopped_here:
+            return 0
+
+        handler, operand_a, operand_b, next_pc = self.decode_instruction(pc)
+        handler(operand_a, operand_b)
+
+        if next_pc is not None:
+            self.program_counter = next_pc
+
+        return 1
+
+    def run_blocks(self, until_pc=None):
+        """
+        Run the CPU a basic block at a time, translating each block into a
+        Python function the first time it's reached. Stops like run(), but
+        without a step budget, and the RunResult has no step count.
+        """
+
+        temporary = until_pc is not None and until_pc not in self.breakpoints
+        if temporary:
+            self.add_breakpoint(until_pc)
 
         self.running = True
+        self.hit_breakpoint = False
+        blocks = self.blocks
 
-        while self.running:
-            instruction_register = self.ram_read(self.program_counter)
-            operand_a = self.ram_read(self.program_counter + 1)
-            operand_b = self.ram_read(self.program_counter + 2)
+        try:
+            self.step_over_breakpoint()
 
-            if instruction_register in self.dispatch_table:
-                self.dispatch_table[instruction_register](operand_a, operand_b)
-            else:
-                print(
-                    f"Unkown instruction: {instruction_register} at address {self.program_counter}")
-                sys.exit(1)
-
-            # declare a variable and check if that bit is equal to 1 (true/false value)
-            set_instruction = ((instruction_register & 0b00010000))
-            if set_instruction != 0:
-                pass
-            # if instruction_register == CALL or instruction_register == RET:
-            #     pass
-            else:
-                # if it's not true, increment as normal
-                instruction_length = (
-                    (instruction_register & 0b11000000) >> 6) + 1
-                # this also works => instruction_length = (instruction_register >> 6) + 1
-                self.program_counter += instruction_length
+            while self.running:
+                self.poll()
+
+                if self.idle_policy is not None:
+                    _, idle = self.idle_check(self.poll_interval)
+
+                    if idle:
+                        return RunResult(IDLE, None, self.program_counter)
+
+                self.watch_budget = self.poll_interval
+
+                for _ in repeat(None, self.poll_interval):
+                    block = blocks.get(self.program_counter)
+                    if block is None:
+                        block = self.translate(self.program_counter)
+
+                    self.program_counter = block()
+
+                    if self.poll_now:
+                        break
+
+                if self.hit_breakpoint:
+                    self.break_pc = self.program_counter
+                    return RunResult(BREAKPOINT, None, self.program_counter)
+
+        except Fault as fault:
+            self.running = False
+            self.output.flush()
+            return RunResult(FAULTED, None, self.program_counter, fault)
+
+        finally:
+            # other loops calling the handlers don't budget for watching
+            self.watch_budget = 0
+
+            if temporary:
+                self.remove_breakpoint(until_pc)
+
+        return RunResult(HALTED, None, self.program_counter)
+
+    def run_checkpointed(self, filename, interval):
+        """
+        Run the CPU like run(), saving a checkpoint to filename every
+        interval instructions.
+        """
+
+        while True:
+            result = self.run(max_steps=interval)
+
+            if result.status != BUDGET_EXHAUSTED:
+                return result
+
+            self.save_checkpoint(filename)
+
+    def run_sliced(self, slice_steps=POLL_INTERVAL, max_steps=None,
+                   until_pc=None):
+        """
+        Generator that runs the CPU slice_steps instructions at a time,
+        yielding the total steps so far after each slice so the caller can
+        do other work. Under IDLE_SLEEP, a program spinning until an
+        interrupt yields instead of sleeping, with cpu.idle set; the caller
+        can wait up to cpu.wake_delay() seconds. Returns the final
+        RunResult.
+        """
+
+        total = 0
+        policy = self.idle_policy
+
+        while True:
+            budget = slice_steps
+            if max_steps is not None:
+                budget = min(budget, max_steps - total)
+
+            if policy == IDLE_SLEEP:
+                self.idle_policy = IDLE_RETURN
+
+            try:
+                result = self.run(max_steps=budget, until_pc=until_pc)
+            finally:
+                self.idle_policy = policy
+
+            total += result.steps
+
+            waiting = (result.status == IDLE and policy == IDLE_SLEEP
+                       and self.wake_delay() is not None)
+
+            if not waiting and (result.status != BUDGET_EXHAUSTED or (
+                    max_steps is not None and total >= max_steps)):
+                result.steps = total
+                return result
+
+            yield total
+
+    async def run_async(self, slice_steps=POLL_INTERVAL, max_steps=None,
+                        until_pc=None):
+        """
+        Run the CPU like run_sliced(), giving the asyncio event loop a turn
+        between slices, and waiting in it while the program is idle.
+        Returns the final RunResult.
+        """
+
+        import asyncio
+
+        runner = self.run_sliced(slice_steps, max_steps, until_pc)
+
+        while True:
+            try:
+                next(runner)
+            except StopIteration as stop:
+                return stop.value
+
+            delay = self.wake_delay() if self.idle else 0
+            await asyncio.sleep(delay or 0)
+
+    def run(self, max_steps=None, until_pc=None):
+        """
+        Run the CPU until it halts, faults, reaches a breakpoint or until_pc,
+        or has run max_steps instructions, and return a RunResult. A program
+        spinning until an interrupt is handled by the idle policy.
+        """
+
+        temporary = until_pc is not None and until_pc not in self.breakpoints
+        if temporary:
+            self.add_breakpoint(until_pc)
+
+        self.running = True
+        self.hit_breakpoint = False
+        self.idle = False
+        self.fused_steps = 0
+        self.watch_budget = 0
+        steps = 0
+        executed = 0
+
+        try:
+            if max_steps is None or max_steps > 0:
+                steps = self.step_over_breakpoint()
+
+            while self.running:
+                self.poll()
+
+                batch = self.poll_interval
+                if max_steps is not None:
+                    batch = min(batch, max_steps - steps)
+
+                    if batch <= 0:
+                        return RunResult(
+                            BUDGET_EXHAUSTED, steps, self.program_counter)
+
+                    # leave room in the budget for checking memoized calls
+                    if self.memo is not None:
+                        batch = max(1, min(batch, (max_steps - steps) // 3))
+
+                executed = 0
+
+                # a program back in the same state as at the last poll may
+                # be spinning until an interrupt; with a budget, the time
+                # slept through the spin loop uses the budget up instead
+                if self.idle_policy is not None:
+                    probed, idle = self.idle_check(
+                        batch, None if max_steps is None else max_steps - steps)
+                    steps += probed
+                    batch = max(batch - probed, 0)
+
+                    if idle:
+                        self.idle = True
+                        return RunResult(IDLE, steps, self.program_counter)
+
+                # a fused entry runs two instructions, so it's only used
+                # while the budget has room for a whole batch of them
+                if max_steps is None or max_steps - steps >= 2 * batch:
+                    cache, decode = self.fused, self.fuse
+                    spare = batch
+                else:
+                    cache, decode = self.decoded, self.decode
+                    spare = 0
+
+                # a memoized call being checked runs inside its CALL, on
+                # whatever budget is left over after the batch
+                if max_steps is None:
+                    self.watch_budget = self.poll_interval
+                else:
+                    self.watch_budget = min(
+                        self.poll_interval, max_steps - steps - batch - spare)
+
+                for executed in range(1, batch + 1):
+                    # fetch the decoded instruction, decoding it on a miss
+                    entry = cache[self.program_counter]
+                    if entry is None:
+                        entry = decode(self.program_counter)
+
+                    handler, operand_a, operand_b, next_pc = entry
+                    handler(operand_a, operand_b)
+
+                    # instructions that set the PC have no next_pc
+                    if next_pc is not None:
+                        self.program_counter = next_pc
+
+                    if self.poll_now:
+                        break
+
+                steps += executed + self.fused_steps
+                self.fused_steps = 0
+
+                if self.hit_breakpoint:
+                    self.break_pc = self.program_counter
+                    return RunResult(
+                        BREAKPOINT, steps - 1, self.program_counter)
+
+        except Fault as fault:
+            self.running = False
+            self.output.flush()
+            return RunResult(
+                FAULTED, steps + max(executed - 1, 0) + self.fused_steps,
+                self.program_counter, fault)
+
+        finally:
+            # other loops calling the handlers don't budget for watching
+            self.watch_budget = 0
+
+            if temporary:
+                self.remove_breakpoint(until_pc)
+
+        return RunResult(HALTED, steps, self.program_counter)
@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+"""
+Debugger: breakpoints, watchpoints and reverse execution for LS-8 programs.
+
+Every instruction the debugger runs leaves an undo delta behind:
+
+    pc, flag, interrupts enabled, R0-R7 before the instruction
+    (address, old value) for each RAM write
+
+so stepping back one instruction is a single delta. A full snapshot is
+also kept every snapshot_interval instructions, so going back to any
+step restores the nearest snapshot after it and undoes at most
+snapshot_interval deltas, however long ago the step was.
+
+Breakpoints use the CPU's own breakpoints, which cost nothing until one is
+reached. Watchpoints are only checked against the RAM addresses and
+registers an instruction actually wrote, so unwatched code pays for a
+single test.
+"""
+
+import argparse
+import cmd
+import sys
+from collections import deque
+
+from cpu import *
+from profiler import OPCODE_NAMES, SourceMap
+from tracer import MASK_REGISTERS
+import programs
+
+# Instructions between full snapshots
+SNAPSHOT_INTERVAL = 4096
+
+# Instructions of history kept for reverse execution
+MAX_HISTORY = 1 << 18
+
+# How a debugger move ended, besides the CPU's own statuses
+WATCHPOINT = "watchpoint"
+START_OF_HISTORY = "start of history"
+
+# Offsets in an undo delta
+DELTA_PC = 0
+DELTA_FLAG = 1
+DELTA_INTERRUPTS = 2
+DELTA_REGISTERS = 3
+DELTA_WRITES = 11
+
+
+class Debugger:
+    """
+    Runs a CPU in its own recording loop, so it can stop on breakpoints and
+    watchpoints and run backwards as well as forwards.
+    """
+
+    def __init__(self, cpu, snapshot_interval=SNAPSHOT_INTERVAL,
+                 max_history=MAX_HISTORY):
+        self.cpu = cpu
+        self.snapshot_interval = snapshot_interval
+        self.max_history = max_history
+        # instructions run so far, less any undone
+        self.steps = 0
+        # undo deltas, one per instruction, the latest last
+        self.history = deque()
+        # step -> snapshot() before that step
+        self.snapshots = {0: cpu.snapshot()}
+        # nonzero for every watched RAM address
+        self.watched_ram = bytearray(256)
+        # mask of watched registers
+        self.watched_registers = 0
+        # what the last watchpoint stop saw change
+        self.watch_hits = []
+        self.halted = False
+        cpu.running = True
+
+        # every instruction has to leave a delta, so none can be memoized
+        if cpu.memo is not None:
+            cpu.disable_memoization()
+
+    @property
+    def first_step(self):
+        """The earliest step reverse execution can reach."""
+
+        return self.steps - len(self.history)
+
+    def watch_ram(self, address):
+        self.watched_ram[address] = 1
+
+    def unwatch_ram(self, address):
+        self.watched_ram[address] = 0
+
+    def watch_register(self, register):
+        self.watched_registers |= 1 << register
+
+    def unwatch_register(self, register):
+        self.watched_registers &= ~(1 << register)
+
+    def changed_watches(self, delta):
+        """
+        Describe each watched location that delta's instruction changed,
+        with the CPU still in the state right after it.
+        """
+
+        ram = self.cpu.ram
+        register = self.cpu.register
+        hits = []
+
+        for i in range(DELTA_WRITES, len(delta), 2):
+            address = delta[i]
+
+            if self.watched_ram[address] and ram[address] != delta[i + 1]:
+                hits.append(f"[{address:02X}] {delta[i + 1]:02X} -> "
+                            f"{ram[address]:02X}")
+
+        for i in MASK_REGISTERS[self.watched_registers]:
+            old = delta[DELTA_REGISTERS + i]
+
+            if register[i] != old:
+                hits.append(f"R{i} {old:02X} -> {register[i]:02X}")
+
+        return hits
+
+    def forward(self, max_steps=None):
+        """
+        Run until the CPU halts or faults, reaches a breakpoint, changes a
+        watched location or has run max_steps instructions. The instruction
+        at the PC always runs, even if there's a breakpoint on it. Returns
+        a RunResult.
+        """
+
+        cpu = self.cpu
+
+        if self.halted:
+            return RunResult(HALTED, 0, cpu.program_counter)
+
+        decoded = cpu.decoded
+        ram = cpu.ram
+        register = cpu.register
+        history = self.history
+        watched_ram = self.watched_ram
+        watching_ram = any(watched_ram)
+        watched_registers = MASK_REGISTERS[self.watched_registers]
+        watch_hit = False
+        # RAM writes, as address, old value, address, old value...
+        writes = bytearray()
+
+        real_write = cpu.ram_write
+
+        def ram_write(address, value):
+            writes.append(address)
+            writes.append(ram[address])
+            real_write(address, value)
+
+        cpu.ram_write = ram_write
+
+        moved = 0
+        countdown = cpu.poll_interval
+        until_snapshot = (self.snapshot_interval
+                          - self.steps % self.snapshot_interval)
+        self.watch_hits = []
+        status = BUDGET_EXHAUSTED
+        fault = None
+
+        try:
+            while max_steps is None or moved < max_steps:
+                pc = cpu.program_counter
+                entry = decoded[pc]
+                if entry is None:
+                    entry = cpu.decode(pc)
+
+                handler, operand_a, operand_b, next_pc = entry
+                before = bytes((pc, cpu.flag, cpu.interrupts_enabled))
+                before += register
+
+                handler(operand_a, operand_b)
+
+                # a breakpoint decodes as an instruction that only sets
+                # hit_breakpoint; step over it if it's where we started
+                if cpu.poll_now and cpu.hit_breakpoint:
+                    cpu.hit_breakpoint = False
+
+                    if moved:
+                        status = BREAKPOINT
+                        break
+
+                    handler, operand_a, operand_b, next_pc = (
+                        cpu.decode_instruction(pc))
+                    handler(operand_a, operand_b)
+
+                if next_pc is not None:
+                    cpu.program_counter = next_pc
+
+                countdown -= 1
+
+                if (cpu.poll_now or countdown <= 0) and cpu.running:
+                    countdown = cpu.poll_interval
+                    cpu.poll()
+
+                if writes:
+                    before += writes
+                    writes.clear()
+
+                history.append(before)
+                moved += 1
+
+                until_snapshot -= 1
+                if until_snapshot == 0:
+                    until_snapshot = self.snapshot_interval
+                    self.take_snapshot(self.steps + moved)
+
+                if not cpu.running:
+                    self.halted = True
+                    cpu.output.flush()
+                    status = HALTED
+                    break
+
+                # only look closer when a watched location was written
+                if watched_registers:
+                    for i in watched_registers:
+                        if register[i] != before[DELTA_REGISTERS + i]:
+                            watch_hit = True
+
+                if watching_ram and len(before) > DELTA_WRITES:
+                    for i in range(DELTA_WRITES, len(before), 2):
+                        if watched_ram[before[i]]:
+                            watch_hit = True
+
+                if watch_hit:
+                    watch_hit = False
+                    self.watch_hits = self.changed_watches(before)
+
+                    if self.watch_hits:
+                        status = WATCHPOINT
+                        break
+
+        except Fault as e:
+            # faults happen before the instruction changes anything, so
+            # the CPU is left at the faulting instruction
+            cpu.output.flush()
+            status = FAULTED
+            fault = e
+
+        finally:
+            del cpu.ram_write
+            self.steps += moved
+
+        return RunResult(status, moved, cpu.program_counter, fault)
+
+    def take_snapshot(self, step):
+        """
+        Snapshot the CPU as it is before step, and drop the history that
+        goes further back than max_history.
+        """
+
+        self.snapshots[step] = self.cpu.snapshot()
+        first_step = step - len(self.history)
+        excess = len(self.history) - self.max_history
+
+        if excess > 0:
+            # keep history back to a snapshot, which goto() needs
+            first = min(s for s in self.snapshots if s >= first_step + excess)
+
+            for _ in range(first - first_step):
+                self.history.popleft()
+
+            for s in [s for s in self.snapshots if s < first]:
+                del self.snapshots[s]
+
+    def undo(self):
+        """Undo the last instruction."""
+
+        cpu = self.cpu
+        delta = self.history.pop()
+
+        # put back the RAM writes latest first
+        for i in range(len(delta) - 2, DELTA_WRITES - 1, -2):
+            cpu.ram_write(delta[i], delta[i + 1])
+
+        cpu.register[:] = delta[DELTA_REGISTERS:DELTA_WRITES]
+        cpu.program_counter = delta[DELTA_PC]
+        cpu.flag = delta[DELTA_FLAG]
+        cpu.interrupts_enabled = bool(delta[DELTA_INTERRUPTS])
+        cpu.running = True
+        self.halted = False
+        self.steps -= 1
+
+        if self.steps + 1 in self.snapshots:
+            del self.snapshots[self.steps + 1]
+
+    def reverse(self, max_steps=None):
+        """
+        Run backwards until the PC reaches a breakpoint, an instruction that
+        changed a watched location is next to undo, max_steps instructions
+        have been undone or the history runs out. Returns a RunResult.
+        """
+
+        cpu = self.cpu
+        breakpoints = cpu.breakpoints
+        watching = self.watched_registers or any(self.watched_ram)
+        moved = 0
+        self.watch_hits = []
+
+        while max_steps is None or moved < max_steps:
+            if not self.history:
+                return RunResult(START_OF_HISTORY, moved, cpu.program_counter)
+
+            if moved and watching:
+                self.watch_hits = self.changed_watches(self.history[-1])
+
+                if self.watch_hits:
+                    return RunResult(WATCHPOINT, moved, cpu.program_counter)
+
+            self.undo()
+            moved += 1
+
+            if cpu.program_counter in breakpoints:
+                return RunResult(BREAKPOINT, moved, cpu.program_counter)
+
+        return RunResult(BUDGET_EXHAUSTED, moved, cpu.program_counter)
+
+    def goto(self, step):
+        """
+        Put the CPU back to how it was before instruction step, from the
+        nearest snapshot after it. Steps ahead of the current one are run.
+        Returns False if step is further back than the history goes.
+        """
+
+        if step >= self.steps:
+            self.forward(step - self.steps)
+            return True
+
+        if step < self.first_step:
+            return False
+
+        later = min((s for s in self.snapshots if step <= s < self.steps),
+                    default=self.steps)
+
+        if later < self.steps:
+            self.cpu.restore(self.snapshots[later])
+            self.cpu.running = True
+            self.halted = False
+
+            for _ in range(self.steps - later):
+                self.history.pop()
+
+            for s in [s for s in self.snapshots if s > later]:
+                del self.snapshots[s]
+
+            self.steps = later
+
+        for _ in range(self.steps - step):
+            self.undo()
+
+        return True
+
+
+def disassemble(ram, address):
+    """Get the instruction at address as assembly text."""
+
+    opcode = ram[address]
+    name = OPCODE_NAMES.get(opcode)
+
+    if name is None:
+        return f"DB {opcode:08b}"
+
+    operands = []
+
+    for i in range(1, (opcode >> 6) + 1):
+        value = ram[(address + i) & 0xff]
+
+        if opcode == LDI and i == 2:
+            operands.append(f"{value:02X}h")
+        else:
+            operands.append(f"R{value}")
+
+    return f"{name} {','.join(operands)}".rstrip()
+
+
+class DebuggerShell(cmd.Cmd):
+    """Command line for a Debugger."""
+
+    prompt = "(ls8db) "
+
+    def __init__(self, debugger, source_map):
+        super().__init__()
+        self.debugger = debugger
+        self.cpu = debugger.cpu
+        self.source_map = source_map
+        # print each command before running it
+        self.echo = False
+
+    def precmd(self, line):
+        if self.echo:
+            print(f"{DebuggerShell.prompt}{line}")
+
+        return line
+
+    def address(self, text):
+        """Parse a label or a hex address."""
+
+        for name in (text, text.upper()):
+            if name in self.source_map.labels:
+                return self.source_map.labels[name]
+
+        address = int(text, 16)
+
+        if not 0 <= address <= 0xff:
+            raise ValueError(text)
+
+        return address
+
+    def location(self):
+        cpu = self.cpu
+        pc = cpu.program_counter
+        line = self.source_map.line_for(pc)
+
+        return (f"{self.debugger.steps:>10}  {pc:02X}  "
+                f"{self.source_map.label_for(pc):<16} "
+                f"{disassemble(cpu.ram, pc):<14} {line}").rstrip()
+
+    def report(self, result):
+        self.cpu.output.flush()
+
+        if result.status == WATCHPOINT:
+            print(f"watchpoint: {', '.join(self.debugger.watch_hits)}")
+        elif result.status == FAULTED:
+            print(f"fault: {result.fault}")
+        elif result.status != BUDGET_EXHAUSTED:
+            print(result.status)
+
+        print(self.location())
+
+    def count(self, arg):
+        return int(arg) if arg else 1
+
+    def emptyline(self):
+        pass
+
+    def default(self, line):
+        print(f"unknown command: {line}")
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except ValueError as e:
+            print(f"bad argument: {e}")
+
+    def do_step(self, arg):
+        """step [N]: run N instructions (default 1)."""
+        self.report(self.debugger.forward(self.count(arg)))
+
+    def do_continue(self, arg):
+        """continue: run to the next breakpoint or watchpoint."""
+        self.report(self.debugger.forward())
+
+    def do_rstep(self, arg):
+        """rstep [N]: undo N instructions (default 1)."""
+        self.report(self.debugger.reverse(self.count(arg)))
+
+    def do_rcontinue(self, arg):
+        """rcontinue: run backwards to the previous breakpoint or watchpoint."""
+        self.report(self.debugger.reverse())
+
+    def do_goto(self, arg):
+        """goto STEP: go back (or forward) to before instruction STEP."""
+
+        if not self.debugger.goto(int(arg)):
+            print(f"history starts at step {self.debugger.first_step}")
+
+        print(self.location())
+
+    def do_break(self, arg):
+        """break [ADDR|LABEL]: set a breakpoint, or list them."""
+
+        if arg:
+            self.cpu.add_breakpoint(self.address(arg))
+
+        for address in sorted(self.cpu.breakpoints):
+            print(f"  {address:02X}  {self.source_map.label_for(address)}")
+
+    def do_delete(self, arg):
+        """delete ADDR|LABEL: remove a breakpoint."""
+        self.cpu.remove_breakpoint(self.address(arg))
+
+    def do_watch(self, arg):
+        """watch [ADDR|LABEL|Rn|SP]: watch RAM or a register, or list them."""
+
+        if arg:
+            register = parse_register(arg)
+
+            if register is None:
+                self.debugger.watch_ram(self.address(arg))
+            else:
+                self.debugger.watch_register(register)
+
+        for i in MASK_REGISTERS[self.debugger.watched_registers]:
+            print(f"  R{i}")
+
+        for address in range(256):
+            if self.debugger.watched_ram[address]:
+                print(f"  [{address:02X}]  {self.source_map.label_for(address)}")
+
+    def do_unwatch(self, arg):
+        """unwatch ADDR|LABEL|Rn|SP: remove a watchpoint."""
+
+        register = parse_register(arg)
+
+        if register is None:
+            self.debugger.unwatch_ram(self.address(arg))
+        else:
+            self.debugger.unwatch_register(register)
+
+    def do_regs(self, arg):
+        """regs: print the registers and the flag."""
+
+        cpu = self.cpu
+        print(" ".join(f"R{i}={cpu.register[i]:02X}" for i in range(8))
+              + f" FL={cpu.flag:03b} IE={int(cpu.interrupts_enabled)}")
+
+    def do_x(self, arg):
+        """x ADDR|LABEL [N]: dump N bytes of RAM (default 16)."""
+
+        parts = arg.split()
+        start = self.address(parts[0])
+        length = int(parts[1]) if len(parts) > 1 else 16
+
+        for row in range(start, min(start + length, 256), 16):
+            end = min(row + 16, start + length, 256)
+            print(f"  {row:02X}: " + " ".join(
+                f"{self.cpu.ram[address]:02X}" for address in range(row, end)))
+
+    def do_key(self, arg):
+        """key TEXT: queue key presses for the keyboard interrupt."""
+        self.cpu.feed_keys(arg.encode())
+
+    def do_info(self, arg):
+        """info: where the program is and how far back history goes."""
+
+        print(self.location())
+        print(f"history: steps {self.debugger.first_step}-"
+              f"{self.debugger.steps}, {len(self.debugger.snapshots)} "
+              "snapshots")
+
+    def do_quit(self, arg):
+        """quit: leave the debugger."""
+        return True
+
+    do_EOF = do_quit
+
+    # short forms
+    do_s = do_step
+    do_c = do_continue
+    do_rs = do_rstep
+    do_rc = do_rcontinue
+    do_b = do_break
+    do_w = do_watch
+    do_q = do_quit
+
+
+def parse_register(text):
+    """Get the register number for "R0"-"R7" or "SP", or None."""
+
+    text = text.upper()
+
+    if text == "SP":
+        return 7
+
+    if len(text) == 2 and text[0] == "R" and text[1] in "01234567":
+        return int(text[1])
+
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Debug an LS-8 program, forwards and backwards.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file to debug")
+    parser.add_argument(
+        "source", nargs="?", help=".asm source, for labels and source lines")
+    parser.add_argument(
+        "--interval", type=int, default=SNAPSHOT_INTERVAL,
+        help="instructions between snapshots")
+    parser.add_argument(
+        "--history", type=int, default=MAX_HISTORY,
+        help="instructions of history to keep for reverse execution")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+
+    try:
+        if args.program.endswith(".asm"):
+            programs.assemble_file(args.program).load(cpu)
+        else:
+            cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return e.code
+
+    source = args.source
+    if source is None and args.program.endswith(".asm"):
+        source = args.program
+
+    if source is not None:
+        source_map = SourceMap.from_asm(source)
+    elif cpu.symbols:
+        source_map = SourceMap(cpu.symbols)
+    elif not args.program.endswith(".ls8b"):
+        source_map = SourceMap.from_ls8(args.program)
+    else:
+        source_map = SourceMap()
+
+    shell = DebuggerShell(
+        Debugger(cpu, args.interval, args.history), source_map)
+
+    # echo commands read from a pipe, so the transcript makes sense
+    if not sys.stdin.isatty():
+        shell.echo = True
+        shell.prompt = ""
+
+    print(shell.location())
+    shell.cmdloop()
+    cpu.output.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
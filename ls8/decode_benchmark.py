@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Decode benchmark: instructions a second on the ADD/CMP/JNE counting loop,
+decoding each instruction every time it runs against looking it up in the
+decoded instruction cache. The first is what run() did before the cache.
+run() itself is timed too, for everything it does on top of the cache.
+"""
+
+import argparse
+import sys
+import time
+
+from cpu import *
+import programs
+
+# Never halts, so every engine runs exactly the steps it's given
+COUNT_LOOP = """
+LDI R0,0
+LDI R1,1
+LDI R2,0
+LDI R3,Loop
+Loop:
+ADD R0,R1
+CMP R0,R2
+JNE R3
+JMP R3
+"""
+
+# Instructions in one timed run
+STEPS = 1000000
+
+
+def run_decoding(cpu, steps):
+    """Decode every instruction as it runs, without the cache."""
+
+    for _ in range(steps):
+        handler, operand_a, operand_b, next_pc = cpu.decode_instruction(
+            cpu.program_counter)
+        handler(operand_a, operand_b)
+
+        if next_pc is not None:
+            cpu.program_counter = next_pc
+
+
+def run_cached(cpu, steps):
+    """Run the decoded instruction cache's entries, like run()'s loop."""
+
+    decoded = cpu.decoded
+
+    for _ in range(steps):
+        pc = cpu.program_counter
+        entry = decoded[pc]
+        if entry is None:
+            entry = cpu.decode(pc)
+
+        handler, operand_a, operand_b, next_pc = entry
+        handler(operand_a, operand_b)
+
+        if next_pc is not None:
+            cpu.program_counter = next_pc
+
+
+def run_cpu(cpu, steps):
+    cpu.run(max_steps=steps)
+
+
+ENGINES = {
+    "decode every step": run_decoding,
+    "decoded cache": run_cached,
+    "run()": run_cpu,
+}
+
+
+def measure(engine, steps, repeat):
+    """Best instructions a second of repeat runs of engine."""
+
+    best = 0
+
+    for _ in range(repeat):
+        cpu = CPU()
+        cpu.set_output(CaptureOutput())
+        cpu.idle_policy = None
+        cpu.next_timer = float("inf")
+        programs.assemble(COUNT_LOOP).load(cpu)
+
+        start = time.perf_counter()
+        engine(cpu, steps)
+        best = max(best, steps / (time.perf_counter() - start))
+
+    return best
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Time the decoded instruction cache on a counting loop.")
+    parser.add_argument(
+        "--steps", type=int, default=STEPS,
+        help="instructions in each timed run")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="timed runs of each engine; the best one counts")
+    args = parser.parse_args(argv[1:])
+
+    for name, engine in ENGINES.items():
+        rate = measure(engine, args.steps, args.repeat)
+        print(f"{name:<18} {rate / 1e6:6.2f}M instructions/s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
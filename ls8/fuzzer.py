@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+"""
+Fuzzer: coverage-guided fuzzing of the inputs to an LS-8 program.
+
+An input is the starting value of R0-R6 (so IM and IS too), the key in
+KEY_PRESSED and the bytes of the RAM input regions. Each execution restores
+the machine from a snapshot taken right after the program was loaded,
+writes the input over it and runs it in an instrumented loop that marks
+every (previous PC, PC) edge in a 64 KiB bitmap, counting the edges it
+marks for the first time. Restoring keeps the decoded instruction cache,
+so nothing is parsed or decoded again between executions.
+
+Inputs that reach an edge no earlier input did join the corpus and get
+mutated further. Inputs that fault, or that push onto the program's code
+or data, are kept as crashes, one for each kind of fault at each PC, and
+shrunk to the smallest input that still crashes the same way.
+The timer interrupt comes in every FUZZ_POLL_INTERVAL instructions instead
+of every second, so executions are repeatable. A program spinning until an
+interrupt skips ahead to its next timer interrupt, gets the input's key
+press if it's waiting for one, or else ends the execution as idle.
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+from cpu import *
+from programs import analyze
+from tracer import parse_range
+import programs
+
+# Input layout: R0-R6, the key pressed, then the bytes of each input region
+INPUT_REGISTERS = 0
+INPUT_KEY = 7
+INPUT_REGIONS = 8
+
+# Instructions an execution runs before it counts as a hang
+FUZZ_MAX_STEPS = 10000
+
+# Instructions between interrupt checks, and between timer interrupts
+FUZZ_POLL_INTERVAL = 256
+
+# Byte values that tend to find edge cases
+INTERESTING = (0, 1, 2, 7, 8, 0x7f, 0x80, 0xf3, 0xf4, 0xf8, 0xfe, 0xff)
+
+# Fault code for a stack that grew into the program
+FAULT_STACK_OVERFLOW = 4
+
+
+class StackOverflow(Fault):
+    """A push landed on the program's code or data."""
+
+    code = FAULT_STACK_OVERFLOW
+
+
+class Fuzzer:
+    """Mutates inputs to the program loaded into cpu, looking for faults."""
+
+    def __init__(self, cpu, regions=(), max_steps=FUZZ_MAX_STEPS, seed=None):
+        self.cpu = cpu
+        # (low, high) address ranges, inclusive
+        self.regions = list(regions)
+        self.input_size = INPUT_REGIONS + sum(
+            high - low + 1 for low, high in self.regions)
+        self.max_steps = max_steps
+        self.random = random.Random(seed)
+
+        # every instruction has to be traced, so none can be memoized
+        if cpu.memo is not None:
+            cpu.disable_memoization()
+
+        cpu.set_output(CaptureOutput())
+        cpu.idle_policy = None
+        cpu.keyboard = None
+        cpu.poll_interval = FUZZ_POLL_INTERVAL
+        # the fuzzer raises the timer itself, by instructions run
+        cpu.next_timer = float("inf")
+
+        # nonzero for each address a push mustn't land on; the program may
+        # put its stack anywhere else
+        self.program = program_bytes(cpu)
+        self.pushes = (cpu.handle_push, cpu.handle_call)
+        self.base = cpu.snapshot()
+
+        # nonzero at prev << 8 | pc for every edge seen so far
+        self.edges = bytearray(1 << 16)
+        self.edge_count = 0
+
+        # inputs that reached new edges
+        self.corpus = []
+        # (fault class name, pc) -> (input, Fault)
+        self.crashes = {}
+        self.executions = 0
+        self.hangs = 0
+        self.elapsed = 0.0
+
+    def initial_input(self):
+        """The input the program starts with when it isn't fuzzed."""
+
+        state = self.base
+        data = bytearray(state[STATE_REGISTERS:STATE_REGISTERS + 7])
+        data.append(state[KEY_PRESSED])
+
+        for low, high in self.regions:
+            data += state[low:high + 1]
+
+        return bytes(data)
+
+    def execute(self, data):
+        """
+        Run the program once on data from the post-load snapshot, marking
+        its edges in the bitmap. Returns HALTED, BUDGET_EXHAUSTED, IDLE or
+        FAULTED, the Fault and the number of edges it saw first.
+        """
+
+        cpu = self.cpu
+        cpu.restore(self.base)
+        register = cpu.register
+        register[:7] = data[:7]
+        cpu.ram_write(KEY_PRESSED, data[INPUT_KEY])
+
+        position = INPUT_REGIONS
+        for low, high in self.regions:
+            for address in range(low, high + 1):
+                cpu.ram_write(address, data[position])
+                position += 1
+
+        cpu.output.buffer.clear()
+        cpu.poll_now = False
+        cpu.poll_state = None
+        cpu.running = True
+
+        edges = self.edges
+        new_edges = 0
+        decoded = cpu.decoded
+        program = self.program
+        pushes = self.pushes
+        prev = cpu.program_counter
+        sp = register[7]
+        key_pressed = False
+        interrupted = False
+        steps = 0
+        ticks = 0
+        pc = prev
+
+        try:
+            while cpu.running and steps < self.max_steps:
+                batch = min(FUZZ_POLL_INTERVAL - steps % FUZZ_POLL_INTERVAL,
+                            self.max_steps - steps)
+
+                # look for a spin loop, but not in an interrupt handler, so
+                # the state after it returns is compared with the state
+                # before; the instructions probed go around a loop whose
+                # edges are already marked
+                probed, idle = 0, False
+                if not interrupted:
+                    probed, idle = cpu.idle_check(batch)
+                    steps += probed
+                    batch -= probed
+                    sp = register[7]
+
+                if idle:
+                    deadline, keyboard = cpu.wake_sources()
+
+                    if keyboard and not key_pressed:
+                        key_pressed = True
+                        register[IS] |= 1 << KEYBOARD_INTERRUPT
+                    elif deadline is None:
+                        return IDLE, None, new_edges
+                    elif steps // FUZZ_POLL_INTERVAL == ticks:
+                        # skip ahead to the next timer interrupt
+                        steps += batch
+                        batch = 0
+
+                if steps // FUZZ_POLL_INTERVAL > ticks:
+                    ticks = steps // FUZZ_POLL_INTERVAL
+                    register[IS] |= 1 << TIMER_INTERRUPT
+
+                pc = cpu.program_counter
+                cpu.poll()
+
+                # an interrupt pushes the machine state
+                interrupted = register[7] != sp
+
+                if register[7] < sp and any(program[register[7]:sp]):
+                    raise StackOverflow(
+                        pc, f"Interrupt pushed onto the program at "
+                            f"address {pc}")
+
+                sp = register[7]
+
+                if not batch:
+                    continue
+
+                for executed in range(1, batch + 1):
+                    pc = cpu.program_counter
+                    edge = prev << 8 | pc
+                    if not edges[edge]:
+                        edges[edge] = 1
+                        new_edges += 1
+                    prev = pc
+
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+
+                    handler, operand_a, operand_b, next_pc = entry
+                    handler(operand_a, operand_b)
+
+                    if next_pc is not None:
+                        cpu.program_counter = next_pc
+
+                    if register[7] != sp:
+                        if (register[7] < sp and program[register[7]]
+                                and handler in pushes):
+                            raise StackOverflow(
+                                pc, f"Stack overflow into the program at "
+                                    f"address {pc}")
+
+                        sp = register[7]
+
+                    if cpu.poll_now:
+                        break
+
+                steps += executed
+                interrupted = False
+
+        except Fault as fault:
+            cpu.running = False
+            return FAULTED, fault, new_edges
+
+        status = BUDGET_EXHAUSTED if cpu.running else HALTED
+        return status, None, new_edges
+
+    def run_input(self, data):
+        """
+        Execute data and keep it if it found new edges or a new crash.
+        Returns the status.
+        """
+
+        status, fault, new_edges = self.execute(data)
+
+        if new_edges:
+            self.edge_count += new_edges
+            self.corpus.append(data)
+
+        if fault is not None:
+            key = crash_key(fault)
+            if key not in self.crashes:
+                self.crashes[key] = (self.minimize(data, key), fault)
+
+        return status
+
+    def minimize(self, data, key):
+        """
+        Shrink an input that crashes the way key says, zeroing or halving
+        each byte while it still crashes the same way. The runs leave the
+        edge bitmap alone.
+        """
+
+        edges = bytes(self.edges)
+        data = bytearray(data)
+        shrunk = True
+
+        while shrunk:
+            shrunk = False
+
+            for position in range(len(data)):
+                for value in (0, data[position] >> 1):
+                    if value == data[position]:
+                        continue
+
+                    old = data[position]
+                    data[position] = value
+                    _, fault, _ = self.execute(data)
+
+                    if fault is not None and crash_key(fault) == key:
+                        shrunk = True
+                        break
+
+                    data[position] = old
+
+        self.edges[:] = edges
+
+        return bytes(data)
+
+    def mutate(self, data):
+        """A copy of data with a few random changes stacked up."""
+
+        rng = self.random
+        data = bytearray(data)
+
+        for _ in range(1 << rng.randrange(4)):
+            position = rng.randrange(len(data))
+            choice = rng.randrange(5)
+
+            if choice == 0:
+                data[position] ^= 1 << rng.randrange(8)
+            elif choice == 1:
+                data[position] = rng.choice(INTERESTING)
+            elif choice == 2:
+                data[position] = (data[position] + rng.randint(-16, 16)) & 0xff
+            elif choice == 3:
+                data[position] = rng.randrange(256)
+            else:
+                # splice in part of another corpus input
+                other = rng.choice(self.corpus)
+                end = rng.randint(position, len(data))
+                data[position:end] = other[position:end]
+
+        return bytes(data)
+
+    def fuzz(self, executions=None, seconds=None, report=None):
+        """
+        Mutate corpus inputs until executions have run or seconds have
+        passed, calling report(fuzzer) about once a second.
+        """
+
+        if not self.corpus:
+            self.run_input(self.initial_input())
+
+        # an input that found nothing new still has to be mutated from
+        if not self.corpus:
+            self.corpus.append(self.initial_input())
+
+        elapsed = self.elapsed
+        start = last_report = time.perf_counter()
+        count = 0
+
+        while executions is None or count < executions:
+            data = self.mutate(self.random.choice(self.corpus))
+            status = self.run_input(data)
+            count += 1
+
+            # only the mutated inputs count, not the seeds they came from
+            self.executions += 1
+            if status == BUDGET_EXHAUSTED:
+                self.hangs += 1
+
+            if count % 256 == 0:
+                now = time.perf_counter()
+                self.elapsed = elapsed + now - start
+
+                if seconds is not None and now - start >= seconds:
+                    break
+
+                if report is not None and now - last_report >= 1:
+                    last_report = now
+                    report(self)
+
+        self.elapsed = elapsed + time.perf_counter() - start
+
+    def add_seeds(self, inputs):
+        """Run inputs, like a saved corpus, keeping those that add edges."""
+
+        for data in inputs:
+            data = bytes(data[:self.input_size]).ljust(self.input_size, b"\0")
+            self.run_input(data)
+
+    def status(self):
+        """One line of statistics."""
+
+        rate = self.executions / self.elapsed if self.elapsed else 0
+
+        return (f"{self.executions} execs ({rate:.0f}/s), "
+                f"{self.edge_count} edges, corpus {len(self.corpus)}, "
+                f"crashes {len(self.crashes)}, hangs {self.hangs}")
+
+    def save(self, directory):
+        """Write the corpus and crashes under directory."""
+
+        corpus = os.path.join(directory, "corpus")
+        crashes = os.path.join(directory, "crashes")
+        os.makedirs(corpus, exist_ok=True)
+        os.makedirs(crashes, exist_ok=True)
+
+        for data in self.corpus:
+            name = hashlib.sha1(data).hexdigest()[:16]
+            with open(os.path.join(corpus, name), "wb") as f:
+                f.write(data)
+
+        for (kind, pc), (data, fault) in self.crashes.items():
+            name = f"{kind}-{pc:02X}-{hashlib.sha1(data).hexdigest()[:16]}"
+            with open(os.path.join(crashes, name), "wb") as f:
+                f.write(data)
+
+
+def crash_key(fault):
+    """What makes two crashes the same: the kind of fault and its PC."""
+
+    return type(fault).__name__, fault.pc
+
+
+def program_bytes(cpu):
+    """
+    A bytearray that's nonzero for each address holding the program loaded
+    into cpu: every byte of the instructions static analysis can reach,
+    and every other nonzero byte below KEY_PRESSED.
+    """
+
+    program = bytearray(256)
+
+    for address in range(KEY_PRESSED):
+        if cpu.ram[address]:
+            program[address] = 1
+
+    analysis = analyze.analyze(cpu.ram, cpu.program_counter)
+
+    for address, (name, a, b, length) in analysis.instructions.items():
+        for offset in range(length):
+            program[(address + offset) & 0xff] = 1
+
+    return program
+
+
+def read_inputs(directory):
+    """Read every input file in directory, if it exists."""
+
+    if not os.path.isdir(directory):
+        return []
+
+    inputs = []
+
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as f:
+            inputs.append(f.read())
+
+    return inputs
+
+
+def default_regions(cpu):
+    """
+    The RAM the program's reachable LD instructions read, as far as static
+    analysis can tell: the byte at each constant address, and all the
+    bytes outside the code if some address isn't constant.
+    """
+
+    analysis = analyze.analyze(cpu.ram, cpu.program_counter)
+    addresses = set()
+
+    for address, (name, a, b, length) in analysis.instructions.items():
+        if name != "LD":
+            continue
+
+        target = analysis.states[address][b]
+
+        if target is None:
+            for start, end, kind in analysis.data:
+                addresses.update(range(start, end))
+
+        # the key is already part of every input
+        elif target != KEY_PRESSED:
+            addresses.add(target)
+
+    regions = []
+
+    for address in sorted(addresses):
+        if regions and regions[-1][1] == address - 1:
+            regions[-1] = (regions[-1][0], address)
+        else:
+            regions.append((address, address))
+
+    return regions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Fuzz the inputs of an LS-8 program.")
+    parser.add_argument("program", help=".ls8, .ls8b or .asm file to fuzz")
+    parser.add_argument(
+        "--region", action="append", type=parse_range, metavar="LO-HI",
+        help="RAM input region in hex, like 80-9F (may be repeated; default: "
+             "the RAM the program loads from, found by static analysis)")
+    parser.add_argument(
+        "--runs", type=int, default=None,
+        help="stop after this many executions")
+    parser.add_argument(
+        "--time", type=float, default=None,
+        help="stop after this many seconds (default: 10, unless --runs)")
+    parser.add_argument(
+        "--max-steps", type=int, default=FUZZ_MAX_STEPS,
+        help="instructions before an execution counts as a hang")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed")
+    parser.add_argument(
+        "--out", metavar="DIR",
+        help="load the corpus from DIR/corpus and save it and the crashes "
+             "under DIR")
+    parser.add_argument(
+        "--replay", metavar="FILE",
+        help="run one saved input and print what happened")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+
+    try:
+        if args.program.endswith(".asm"):
+            programs.assemble_file(args.program).load(cpu)
+        else:
+            cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return e.code
+
+    regions = args.region if args.region is not None else default_regions(cpu)
+    fuzzer = Fuzzer(cpu, regions, args.max_steps, args.seed)
+
+    if args.replay is not None:
+        with open(args.replay, "rb") as f:
+            data = f.read().ljust(fuzzer.input_size, b"\0")
+
+        status, fault, _ = fuzzer.execute(data)
+        sys.stdout.buffer.write(cpu.output.getvalue())
+        print(status if fault is None else f"{status}: {fault}",
+              file=sys.stderr)
+        return 0 if fault is None else 1
+
+    regions_text = ", ".join(f"{low:02X}-{high:02X}" for low, high in regions)
+    print(f"Fuzzing {fuzzer.input_size} input bytes: R0-R6, key"
+          f"{', ' + regions_text if regions_text else ''}", file=sys.stderr)
+
+    if args.out is not None:
+        fuzzer.add_seeds(read_inputs(os.path.join(args.out, "corpus")))
+
+    seconds = args.time
+    if seconds is None and args.runs is None:
+        seconds = 10
+
+    fuzzer.fuzz(args.runs, seconds,
+                report=lambda f: print(f.status(), file=sys.stderr))
+
+    print(fuzzer.status(), file=sys.stderr)
+
+    for (kind, pc), (data, fault) in sorted(fuzzer.crashes.items(),
+                                            key=lambda item: item[0][1]):
+        print(f"  {pc:02X}  {kind}: {fault}  input {data.hex()}",
+              file=sys.stderr)
+
+    if args.out is not None:
+        fuzzer.save(args.out)
+
+    return 1 if fuzzer.crashes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,10 +2,89 @@
 
 """Main."""
 
+import argparse
+import os
 import sys
 from cpu import *
+from programs import analyze, assemble_file
+
+parser = argparse.ArgumentParser(description="Run an LS-8 program.")
+parser.add_argument("program", help=".ls8, .ls8b or .asm file to run")
+parser.add_argument(
+    "--checkpoint", metavar="FILE",
+    help="save the machine state to FILE every --every instructions")
+parser.add_argument(
+    "--every", type=int, default=1000000, metavar="N",
+    help="instructions between checkpoints (default: 1000000)")
+parser.add_argument(
+    "--resume", action="store_true",
+    help="carry on from the --checkpoint file if there is one")
+parser.add_argument(
+    "--prelink", action="store_true",
+    help="resolve jump and call targets statically before running")
+parser.add_argument(
+    "--memoize", action="store_true",
+    help="skip repeated calls to pure subroutines, and report how it went")
+args = parser.parse_args()
 
 cpu = CPU()
 
-cpu.load()
-cpu.run()
+if args.memoize:
+    cpu.enable_memoization()
+
+try:
+    if args.program.endswith(".asm"):
+        assemble_file(args.program).load(cpu)
+    else:
+        cpu.load(args.program)
+
+    if args.resume and args.checkpoint and os.path.exists(args.checkpoint):
+        cpu.load_checkpoint(args.checkpoint)
+
+    # the analysis assumes the program starts from the top, not from a
+    # checkpoint, and only holds if nothing can write over the code
+    elif args.prelink:
+        analysis = analyze.analyze(cpu.ram, cpu.program_counter)
+        if analysis.complete:
+            cpu.prelink(analysis.branch_targets)
+
+except LoadError as e:
+    print(e)
+    sys.exit(e.code)
+
+
+def run():
+    try:
+        if args.checkpoint:
+            result = cpu.run_checkpointed(args.checkpoint, args.every)
+        else:
+            result = cpu.run()
+    finally:
+        cpu.output.flush()
+
+        if cpu.memo is not None:
+            print(cpu.memo.report(), file=sys.stderr)
+
+    if result.status == FAULTED:
+        print(result.fault)
+        sys.exit(1)
+
+
+# key presses raise the keyboard interrupt; on a terminal, read them one
+# at a time instead of a line at a time
+if sys.stdin.isatty():
+    import termios
+    import tty
+
+    saved_terminal = termios.tcgetattr(sys.stdin)
+    tty.setcbreak(sys.stdin)
+
+    try:
+        cpu.enable_keyboard(sys.stdin)
+        run()
+    finally:
+        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, saved_terminal)
+
+else:
+    cpu.enable_keyboard(sys.stdin)
+    run()
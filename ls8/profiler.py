@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""Profiler: per-opcode, per-PC and call graph counts for LS-8 programs."""
+
+import argparse
+import io
+import sys
+from itertools import repeat
+
+from cpu import *
+from programs import analyze, asm
+
+OPCODE_NAMES = analyze.NAMES
+REGEX_LS8_LABEL = analyze.REGEX_LS8_LABEL
+label_for = analyze.label_for
+
+
+class SourceMap:
+    """Labels and source lines for the addresses of a program."""
+
+    def __init__(self, labels=None, lines=None):
+        # name -> address
+        self.labels = labels or {}
+        # address -> (line number, source text)
+        self.lines = lines or {}
+
+    @classmethod
+    def from_asm(cls, filename):
+        """Assemble filename to find its labels and source lines."""
+
+        with open(filename) as f:
+            source = f.read()
+
+        labels = {}
+        lines = {}
+        asm.pass1(io.StringIO(source), labels, [], lines)
+
+        return cls(labels, lines)
+
+    @classmethod
+    def from_ls8(cls, filename):
+        """
+        Read the labels and instruction comments the assembler leaves in a
+        text .ls8 file. Line numbers are .ls8 file lines.
+        """
+
+        labels = {}
+        lines = {}
+        address = 0
+
+        with open(filename) as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+
+                m = REGEX_LS8_LABEL.match(line)
+                if m is not None:
+                    labels[m.group(1)] = int(m.group(2))
+                    continue
+
+                if line == "" or line[0] == "#":
+                    continue
+
+                if "#" in line:
+                    lines[address] = (line_num, line.split("#", 1)[1].strip())
+
+                address += 1
+
+        return cls(labels, lines)
+
+    def label_for(self, address):
+        return label_for(self.labels, address)
+
+    def line_for(self, address):
+        """Get the source line at address as text, or ""."""
+
+        if address not in self.lines:
+            return ""
+
+        line_num, text = self.lines[address]
+        return f"{line_num}: {text}"
+
+
+class Profiler:
+    """Counts the opcodes, PCs and calls of a running CPU."""
+
+    def __init__(self):
+        self.instructions = 0
+        self.opcode_counts = [0] * 256
+        self.pc_counts = [0] * 256
+        # lowest stack pointer seen, the stack starts empty at 0xF4
+        self.stack_low_water = KEY_PRESSED
+        # (caller entry, callee entry) -> [calls, inclusive instructions]
+        self.call_edges = {}
+        # entry -> [calls, inclusive instructions]
+        self.functions = {}
+
+    def run(self, cpu, max_steps=None):
+        """
+        Run cpu until it halts, faults or has run max_steps instructions,
+        counting everything it does. Returns the RunResult.
+        """
+
+        # every instruction has to be counted, so none can be memoized
+        if cpu.memo is not None:
+            cpu.disable_memoization()
+
+        cpu.running = True
+        decoded = cpu.decoded
+        ram = cpu.ram
+        register = cpu.register
+        opcode_counts = self.opcode_counts
+        pc_counts = self.pc_counts
+
+        # frames of (function entry, instruction count at entry)
+        frames = [(cpu.program_counter, 0)]
+        count = self.instructions
+        start_count = count
+        status = HALTED
+        fault = None
+
+        try:
+            while cpu.running:
+                batch = cpu.poll_interval
+
+                if max_steps is not None:
+                    batch = min(batch, max_steps - (count - start_count))
+
+                    if batch <= 0:
+                        status = BUDGET_EXHAUSTED
+                        break
+
+                cpu.poll()
+
+                for _ in repeat(None, batch):
+                    pc = cpu.program_counter
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+
+                    handler, operand_a, operand_b, next_pc = entry
+                    opcode = ram[pc]
+                    opcode_counts[opcode] += 1
+                    pc_counts[pc] += 1
+                    count += 1
+
+                    handler(operand_a, operand_b)
+
+                    if next_pc is not None:
+                        cpu.program_counter = next_pc
+
+                    if opcode == CALL:
+                        frames.append((cpu.program_counter, count))
+
+                    elif opcode == RET and len(frames) > 1:
+                        callee, start = frames.pop()
+                        self.record_call(frames[-1][0], callee, count - start)
+
+                    if register[7] < self.stack_low_water:
+                        self.stack_low_water = register[7]
+
+                    if cpu.poll_now:
+                        break
+
+        except Fault as e:
+            cpu.running = False
+            cpu.output.flush()
+            status = FAULTED
+            fault = e
+
+        finally:
+            self.instructions = count
+
+        return RunResult(status, count - start_count, cpu.program_counter,
+                         fault)
+
+    def record_call(self, caller, callee, instructions):
+        edge = self.call_edges.setdefault((caller, callee), [0, 0])
+        edge[0] += 1
+        edge[1] += instructions
+
+        function = self.functions.setdefault(callee, [0, 0])
+        function[0] += 1
+        function[1] += instructions
+
+    def report(self, source_map=None, top=20, file=sys.stdout):
+        """Print the hot PCs, opcode counts and call graph."""
+
+        if source_map is None:
+            source_map = SourceMap()
+
+        total = self.instructions or 1
+
+        print(f"Instructions: {self.instructions}", file=file)
+        print(f"Max stack depth: {KEY_PRESSED - self.stack_low_water} bytes "
+              f"(SP low water {self.stack_low_water:02X})", file=file)
+
+        print("\nHot PCs:", file=file)
+        print(f"{'count':>10} {'%':>6}  addr  {'label':<20} source", file=file)
+
+        hot = sorted(range(256), key=lambda pc: -self.pc_counts[pc])
+
+        for pc in hot[:top]:
+            hits = self.pc_counts[pc]
+            if hits == 0:
+                break
+
+            print(f"{hits:>10} {100 * hits / total:>6.2f}  {pc:02X}    "
+                  f"{source_map.label_for(pc):<20} {source_map.line_for(pc)}",
+                  file=file)
+
+        print("\nOpcodes:", file=file)
+
+        for opcode in sorted(range(256), key=lambda op: -self.opcode_counts[op]):
+            hits = self.opcode_counts[opcode]
+            if hits == 0:
+                break
+
+            name = OPCODE_NAMES.get(opcode, f"{opcode:08b}")
+            print(f"{hits:>10} {100 * hits / total:>6.2f}  {name}", file=file)
+
+        if self.call_edges:
+            print("\nCall graph:", file=file)
+            print(f"{'calls':>10} {'inclusive':>10}  caller -> callee",
+                  file=file)
+
+            for (caller, callee), (calls, instructions) in sorted(
+                    self.call_edges.items(), key=lambda item: -item[1][1]):
+                print(f"{calls:>10} {instructions:>10}  "
+                      f"{source_map.label_for(caller)} -> "
+                      f"{source_map.label_for(callee)}", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Profile an LS-8 program's opcodes, PCs and calls.")
+    parser.add_argument("program", help=".ls8 or .ls8b file to run")
+    parser.add_argument("source", nargs="?",
+                        help=".asm source for labels and source lines")
+    parser.add_argument(
+        "--max-steps", type=int, default=None,
+        help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+
+    try:
+        cpu.load(args.program)
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return e.code
+
+    if args.source is not None:
+        source_map = SourceMap.from_asm(args.source)
+    elif cpu.symbols:
+        source_map = SourceMap(cpu.symbols)
+    elif not args.program.endswith(".ls8b"):
+        source_map = SourceMap.from_ls8(args.program)
+    else:
+        source_map = SourceMap()
+
+    profiler = Profiler()
+    result = profiler.run(cpu, args.max_steps)
+    cpu.output.flush()
+
+    if result.fault is not None:
+        print(result.fault, file=sys.stderr)
+
+    profiler.report(source_map)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,169 @@
+"""
+Programs: assemble LS-8 source in-process and load the machine code
+straight into a CPU, without writing or parsing a .ls8 file.
+"""
+
+import contextlib
+import hashlib
+import importlib.util
+import io
+import os
+import sys
+from collections import OrderedDict
+
+from cpu import *
+
+# Where the assembler's modules are; it isn't a package
+ASSEMBLER_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "asm")
+
+
+def import_assembler(name):
+    """
+    Import one of the assembler's modules from its file, so nothing else
+    on sys.path, like an asm.py in the working directory, can stand in for
+    it. The module is registered under name, since the assembler's modules
+    import each other by name.
+    """
+
+    filename = os.path.abspath(os.path.join(ASSEMBLER_DIRECTORY, f"{name}.py"))
+    module = sys.modules.get(name)
+
+    if (module is not None and getattr(module, "__file__", None)
+            and os.path.abspath(module.__file__) == filename):
+        return module
+
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+asm = import_assembler("asm")
+# asm imports this one itself when it needs it
+analyze = import_assembler("analyze")
+
+# How many assembled programs the default cache keeps
+PROGRAM_CACHE_SIZE = 512
+
+
+class Program:
+    """Assembled machine code and its symbol table."""
+
+    def __init__(self, code, symbols):
+        self.code = bytes(code)
+        # name -> address
+        self.symbols = symbols
+
+    def load(self, cpu):
+        """Load the program into cpu."""
+
+        cpu.load_code(self.code, self.symbols)
+
+
+class ProgramCache:
+    """
+    Assembled programs, most recently used last, keyed by a hash of their
+    source. Sources that .include other files aren't cached, since the key
+    doesn't cover the included files.
+    """
+
+    def __init__(self, maxsize=PROGRAM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.programs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def assemble(self, source, base="."):
+        """Get the Program for source, assembling it on a miss."""
+
+        cacheable = ".include" not in source.lower()
+
+        if cacheable:
+            key = hashlib.sha256(source.encode()).digest()
+            program = self.programs.get(key)
+
+            if program is not None:
+                self.programs.move_to_end(key)
+                self.hits += 1
+                return program
+
+        self.misses += 1
+        program = assemble_uncached(source, base)
+
+        if cacheable:
+            self.programs[key] = program
+
+            if len(self.programs) > self.maxsize:
+                self.programs.popitem(last=False)
+
+        return program
+
+    def clear(self):
+        self.programs.clear()
+
+
+def assemble_uncached(source, base="."):
+    """
+    Assemble source with the single-pass assembler. Assembler errors
+    raise LoadError with the assembler's message.
+    """
+
+    messages = io.StringIO()
+
+    try:
+        with contextlib.redirect_stderr(messages):
+            code, symbols = asm.assemble_stream(source.splitlines(),
+                                                base=base)
+
+    except SystemExit as e:
+        raise LoadError(messages.getvalue().strip(), e.code)
+
+    return Program(code, symbols)
+
+
+# The cache assemble() and friends use
+cache = ProgramCache()
+
+
+def assemble(source, base="."):
+    """Assemble source, or get it from the cache."""
+
+    return cache.assemble(source, base)
+
+
+def assemble_file(filename):
+    """Assemble the .asm file filename, or get it from the cache."""
+
+    try:
+        with open(filename) as f:
+            source = f.read()
+
+    except FileNotFoundError:
+        raise LoadError(f"File not found: {filename}", 2)
+
+    return cache.assemble(source, os.path.dirname(filename))
+
+
+def load_source(cpu, source, base="."):
+    """Assemble source and load it into cpu. Returns the Program."""
+
+    program = assemble(source, base)
+    program.load(cpu)
+
+    return program
+
+
+def run_source(source, max_steps=None, base="."):
+    """
+    Assemble source and run it on a new CPU that captures its output.
+    Returns the CPU and its RunResult.
+    """
+
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    load_source(cpu, source, base)
+
+    return cpu, cpu.run(max_steps=max_steps)
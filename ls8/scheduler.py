@@ -0,0 +1,315 @@
+"""Scheduler: time-slice many LS-8 machines in one asyncio event loop."""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+from cpu import *
+
+# How the scheduler picks the next machine to run
+ROUND_ROBIN = "round-robin"
+PRIORITY = "priority"
+
+# Result status for a machine parked on keyboard input when its input ends
+INPUT_CLOSED = "input closed"
+
+# Result status for a cancelled machine
+CANCELLED = "cancelled"
+
+# Result status for a machine whose run raised something other than a
+# Fault, like its output sink failing; the exception is the result's fault
+CRASHED = "crashed"
+
+# Most results of finished machines kept for result(), oldest dropped first
+MAX_FINISHED = 1024
+
+
+class Guest:
+    """One machine owned by a Scheduler."""
+
+    def __init__(self, guest_id, cpu, priority, max_steps, result):
+        self.id = guest_id
+        self.cpu = cpu
+        # bigger priorities get proportionally more quanta
+        self.priority = priority
+        self.max_steps = max_steps
+        self.steps = 0
+        # virtual time for priority scheduling
+        self.pass_value = 0
+        self.parked = False
+        # timer handle that wakes a guest parked until its timer interrupt
+        self.timer = None
+        self.input_closed = False
+        # task copying the input stream into the machine, if there is one
+        self.pump = None
+        # future for the final RunResult
+        self.result = result
+
+
+class Scheduler:
+    """
+    Runs machines a quantum of instructions at a time, round-robin or
+    weighted by priority. A machine spinning until an interrupt is parked,
+    and costs nothing until its timer is due or input arrives for it.
+    """
+
+    def __init__(self, quantum=POLL_INTERVAL, policy=ROUND_ROBIN):
+        self.quantum = quantum
+        self.policy = policy
+        self.guests = {}
+        # results of finished guests, kept until collected with result(),
+        # oldest first
+        self.finished = {}
+        # guests ready to run: a deque for round-robin, a heap of
+        # (pass value, sequence, guest) for priority
+        self.ready = deque() if policy == ROUND_ROBIN else []
+        self.sequence = itertools.count()
+        self.next_id = itertools.count(1)
+        # virtual time of the last guest run, so new and woken guests
+        # don't starve everyone else
+        self.clock = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        """Start the scheduling loop as a task on the running event loop."""
+
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.loop())
+
+        return self.task
+
+    async def close(self):
+        """Stop the scheduling loop and cancel every machine."""
+
+        for guest_id in list(self.guests):
+            await self.cancel(guest_id)
+
+        if self.task is not None:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+            self.task = None
+
+    async def submit(self, cpu, priority=1, input=None, max_steps=None):
+        """
+        Add a loaded CPU to the pool and return its guest id. Bytes read
+        from input, an asyncio.StreamReader, become key presses.
+        """
+
+        self.start()
+
+        # hand idle machines back instead of letting them sleep in run()
+        cpu.idle_policy = IDLE_RETURN
+
+        guest = Guest(next(self.next_id), cpu, priority, max_steps,
+                      asyncio.get_running_loop().create_future())
+        self.guests[guest.id] = guest
+
+        if input is not None:
+            guest.pump = asyncio.get_running_loop().create_task(
+                self.pump(guest, input))
+
+        self.make_ready(guest)
+
+        return guest.id
+
+    async def feed(self, guest_id, data):
+        """Send key presses to a machine, waking it if it's parked."""
+
+        guest = self.guests.get(guest_id)
+        if guest is None:
+            raise KeyError(guest_id)
+
+        guest.cpu.feed_keys(data)
+        self.unpark(guest)
+
+    async def cancel(self, guest_id):
+        """
+        Stop a machine and return True, or False if it had already
+        finished.
+        """
+
+        guest = self.guests.get(guest_id)
+        if guest is None:
+            return False
+
+        self.finish(guest, RunResult(CANCELLED, guest.steps,
+                                     guest.cpu.program_counter))
+
+        return True
+
+    async def result(self, guest_id):
+        """Wait for a machine to finish and return its RunResult."""
+
+        if guest_id in self.finished:
+            return self.finished.pop(guest_id)
+
+        guest = self.guests.get(guest_id)
+        if guest is None:
+            raise KeyError(guest_id)
+
+        result = await asyncio.shield(guest.result)
+        self.finished.pop(guest_id, None)
+
+        return result
+
+    def make_ready(self, guest):
+        guest.parked = False
+
+        if self.policy == ROUND_ROBIN:
+            self.ready.append(guest)
+        else:
+            guest.pass_value = max(guest.pass_value, self.clock)
+            heapq.heappush(self.ready,
+                           (guest.pass_value, next(self.sequence), guest))
+
+        self.wakeup.set()
+
+    def park(self, guest):
+        """
+        Park a guest that's spinning until an interrupt, until its timer is
+        due or a key press arrives, or finish it if nothing can wake it.
+        """
+
+        cpu = guest.cpu
+        deadline, keyboard = cpu.wake_sources()
+
+        if keyboard and cpu.pending_keys:
+            self.make_ready(guest)
+            return
+
+        if deadline is None and (not keyboard or guest.input_closed):
+            status = INPUT_CLOSED if keyboard else IDLE
+            self.finish(guest, RunResult(status, guest.steps,
+                                         cpu.program_counter))
+            return
+
+        guest.parked = True
+
+        if deadline is not None:
+            guest.timer = asyncio.get_running_loop().call_later(
+                max(deadline - time.monotonic(), 0), self.unpark, guest)
+
+    def unpark(self, guest):
+        if guest.timer is not None:
+            guest.timer.cancel()
+            guest.timer = None
+
+        if guest.parked and guest.id in self.guests:
+            self.make_ready(guest)
+
+    def next_guest(self):
+        """Take the next guest to run off the ready queue, or None."""
+
+        while self.ready:
+            if self.policy == ROUND_ROBIN:
+                guest = self.ready.popleft()
+            else:
+                guest = heapq.heappop(self.ready)[2]
+
+            # cancelled guests are left in the queue and skipped here
+            if guest.id in self.guests:
+                return guest
+
+        return None
+
+    def finish(self, guest, result):
+        del self.guests[guest.id]
+        guest.cpu.running = False
+
+        try:
+            guest.cpu.output.flush()
+        except Exception as e:
+            result = RunResult(CRASHED, result.steps, result.pc, e)
+
+        if guest.timer is not None:
+            guest.timer.cancel()
+
+        if guest.pump is not None:
+            guest.pump.cancel()
+
+        if not guest.result.done():
+            guest.result.set_result(result)
+            self.finished[guest.id] = result
+
+            # nobody may ever ask for a result, so only keep the latest
+            if len(self.finished) > MAX_FINISHED:
+                del self.finished[next(iter(self.finished))]
+
+    async def pump(self, guest, reader):
+        """Copy bytes from reader into a machine as key presses."""
+
+        while True:
+            data = await reader.read(4096)
+
+            if not data:
+                break
+
+            guest.cpu.feed_keys(data)
+            self.unpark(guest)
+
+        guest.input_closed = True
+
+        # nothing can wake a machine parked on input now
+        if guest.parked and guest.timer is None and guest.id in self.guests:
+            self.finish(guest, RunResult(INPUT_CLOSED, guest.steps,
+                                         guest.cpu.program_counter))
+
+    def run_quantum(self, guest):
+        """Run one quantum of a guest and put it back where it belongs."""
+
+        cpu = guest.cpu
+        budget = self.quantum
+
+        if guest.max_steps is not None:
+            budget = min(budget, guest.max_steps - guest.steps)
+
+        result = cpu.run(max_steps=budget)
+        guest.steps += result.steps
+
+        # give up the CPU in proportion to the time used
+        guest.pass_value += max(result.steps, 1) / guest.priority
+        self.clock = guest.pass_value
+
+        if result.status == IDLE:
+            self.park(guest)
+
+        elif result.status != BUDGET_EXHAUSTED:
+            result.steps = guest.steps
+            self.finish(guest, result)
+
+        elif guest.max_steps is not None and guest.steps >= guest.max_steps:
+            result.steps = guest.steps
+            self.finish(guest, result)
+
+        else:
+            self.make_ready(guest)
+
+    async def loop(self):
+        """Run ready guests until cancelled, sleeping while all are parked."""
+
+        while True:
+            guest = self.next_guest()
+
+            if guest is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            try:
+                self.run_quantum(guest)
+            except Exception as e:
+                # one machine going wrong doesn't stop the others
+                if guest.id in self.guests:
+                    self.finish(guest, RunResult(CRASHED, guest.steps,
+                                                 guest.cpu.program_counter, e))
+
+            # let input and callers in between quanta
+            await asyncio.sleep(0)
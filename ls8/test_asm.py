@@ -0,0 +1,194 @@
+"""Tests for the assembler, checked by running its output on the CPU."""
+
+import glob
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from cpu import *
+from programs import asm
+
+ASM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "asm")
+
+SOURCES = sorted(glob.glob(os.path.join(ASM, "*.asm")))
+
+# enough for every example to halt or settle
+MAX_STEPS = 20000
+
+# source -> the optimizer rewrite it has to make, one for each pass
+REWRITES = {
+    # optimize_jumps
+    "LDI R0,First\nJMP R0\nFirst:\nLDI R0,Second\nJMP R0\nSecond:\n"
+    "LDI R1,1\nPRN R1\nHLT": "jump chains",
+    "LDI R1,1\nLDI R0,Next\nJMP R0\nNext:\nPRN R1\nHLT": "jumps to next",
+    # optimize_dead_code
+    "LDI R0,1\nPRN R0\nHLT\nPRN R0\nHLT": "dead code",
+    # optimize_stack
+    "LDI R0,3\nPUSH R0\nPOP R0\nPRN R0\nHLT": "push/pop pairs",
+    # optimize_constants
+    "LDI R0,3\nPRN R0\nLDI R0,3\nPRN R0\nHLT": "redundant LDI",
+    "LDI R0,3\nLDI R1,4\nMUL R0,R1\nLDI R1,0\nPRN R0\nHLT":
+        "multiplies to shifts",
+}
+
+
+def assemble(source, optimizing=False):
+    """
+    Assemble source with pass 1 and pass 2, like asm.py does for a .ls8b
+    file with -O or -D. Returns the image and the optimizer's report.
+    """
+
+    sym = {}
+    code = []
+    asm.pass1(io.StringIO(source), sym, code)
+    report = None
+
+    if optimizing:
+        sym, code, report = asm.optimize(code)
+
+    f = io.BytesIO()
+    asm.pass2_image(f, sym, code)
+
+    return f.getvalue(), report
+
+
+def assemble_streaming(filename):
+    """Assemble filename in one pass, like asm.py does for a .ls8b file."""
+
+    with open(filename) as f:
+        machine_code, sym = asm.assemble_stream(
+            f, base=os.path.dirname(filename))
+
+    f = io.BytesIO()
+    asm.write_image(f, sym, machine_code)
+
+    return f.getvalue()
+
+
+def run_image(image):
+    """Run an image without the timer. Returns the status and output."""
+
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    cpu.idle_policy = None
+    cpu.next_timer = float("inf")
+    cpu.load(image)
+    result = cpu.run(max_steps=MAX_STEPS)
+
+    return result.status, cpu.output.getvalue()
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+class OptimizerTest(unittest.TestCase):
+    def test_examples(self):
+        for filename in SOURCES:
+            with self.subTest(source=os.path.basename(filename)):
+                source = read(filename)
+                plain, _ = assemble(source)
+                optimized, report = assemble(source, True)
+
+                self.assertLessEqual(report["after"]["bytes"],
+                                     report["before"]["bytes"])
+                self.assertEqual(run_image(optimized), run_image(plain))
+
+    def test_rewrites(self):
+        for source, rewrite in REWRITES.items():
+            with self.subTest(rewrite=rewrite):
+                plain, _ = assemble(source)
+                optimized, report = assemble(source, True)
+
+                self.assertGreater(report["rewrites"][rewrite], 0)
+                before, after = report["before"], report["after"]
+                self.assertLess((after["bytes"], after["cycles"]),
+                                (before["bytes"], before["cycles"]))
+                self.assertEqual(run_image(optimized), run_image(plain))
+                self.assertEqual(run_image(plain)[0], HALTED)
+
+
+class StreamingTest(unittest.TestCase):
+    def test_same_image_as_two_passes(self):
+        for filename in SOURCES:
+            with self.subTest(source=os.path.basename(filename)):
+                image, _ = assemble(read(filename))
+                self.assertEqual(assemble_streaming(filename), image)
+
+
+# a build tree: two programs sharing an included subroutine, and one on its
+# own
+BUILD_SOURCES = {
+    "first.asm": 'LDI R0,1\nLDI R1,Print\nCALL R1\nHLT\n'
+                 '.include "lib/print.asm"\n',
+    "second.asm": 'LDI R0,2\nLDI R1,Print\nCALL R1\nHLT\n'
+                  '.include "lib/print.asm"\n',
+    "third.asm": "LDI R0,3\nPRN R0\nHLT\n",
+    "lib/print.asm": "Print:\nPRN R0\nRET\n",
+}
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.srcdir = os.path.join(directory.name, "src")
+        self.outdir = os.path.join(directory.name, "out")
+        os.makedirs(os.path.join(self.srcdir, "lib"))
+
+        for name, source in BUILD_SOURCES.items():
+            self.write(name, source)
+
+    def write(self, name, source):
+        with open(os.path.join(self.srcdir, name), "w") as f:
+            f.write(source)
+
+    def build(self):
+        """Run build.py. Returns (units assembled, programs written)."""
+
+        process = subprocess.run(
+            [sys.executable, os.path.join(ASM, "build.py"), self.srcdir,
+             self.outdir, "-j", "2"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            timeout=60, check=True)
+
+        assembled = re.search(r"assembled (\d+) of 4 units", process.stderr)
+        written = re.search(r"wrote (\d+) of 3 programs", process.stderr)
+
+        return int(assembled.group(1)), int(written.group(1))
+
+    def run_program(self, name):
+        cpu = CPU()
+        cpu.set_output(CaptureOutput())
+        cpu.load(os.path.join(self.outdir, name))
+        cpu.run(max_steps=MAX_STEPS)
+
+        return cpu.output.getvalue()
+
+    def test_incremental(self):
+        self.assertEqual(self.build(), (4, 3))
+        self.assertEqual(self.run_program("first.ls8"), b"1\n")
+
+        # nothing changed
+        self.assertEqual(self.build(), (0, 0))
+
+        # only the included unit is assembled again, and only the programs
+        # that include it change
+        self.write("lib/print.asm", "Print:\nPRN R0\nPRN R0\nRET\n")
+        self.assertEqual(self.build(), (1, 2))
+        self.assertEqual(self.run_program("first.ls8"), b"1\n1\n")
+        self.assertEqual(self.run_program("second.ls8"), b"2\n2\n")
+        self.assertEqual(self.run_program("third.ls8"), b"3\n")
+
+        # the cache still has the old unit
+        self.write("lib/print.asm", "Print:\nPRN R0\nRET\n")
+        self.assertEqual(self.build(), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Tests for the batch runner's jobs."""
+
+import os
+import unittest
+
+from batch import run_job
+from cpu import *
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "examples")
+
+
+class RunJobTest(unittest.TestCase):
+    def test_timer_wakes_idle_program(self):
+        program = os.path.join(EXAMPLES, "interrupts.ls8")
+        result = run_job((program, None, None, 5000))
+
+        self.assertEqual(result["status"], BUDGET_EXHAUSTED)
+        self.assertEqual(result["steps"], 5000)
+        self.assertIsNone(result["error"])
+        self.assertTrue(result["output"])
+        self.assertEqual(set("".join(result["output"])), {"A"})
+
+    def test_idle_without_wake_source(self):
+        program = os.path.join(EXAMPLES, "keyboard.ls8")
+        result = run_job((program, None, None, 5000))
+
+        self.assertEqual(result["status"], IDLE)
+        self.assertIsNone(result["error"])
+
+    def test_seed(self):
+        program = os.path.join(EXAMPLES, "print8.ls8")
+        result = run_job((program, 0, {"registers": {"3": 300},
+                                       "ram": {"200": 7}}, None))
+
+        self.assertEqual(result["status"], HALTED)
+        self.assertEqual(result["registers"][3], 300 & 0xff)
+        self.assertEqual(result["ram"][200], 7)
+
+    def test_invalid_seed(self):
+        program = os.path.join(EXAMPLES, "print8.ls8")
+
+        for seed in ({"registers": {"8": 1}}, {"registers": {"-1": 1}},
+                     {"ram": {"999": 1}}):
+            with self.subTest(seed=seed):
+                result = run_job((program, 0, seed, None))
+                self.assertIsNone(result["status"])
+                self.assertTrue(result["error"].startswith("Invalid seed"),
+                                result["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
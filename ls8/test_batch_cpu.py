@@ -0,0 +1,111 @@
+"""Tests for BatchCPU against CPU."""
+
+import glob
+import os
+import unittest
+
+import numpy as np
+
+from batch_cpu import BatchCPU
+from cpu import *
+
+EXAMPLES = sorted(glob.glob(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "*.ls8")))
+
+# lockstep steps to run, enough for every example to halt or settle
+STEPS = 5000
+
+# machine code, since the assembler rejects the faulting instructions
+FAULTS = [
+    [LDI, 0, 1, LDI, 1, 0, DIV, 0, 1, HLT],
+    [LDI, 0, 1, PRN, 0, ADD, 0, 9, HLT],
+    [LDI, 0, 1, PRN, 0, 0x3F, HLT],
+]
+
+
+# PUSH R7 and POP R7, which see the stack pointer change under them
+STACK_POINTER = [
+    [PUSH, 7, POP, 0, PRN, 0, HLT],
+    [LDI, 0, 80, PUSH, 0, POP, 7, PRN, 7, HLT],
+]
+
+
+def run_cpu(cpu, steps):
+    """
+    Step cpu the way BatchCPU steps a lane: no timer or keyboard, and
+    interrupts serviced right after INT and IRET.
+    """
+
+    cpu.set_output(CaptureOutput())
+    cpu.next_timer = float("inf")
+    running = True
+    fault = FAULT_NONE
+
+    for _ in range(steps):
+        cpu.running = True
+        try:
+            cpu.step()
+        except Fault as e:
+            fault = e.code
+            running = False
+            break
+
+        if not cpu.running:
+            running = False
+            break
+
+        if cpu.poll_now:
+            cpu.poll()
+
+    return running, fault
+
+
+class BatchCPUTest(unittest.TestCase):
+    def compare(self, cpus):
+        batch = BatchCPU(len(cpus))
+        for lane, cpu in enumerate(cpus):
+            batch.ram[lane] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+
+        batch.run(STEPS)
+
+        for lane, cpu in enumerate(cpus):
+            with self.subTest(lane=lane):
+                running, fault = run_cpu(cpu, STEPS)
+                self.assertEqual(bool(batch.running[lane]), running)
+                self.assertEqual(int(batch.fault[lane]), fault)
+                self.assertEqual(int(batch.program_counter[lane]),
+                                 cpu.program_counter)
+                self.assertEqual(bytes(batch.register[lane]),
+                                 bytes(cpu.register))
+                self.assertEqual(int(batch.flag[lane]), cpu.flag)
+                self.assertEqual(bytes(batch.ram[lane]), bytes(cpu.ram))
+                self.assertEqual(bytes(batch.output[lane]),
+                                 cpu.output.getvalue())
+
+    def test_examples(self):
+        cpus = []
+        for filename in EXAMPLES:
+            cpu = CPU()
+            cpu.load(filename)
+            cpus.append(cpu)
+
+        self.compare(cpus)
+
+    def compare_code(self, programs):
+        cpus = []
+        for code in programs:
+            cpu = CPU()
+            cpu.ram[:len(code)] = bytes(code)
+            cpus.append(cpu)
+
+        self.compare(cpus)
+
+    def test_faults(self):
+        self.compare_code(FAULTS)
+
+    def test_stack_pointer(self):
+        self.compare_code(STACK_POINTER)
+
+
+if __name__ == "__main__":
+    unittest.main()
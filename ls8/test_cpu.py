@@ -0,0 +1,415 @@
+"""Tests for the CPU's execution engines and loaders."""
+
+import glob
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from cpu import *
+import programs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, "examples")
+EXAMPLES_LS8 = sorted(glob.glob(os.path.join(EXAMPLES, "*.ls8")))
+
+# IRET back to Check with 0xFF in the flag, then take LDI+Jcc and CMP+Jcc
+# pairs that run() fuses and looks up by flag value
+IRET_GARBAGE_FLAG = """
+LDI R0,Check
+PUSH R0
+LDI R0,0xFF
+PUSH R0
+LDI R0,0
+PUSH R0
+PUSH R0
+PUSH R0
+PUSH R0
+PUSH R0
+PUSH R0
+PUSH R0
+IRET
+
+Check:
+LDI R1,Equal
+CheckJump:
+JEQ R1
+HLT
+
+Equal:
+PRN R1
+LDI R2,1
+CMP R2,R2
+LDI R3,Done
+EqualJump:
+JNE R3
+PRN R2
+
+Done:
+HLT
+"""
+
+
+ENGINES = ("step", "run", "blocks")
+
+
+def run_engine(source, engine, targets=None):
+    cpu = CPU()
+    program = programs.assemble(source)
+    program.load(cpu)
+
+    # label -> label of each jump to prelink, for the step() loop
+    if targets is not None:
+        symbols = program.symbols
+        cpu.prelink({symbols[jump]: symbols[target]
+                     for jump, target in targets.items()})
+
+    status, _ = run_cpu(cpu, engine)
+    return status, cpu.output.getvalue(), bytes(cpu.register), cpu.flag
+
+
+def run_cpu(cpu, engine):
+    """
+    Run cpu to the end with engine, without the timer or idle sleeps.
+    Returns the status and the fault code.
+    """
+
+    cpu.set_output(CaptureOutput())
+    cpu.idle_policy = None
+    cpu.next_timer = float("inf")
+
+    if engine == "step":
+        cpu.running = True
+
+        try:
+            while cpu.running:
+                cpu.step()
+
+                if cpu.poll_now:
+                    cpu.poll()
+        except Fault as fault:
+            return FAULTED, fault.code
+
+        return HALTED, FAULT_NONE
+
+    if engine == "blocks":
+        result = cpu.run_blocks()
+    else:
+        result = cpu.run(max_steps=10000)
+
+    if result.fault is not None:
+        return result.status, result.fault.code
+
+    return result.status, FAULT_NONE
+
+
+class JumpFlagTest(unittest.TestCase):
+    def test_iret_garbage_flag(self):
+        expected = run_engine(IRET_GARBAGE_FLAG, "step")
+        self.assertEqual(expected[0], HALTED)
+
+        for engine in ENGINES[1:]:
+            with self.subTest(engine=engine):
+                self.assertEqual(run_engine(IRET_GARBAGE_FLAG, engine),
+                                 expected)
+
+        targets = {"CHECKJUMP": "EQUAL", "EQUALJUMP": "DONE"}
+        self.assertEqual(run_engine(IRET_GARBAGE_FLAG, "step", targets),
+                         expected)
+
+
+# source -> output, one or more cases for every instruction
+INSTRUCTIONS = {
+    "NOP\nLDI R0,7\nPRN R0\nHLT": b"7\n",
+    # ALU results wrap around to 8 bits
+    "LDI R0,200\nLDI R1,100\nADD R0,R1\nPRN R0\nHLT": b"44\n",
+    "LDI R0,5\nLDI R1,10\nSUB R0,R1\nPRN R0\nHLT": b"251\n",
+    "LDI R0,20\nLDI R1,20\nMUL R0,R1\nPRN R0\nHLT": b"144\n",
+    "LDI R0,200\nLDI R1,7\nDIV R0,R1\nPRN R0\nHLT": b"28\n",
+    "LDI R0,200\nLDI R1,7\nMOD R0,R1\nPRN R0\nHLT": b"4\n",
+    "LDI R0,255\nINC R0\nPRN R0\nHLT": b"0\n",
+    "LDI R0,0\nDEC R0\nPRN R0\nHLT": b"255\n",
+    "LDI R0,12\nLDI R1,10\nAND R0,R1\nPRN R0\nHLT": b"8\n",
+    "LDI R0,12\nLDI R1,10\nOR R0,R1\nPRN R0\nHLT": b"14\n",
+    "LDI R0,12\nLDI R1,10\nXOR R0,R1\nPRN R0\nHLT": b"6\n",
+    "LDI R0,15\nNOT R0\nPRN R0\nHLT": b"240\n",
+    "LDI R0,129\nLDI R1,1\nSHL R0,R1\nPRN R0\nHLT": b"2\n",
+    "LDI R0,129\nLDI R1,9\nSHL R0,R1\nPRN R0\nHLT": b"0\n",
+    "LDI R0,129\nLDI R1,1\nSHR R0,R1\nPRN R0\nHLT": b"64\n",
+    "LDI R0,129\nLDI R1,9\nSHR R0,R1\nPRN R0\nHLT": b"0\n",
+    "LDI R0,65\nPRA R0\nHLT": b"A",
+    "LDI R0,0x80\nLDI R1,42\nST R0,R1\nLD R2,R0\nPRN R2\nHLT": b"42\n",
+    "LDI R0,9\nPUSH R0\nLDI R0,1\nPOP R1\nPRN R1\nPRN R0\nHLT":
+        b"9\n1\n",
+    "LDI R0,Sub\nCALL R0\nPRN R1\nHLT\nSub:\nLDI R1,3\nRET": b"3\n",
+    "LDI R0,Done\nJMP R0\nPRN R0\nDone:\nHLT": b"",
+    # interrupt 2 through the vector at 0xFA
+    "LDI R0,0xFA\nLDI R1,Handler\nST R0,R1\nLDI R5,4\nLDI R0,2\n"
+    "INT R0\nPRN R0\nHLT\nHandler:\nLDI R0,9\nPRN R0\nIRET":
+        b"9\n2\n",
+}
+
+# conditional jump -> the flags it jumps on
+CONDITIONS = {
+    "JEQ": FLAG_EQUAL,
+    "JNE": FLAG_LESS | FLAG_GREATER,
+    "JGT": FLAG_GREATER,
+    "JLT": FLAG_LESS,
+    "JGE": FLAG_GREATER | FLAG_EQUAL,
+    "JLE": FLAG_LESS | FLAG_EQUAL,
+}
+
+# (a, b) -> the flag CMP sets
+COMPARISONS = {(1, 2): FLAG_LESS, (2, 1): FLAG_GREATER, (2, 2): FLAG_EQUAL}
+
+# (machine code, fault, faulting PC), the assembler won't write these
+FAULTS = [
+    ([LDI, 0, 1, LDI, 1, 0, DIV, 0, 1, HLT], FAULT_DIVIDE_BY_ZERO, 6),
+    ([LDI, 0, 1, LDI, 1, 0, MOD, 0, 1, HLT], FAULT_DIVIDE_BY_ZERO, 6),
+    ([LDI, 0, 1, ADD, 0, 9, HLT], FAULT_INVALID_REGISTER, 3),
+    ([LDI, 8, 1, HLT], FAULT_INVALID_REGISTER, 0),
+    ([PUSH, 8, HLT], FAULT_INVALID_REGISTER, 0),
+    ([LDI, 0, 1, 0x3F, HLT], FAULT_UNKNOWN_INSTRUCTION, 3),
+]
+
+
+class InstructionTest(unittest.TestCase):
+    """Every instruction on every engine."""
+
+    def run_source(self, source, engine):
+        cpu = CPU()
+        programs.assemble(source).load(cpu)
+        status, fault = run_cpu(cpu, engine)
+        self.assertEqual((status, fault), (HALTED, FAULT_NONE))
+
+        return cpu
+
+    def test_instructions(self):
+        for source, output in INSTRUCTIONS.items():
+            for engine in ENGINES:
+                with self.subTest(source=source, engine=engine):
+                    cpu = self.run_source(source, engine)
+                    self.assertEqual(cpu.output.getvalue(), output)
+
+    def test_store(self):
+        for engine in ENGINES:
+            with self.subTest(engine=engine):
+                cpu = self.run_source(
+                    "LDI R0,0x80\nLDI R1,42\nST R0,R1\nHLT", engine)
+                self.assertEqual(cpu.ram[0x80], 42)
+
+    def test_compare(self):
+        for (a, b), flag in COMPARISONS.items():
+            source = f"LDI R0,{a}\nLDI R1,{b}\nCMP R0,R1\nHLT"
+
+            for engine in ENGINES:
+                with self.subTest(a=a, b=b, engine=engine):
+                    self.assertEqual(self.run_source(source, engine).flag,
+                                     flag)
+
+    def test_conditional_jumps(self):
+        for name, flags in CONDITIONS.items():
+            for (a, b), flag in COMPARISONS.items():
+                source = (f"LDI R0,{a}\nLDI R1,{b}\nLDI R2,Taken\n"
+                          f"CMP R0,R1\n{name} R2\nPRN R0\nHLT\n"
+                          f"Taken:\nPRN R1\nHLT")
+                expected = b"%d\n" % (b if flag & flags else a)
+
+                for engine in ENGINES:
+                    with self.subTest(jump=name, a=a, b=b, engine=engine):
+                        cpu = self.run_source(source, engine)
+                        self.assertEqual(cpu.output.getvalue(), expected)
+
+    def test_faults(self):
+        for code, fault, pc in FAULTS:
+            for engine in ENGINES:
+                with self.subTest(code=code, engine=engine):
+                    cpu = CPU()
+                    cpu.ram[:len(code)] = bytes(code)
+                    self.assertEqual(run_cpu(cpu, engine), (FAULTED, fault))
+                    # the PC stays on the faulting instruction
+                    self.assertEqual(cpu.program_counter, pc)
+
+
+# Square R0 into R1 ten times, through a subroutine with a stack frame
+MEMO_SQUARE = """
+LDI R3,Square
+LDI R4,10
+Loop:
+LDI R0,3
+CALL R3
+PRN R1
+DEC R4
+LDI R2,0
+CMP R4,R2
+LDI R2,Loop
+JNE R2
+HLT
+
+Square:
+PUSH R2
+LDI R2,0
+ADD R2,R0
+MUL R2,R0
+LDI R1,0
+ADD R1,R2
+POP R2
+RET
+"""
+
+# Call a subroutine twice, then write over the value it loads
+MEMO_CODE_WRITE = """
+LDI R3,Seven
+CALL R3
+PRN R1
+CALL R3
+PRN R1
+LDI R0,Seven
+INC R0
+INC R0
+LDI R2,8
+ST R0,R2
+CALL R3
+PRN R1
+HLT
+
+Seven:
+LDI R1,7
+RET
+"""
+
+# Call a subroutine that loads from RAM, before and after writing it
+MEMO_RAM_READ = """
+LDI R3,Load
+LDI R0,0x80
+CALL R3
+PRN R1
+LDI R2,5
+ST R0,R2
+CALL R3
+PRN R1
+HLT
+
+Load:
+LD R1,R0
+RET
+"""
+
+
+def run_memo(source, memoize):
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    cpu.idle_policy = None
+
+    if memoize:
+        cpu.enable_memoization()
+
+    programs.assemble(source).load(cpu)
+    result = cpu.run()
+
+    return cpu, result
+
+
+class MemoTest(unittest.TestCase):
+    def test_hit(self):
+        plain, plain_result = run_memo(MEMO_SQUARE, False)
+        cpu, result = run_memo(MEMO_SQUARE, True)
+
+        self.assertEqual(cpu.output.getvalue(), b"9\n" * 10)
+        self.assertEqual(cpu.output.getvalue(), plain.output.getvalue())
+        self.assertEqual(bytes(cpu.register), bytes(plain.register))
+        self.assertEqual(bytes(cpu.ram), bytes(plain.ram))
+        self.assertEqual(cpu.flag, plain.flag)
+
+        # R2, which it pushes, only holds Loop from the second call on
+        self.assertEqual(cpu.memo.hits, 8)
+        self.assertEqual(result.steps + cpu.memo.saved, plain_result.steps)
+
+    def test_code_write_invalidates(self):
+        cpu, _ = run_memo(MEMO_CODE_WRITE, True)
+
+        self.assertEqual(cpu.output.getvalue(), b"7\n7\n8\n")
+        self.assertEqual(cpu.memo.hits, 1)
+
+    def test_ram_read_not_memoized(self):
+        cpu, _ = run_memo(MEMO_RAM_READ, True)
+
+        self.assertEqual(cpu.output.getvalue(), b"0\n5\n")
+        self.assertEqual(cpu.memo.hits, 0)
+        self.assertIn("reads memory", cpu.memo.skipped.values())
+
+    def test_command_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "square.asm")
+            with open(source, "w") as f:
+                f.write(MEMO_SQUARE)
+
+            # interrupts.ls8 never halts
+            for program in [source] + [
+                    filename for filename in EXAMPLES_LS8
+                    if not filename.endswith("interrupts.ls8")]:
+                with self.subTest(program=program):
+                    plain = run_ls8(program)
+                    memoized = run_ls8(program, "--memoize")
+                    self.assertEqual(memoized.stdout, plain.stdout)
+                    self.assertEqual(memoized.returncode, plain.returncode)
+
+
+def run_ls8(*args):
+    return subprocess.run(
+        [sys.executable, os.path.join(HERE, "ls8.py")] + list(args),
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, timeout=60)
+
+
+class IdleTest(unittest.TestCase):
+    def test_budget_sleeps_through_spin_loop(self):
+        cpu = CPU()
+        cpu.load(os.path.join(EXAMPLES, "interrupts.ls8"))
+        cpu.set_output(CaptureOutput())
+
+        # the timer first fires a second in, after about IDLE_STEP_RATE
+        # steps of sleeping
+        max_steps = IDLE_STEP_RATE * 3 // 2
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        result = cpu.run(max_steps=max_steps)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual((result.status, result.steps),
+                         (BUDGET_EXHAUSTED, max_steps))
+        self.assertEqual(cpu.output.getvalue(), b"A")
+        self.assertGreater(elapsed, 1)
+        self.assertLess(time.process_time() - cpu_start, elapsed / 4)
+
+
+class ImageTest(unittest.TestCase):
+    def setUp(self):
+        program = programs.assemble(IRET_GARBAGE_FLAG)
+        f = io.BytesIO()
+        programs.asm.write_image(f, program.symbols, program.code)
+        self.image = f.getvalue()
+        self.symbols = program.symbols
+
+    def test_load(self):
+        cpu = CPU()
+        cpu.load(self.image)
+        self.assertEqual(cpu.symbols, self.symbols)
+
+    def test_truncated_symbols(self):
+        # cut inside a symbol's header, then inside its name
+        for end in (len(self.image) - len("DONE") - 1, len(self.image) - 1):
+            with self.subTest(end=end):
+                with self.assertRaises(LoadError):
+                    CPU().load(self.image[:end])
+
+    def test_corrupt_symbols(self):
+        with self.assertRaises(LoadError):
+            CPU().load(self.image[:-1] + b"X")
+
+
+if __name__ == "__main__":
+    unittest.main()
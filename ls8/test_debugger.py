@@ -0,0 +1,108 @@
+"""Tests for the debugger's reverse execution."""
+
+import unittest
+
+from cpu import *
+from debugger import Debugger, START_OF_HISTORY
+import programs
+
+# writes RAM, the stack and every register but R4-R6, forever
+LOOP = """
+LDI R0,0
+LDI R3,Loop
+Loop:
+INC R0
+LDI R1,0x3F
+AND R1,R0
+LDI R2,0x80
+ADD R1,R2
+ST R1,R0
+PUSH R0
+POP R2
+CMP R2,R1
+JMP R3
+"""
+
+STEPS = 3000
+
+SNAPSHOT_INTERVAL = 64
+
+MAX_HISTORY = 500
+
+# steps to go back and forth to, in this order
+TARGETS = [2999, 2600, 2512, 2513, 2703, 2999, 2544, 3100, 2700, 2650, 3100]
+
+
+def load():
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    cpu.idle_policy = None
+    cpu.next_timer = float("inf")
+    programs.assemble(LOOP).load(cpu)
+    return cpu
+
+
+def state(cpu):
+    return (cpu.program_counter, cpu.flag, bytes(cpu.register),
+            bytes(cpu.ram))
+
+
+def rerun(steps):
+    """The state before instruction steps, from a fresh run."""
+
+    cpu = load()
+    if steps:
+        cpu.run(max_steps=steps)
+    return state(cpu)
+
+
+class GotoTest(unittest.TestCase):
+    def setUp(self):
+        self.debugger = Debugger(load(), SNAPSHOT_INTERVAL, MAX_HISTORY)
+
+    def check(self, step):
+        self.assertEqual(self.debugger.steps, step)
+        self.assertEqual(state(self.debugger.cpu), rerun(step))
+
+    def test_goto(self):
+        debugger = self.debugger
+
+        for step in (1, 50, 700, STEPS):
+            debugger.forward(step - debugger.steps)
+            self.check(step)
+
+        # the start of the run is long gone
+        first_step = debugger.first_step
+        self.assertGreater(first_step, 0)
+        self.assertFalse(debugger.goto(first_step - 1))
+        self.check(STEPS)
+
+        for step in TARGETS:
+            with self.subTest(step=step):
+                self.assertTrue(debugger.goto(step))
+                self.check(step)
+
+        # running forward again trims the history again
+        self.assertGreater(debugger.first_step, first_step)
+        self.assertTrue(debugger.goto(debugger.first_step))
+        self.check(debugger.first_step)
+
+    def test_reverse(self):
+        debugger = self.debugger
+        debugger.forward(STEPS)
+        first_step = debugger.first_step
+
+        result = debugger.reverse(100)
+        self.assertEqual(result.steps, 100)
+        self.check(STEPS - 100)
+
+        result = debugger.reverse()
+        self.assertEqual(result.status, START_OF_HISTORY)
+        self.check(first_step)
+
+        debugger.forward(STEPS - first_step)
+        self.check(STEPS)
+
+
+if __name__ == "__main__":
+    unittest.main()
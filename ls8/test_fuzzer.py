@@ -0,0 +1,113 @@
+"""Tests for the fuzzer."""
+
+import os
+import unittest
+
+from cpu import *
+from fuzzer import *
+import programs
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# divides by zero when R0 starts out as 0x80
+DIVIDE = """
+LDI R2,0x80
+CMP R0,R2
+LDI R2,Done
+JNE R2
+LDI R3,0
+DIV R0,R3
+Done:
+HLT
+"""
+
+# address of the DIV
+DIVIDE_PC = 14
+
+# moves its stack into the gap between the code and a table on purpose
+RELOCATED_STACK = """
+LDI R7,Stack
+LDI R0,5
+PUSH R0
+PUSH R0
+POP R1
+POP R1
+LDI R2,Table
+LD R3,R2
+PRN R3
+HLT
+DB 0
+DB 0
+DB 0
+DB 0
+Stack:
+Table:
+DB 7
+"""
+
+
+def fuzzer(source=None, example=None, **kwargs):
+    cpu = CPU()
+
+    if source is not None:
+        programs.assemble(source).load(cpu)
+    else:
+        cpu.load(os.path.join(EXAMPLES, example))
+
+    return Fuzzer(cpu, **kwargs)
+
+
+class FuzzerTest(unittest.TestCase):
+    def test_crash_found_and_minimized(self):
+        f = fuzzer(DIVIDE, seed=1)
+        # a seed close to crashing, with bytes that don't matter set
+        f.add_seeds([bytes([0x81, 9, 9, 9, 9, 0, 0, 9])])
+        f.fuzz(executions=20000)
+
+        self.assertEqual(list(f.crashes), [("DivideByZero", DIVIDE_PC)])
+        data, fault = f.crashes["DivideByZero", DIVIDE_PC]
+        self.assertEqual(fault.code, FAULT_DIVIDE_BY_ZERO)
+
+        # nothing but R0 matters
+        self.assertEqual(data, bytes([0x80]) + bytes(f.input_size - 1))
+
+    def test_stack_overflow(self):
+        f = fuzzer(example="stackoverflow.ls8")
+        status, fault, _ = f.execute(f.initial_input())
+
+        self.assertEqual(status, FAULTED)
+        self.assertIsInstance(fault, StackOverflow)
+
+    def test_relocated_stack(self):
+        f = fuzzer(RELOCATED_STACK)
+        status, fault, _ = f.execute(f.initial_input())
+
+        self.assertEqual((status, fault), (HALTED, None))
+        self.assertEqual(f.cpu.output.getvalue(), b"7\n")
+
+    def test_key_press(self):
+        f = fuzzer(example="keyboard.ls8")
+        data = bytearray(f.initial_input())
+        data[INPUT_KEY] = ord("x")
+        status, fault, _ = f.execute(bytes(data))
+
+        # echoed, then idle with nothing left to wake it
+        self.assertEqual(status, IDLE)
+        self.assertEqual(f.cpu.output.getvalue(), b"x")
+
+        f.fuzz(executions=256)
+        self.assertEqual(f.hangs, 0)
+
+    def test_timer(self):
+        f = fuzzer(example="interrupts.ls8")
+        status, fault, _ = f.execute(f.initial_input())
+
+        # one interrupt every FUZZ_POLL_INTERVAL instructions, spin loop
+        # or not
+        self.assertEqual(status, BUDGET_EXHAUSTED)
+        self.assertEqual(f.cpu.output.getvalue(),
+                         b"A" * (FUZZ_MAX_STEPS // FUZZ_POLL_INTERVAL))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Tests for assembling programs in-process."""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from cpu import *
+import programs
+from programs import ProgramCache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SOURCES = {name: f"LDI R0,{value}\nPRN R0\nHLT\n"
+           for name, value in (("a", 1), ("b", 2), ("c", 3))}
+
+
+class ProgramCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = ProgramCache(maxsize=2)
+        a = cache.assemble(SOURCES["a"])
+        cache.assemble(SOURCES["b"])
+
+        # a hit makes a the most recently used, so b goes first
+        self.assertIs(cache.assemble(SOURCES["a"]), a)
+        cache.assemble(SOURCES["c"])
+        self.assertEqual(len(cache.programs), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        self.assertIs(cache.assemble(SOURCES["a"]), a)
+        cache.assemble(SOURCES["b"])
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_includes_not_cached(self):
+        cache = ProgramCache()
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "lib.asm"), "w") as f:
+                f.write("Value:\nDB 7\n")
+
+            source = 'LDI R0,Value\nLD R0,R0\nPRN R0\nHLT\n.include "lib.asm"\n'
+            cache.assemble(source, directory)
+            cache.assemble(source, directory)
+
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(len(cache.programs), 0)
+
+    def test_program(self):
+        cpu, result = programs.run_source(SOURCES["b"])
+
+        self.assertEqual(result.status, HALTED)
+        self.assertEqual(cpu.output.getvalue(), b"2\n")
+
+
+class LoadErrorTest(unittest.TestCase):
+    def test_unknown_opcode(self):
+        with self.assertRaises(LoadError) as context:
+            ProgramCache().assemble("FOO R0\n")
+
+        self.assertEqual(str(context.exception), "Line 1: unknown opcode FOO")
+        self.assertNotEqual(context.exception.code, 0)
+
+    def test_unknown_symbol(self):
+        with self.assertRaises(LoadError) as context:
+            ProgramCache().assemble("LDI R0,Nowhere\nHLT\n")
+
+        self.assertIn("NOWHERE", str(context.exception))
+
+    def test_failures_not_cached(self):
+        cache = ProgramCache()
+
+        for _ in range(2):
+            with self.assertRaises(LoadError):
+                cache.assemble("FOO R0\n")
+
+        self.assertEqual(len(cache.programs), 0)
+
+    def test_missing_file(self):
+        with self.assertRaises(LoadError) as context:
+            programs.assemble_file(os.path.join(HERE, "missing.asm"))
+
+        self.assertEqual(context.exception.code, 2)
+
+
+class ImportTest(unittest.TestCase):
+    def test_working_directory(self):
+        # an asm.py in the working directory comes first on sys.path
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "asm.py"), "w") as f:
+                f.write("raise ImportError('wrong asm')\n")
+
+            process = subprocess.run(
+                [sys.executable, "-c",
+                 f"import sys; sys.path.insert(1, {HERE!r}); "
+                 "import programs; print(programs.asm.__file__)"],
+                cwd=directory, stdout=subprocess.PIPE, text=True,
+                timeout=60, check=True)
+
+        self.assertEqual(
+            os.path.realpath(process.stdout.strip()),
+            os.path.realpath(os.path.join(HERE, "..", "asm", "asm.py")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+"""Tests for the asyncio scheduler."""
+
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from cpu import *
+import programs
+import scheduler
+from scheduler import *
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# 604 instructions and no interrupts
+COUNT_LOOP = """
+LDI R0,0
+LDI R1,Loop
+LDI R2,200
+Loop:
+INC R0
+CMP R0,R2
+JNE R1
+HLT
+"""
+
+STEPS = 604
+
+QUANTUM = 50
+
+
+class FailingOutput(CaptureOutput):
+    """Output sink that raises on the first write."""
+
+    def write(self, data):
+        raise OSError("sink is gone")
+
+
+def count_loop():
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    programs.assemble(COUNT_LOOP).load(cpu)
+    return cpu
+
+
+def keyboard():
+    cpu = CPU()
+    cpu.set_output(CaptureOutput())
+    cpu.load(os.path.join(EXAMPLES, "keyboard.ls8"))
+    return cpu
+
+
+async def settle(condition):
+    """Give the scheduler turns until condition() holds."""
+
+    for _ in range(10000):
+        if condition():
+            return
+        await asyncio.sleep(0)
+
+    raise AssertionError("scheduler never got there")
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class PolicyTest(unittest.TestCase):
+    async def race(self, policy):
+        """
+        Run two count loops, the second with three times the priority.
+        Returns the ids in the order they finished, and the steps the other
+        had run when the first finished.
+        """
+
+        pool = Scheduler(quantum=QUANTUM, policy=policy)
+        order = []
+        finish = pool.finish
+
+        def record(guest, result):
+            others = [g.steps for g in pool.guests.values() if g is not guest]
+            order.append((guest.id, others))
+            finish(guest, result)
+
+        pool.finish = record
+        first = await pool.submit(count_loop(), priority=1)
+        second = await pool.submit(count_loop(), priority=3)
+
+        for guest_id in (first, second):
+            result = await pool.result(guest_id)
+            self.assertEqual(result.status, HALTED)
+            self.assertEqual(result.steps, STEPS)
+
+        await pool.close()
+
+        (winner, others), (loser, _) = order
+        return (winner, loser), (first, second), others[0]
+
+    def test_round_robin(self):
+        order, ids, steps = run(self.race(ROUND_ROBIN))
+
+        # priority doesn't count, so they take turns and finish together
+        self.assertEqual(order, ids)
+        self.assertGreaterEqual(steps, STEPS - QUANTUM)
+
+    def test_priority(self):
+        order, ids, steps = run(self.race(PRIORITY))
+
+        # the second gets about three quanta for each of the first's
+        self.assertEqual(order, ids[::-1])
+        self.assertLess(steps, STEPS // 2)
+
+
+class GuestTest(unittest.TestCase):
+    def test_cancel(self):
+        async def main():
+            pool = Scheduler(quantum=QUANTUM)
+            guest_id = await pool.submit(keyboard())
+            await settle(lambda: pool.guests[guest_id].parked)
+
+            self.assertTrue(await pool.cancel(guest_id))
+            self.assertFalse(await pool.cancel(guest_id))
+            self.assertEqual((await pool.result(guest_id)).status, CANCELLED)
+            await pool.close()
+
+        run(main())
+
+    def test_parking(self):
+        async def main():
+            pool = Scheduler(quantum=QUANTUM)
+            cpu = keyboard()
+            guest_id = await pool.submit(cpu)
+            guest = pool.guests[guest_id]
+            await settle(lambda: guest.parked)
+
+            # parked guests don't run
+            steps = guest.steps
+            for _ in range(10):
+                await asyncio.sleep(0)
+            self.assertEqual(guest.steps, steps)
+
+            await pool.feed(guest_id, b"x")
+            await settle(lambda: cpu.output.getvalue() == b"x")
+            await settle(lambda: guest.parked)
+            self.assertGreater(guest.steps, steps)
+
+            await pool.close()
+
+        run(main())
+
+    def test_input_closed(self):
+        async def main():
+            pool = Scheduler(quantum=QUANTUM)
+            cpu = keyboard()
+            reader = asyncio.StreamReader()
+            guest_id = await pool.submit(cpu, input=reader)
+
+            reader.feed_data(b"hi")
+            reader.feed_eof()
+            result = await pool.result(guest_id)
+
+            self.assertEqual(result.status, INPUT_CLOSED)
+            self.assertEqual(cpu.output.getvalue(), b"hi")
+            await pool.close()
+
+        run(main())
+
+    def test_finished_results_capped(self):
+        async def main():
+            pool = Scheduler(quantum=QUANTUM)
+            ids = [await pool.submit(count_loop()) for _ in range(3)]
+            await settle(lambda: not pool.guests)
+
+            # nobody collected them, so the oldest is gone
+            with self.assertRaises(KeyError):
+                await pool.result(ids[0])
+
+            for guest_id in ids[1:]:
+                self.assertEqual((await pool.result(guest_id)).status, HALTED)
+
+            await pool.close()
+
+        with mock.patch.object(scheduler, "MAX_FINISHED", 2):
+            run(main())
+
+    def test_crash(self):
+        async def main():
+            pool = Scheduler(quantum=QUANTUM)
+            cpu = CPU()
+            cpu.set_output(FailingOutput())
+            programs.assemble(COUNT_LOOP.replace("HLT", "PRN R0\nHLT")).load(cpu)
+            crashing = await pool.submit(cpu)
+            other = await pool.submit(count_loop())
+
+            # without the fix the loop dies and this never returns
+            result = await asyncio.wait_for(pool.result(crashing), 5)
+            self.assertEqual(result.status, CRASHED)
+            self.assertIsInstance(result.fault, OSError)
+
+            # the others keep running
+            self.assertEqual((await pool.result(other)).status, HALTED)
+            await pool.close()
+
+        run(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+"""Tests for trace recording and replay."""
+
+import os
+import tempfile
+import unittest
+
+from cpu import *
+import programs
+from tracer import TraceReader, TraceRecorder
+
+# 604 instructions and no interrupts
+COUNT_LOOP = """
+LDI R0,0
+LDI R1,Loop
+LDI R2,200
+Loop:
+INC R0
+CMP R0,R2
+JNE R1
+HLT
+"""
+
+STEPS = 604
+
+# a subroutine with a stack frame, called with the same registers each time
+# and R1 cleared after each call, so a memo hit has to set it
+CALL_LOOP = """
+LDI R3,Double
+LDI R4,5
+Loop:
+LDI R0,3
+CALL R3
+PRN R1
+LDI R1,0
+DEC R4
+LDI R2,0
+CMP R4,R2
+LDI R2,Loop
+JNE R2
+HLT
+
+Double:
+PUSH R0
+ADD R0,R0
+LDI R1,0
+ADD R1,R0
+POP R0
+RET
+"""
+
+
+def load():
+    cpu = CPU()
+    programs.assemble(COUNT_LOOP).load(cpu)
+    return cpu
+
+
+class TraceRingTest(unittest.TestCase):
+    def record(self, max_blocks, cpu=None, steps=STEPS):
+        fd, filename = tempfile.mkstemp(suffix=".trace")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        with open(filename, "wb") as f:
+            recorder = TraceRecorder(f, block_size=256, max_blocks=max_blocks)
+            result = recorder.run(load() if cpu is None else cpu)
+
+        self.assertEqual((result.status, result.steps), (HALTED, steps))
+
+        return TraceReader(filename)
+
+    def test_blocks(self):
+        for max_blocks in (1, 2, 3):
+            with self.subTest(max_blocks=max_blocks):
+                reader = self.record(max_blocks)
+
+                # max_blocks blocks of records, then the final state
+                self.assertEqual(len(reader.blocks), max_blocks + 1)
+                self.assertEqual(reader.blocks[-1][:2], (STEPS, 0))
+
+                steps = [record.step for record in reader.records()
+                         if not record.poll]
+                self.assertTrue(steps)
+                self.assertEqual(steps, list(range(steps[0], STEPS)))
+
+    def test_state_at(self):
+        reader = self.record(2)
+        first = next(reader.records()).step
+        expected = load()
+
+        for step in range(STEPS + 1):
+            if step >= first:
+                with self.subTest(step=step):
+                    cpu = reader.state_at(step)
+                    self.assertEqual(cpu.program_counter,
+                                     expected.program_counter)
+                    self.assertEqual(bytes(cpu.register),
+                                     bytes(expected.register))
+                    self.assertEqual(cpu.flag, expected.flag)
+                    self.assertEqual(bytes(cpu.ram), bytes(expected.ram))
+
+            if step < STEPS:
+                expected.step()
+
+        self.assertIsNone(reader.state_at(first - 1))
+
+
+    def test_memoized_calls(self):
+        plain = CPU()
+        plain.set_output(CaptureOutput())
+        programs.assemble(CALL_LOOP).load(plain)
+        steps = plain.run().steps
+
+        cpu = CPU()
+        cpu.set_output(CaptureOutput())
+        cpu.enable_memoization()
+        programs.assemble(CALL_LOOP).load(cpu)
+
+        # fill the memo in run(), then record the rest, where every call
+        # has to be recorded instruction by instruction, not as a hit
+        warm_up = 30
+        self.assertEqual(cpu.run(max_steps=warm_up).status, BUDGET_EXHAUSTED)
+        self.assertGreater(cpu.memo.hits, 0)
+        skipped = cpu.memo.saved
+
+        reader = self.record(0, cpu, steps - warm_up - skipped)
+        replayed = reader.state_at(steps - warm_up - skipped)
+
+        self.assertEqual(bytes(replayed.register), bytes(plain.register))
+        self.assertEqual(bytes(replayed.ram), bytes(plain.ram))
+        self.assertEqual(cpu.output.getvalue(), plain.output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
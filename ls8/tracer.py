@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+
+"""
+Tracer: record every instruction a program runs to a compact binary log,
+and read the log back offline.
+
+A trace file is a header followed by fixed-size block slots. Each block
+starts with a snapshot of the machine, so any block can be replayed on its
+own, followed by one record per instruction:
+
+    pc, opcode, operand a, operand b, changed register mask, info
+    the new value of each changed register
+    the new flag, if info bit 0 is set
+    (address, value) for each of the info >> 3 RAM writes
+
+Records with info bit 1 set aren't instructions but the timer, keyboard
+and interrupt entry work done between them. Info bit 2 means interrupts
+were turned on or off. With --blocks, the slots are reused oldest first,
+so the file keeps only the latest part of the run.
+"""
+
+import argparse
+import struct
+import sys
+from itertools import repeat
+
+from cpu import *
+from profiler import OPCODE_NAMES
+
+# File header: magic, version, block size, number of block slots (0 for
+# no limit)
+TRACE_MAGIC = b"LS8T"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sBII")
+
+# Block header: first step, record count, record bytes
+BLOCK_HEADER = struct.Struct("<QII")
+
+# Bytes of records in a block
+TRACE_BLOCK_SIZE = 1 << 20
+
+# Biggest record: the fixed part, 8 registers, the flag and 31 RAM writes
+MAX_RECORD = 6 + 8 + 1 + 2 * 31
+
+# Info bits
+INFO_FLAG = 0b001
+INFO_POLL = 0b010
+INFO_INTERRUPTS = 0b100
+
+
+# Which registers each instruction writes: a mask of fixed registers, or
+# its first operand, its first operand and the SP, or anything
+WRITES_A = 0x100
+WRITES_A_SP = 0x200
+WRITES_ANY = 0x400
+REGISTER_WRITES = [WRITES_ANY] * 256
+
+for opcode in (HLT, NOP, PRN, PRA, CMP, JMP, JEQ, JNE, JGT, JLT, JGE, JLE,
+               ST):
+    REGISTER_WRITES[opcode] = 0
+
+for opcode in (PUSH, CALL, RET):
+    REGISTER_WRITES[opcode] = 0x80
+
+for opcode in (LDI, LD, ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, SHL, SHR,
+               INC, DEC, NOT):
+    REGISTER_WRITES[opcode] = WRITES_A
+
+REGISTER_WRITES[POP] = WRITES_A_SP
+
+# The register numbers in each mask
+MASK_REGISTERS = [[i for i in range(8) if mask & (1 << i)]
+                  for mask in range(256)]
+
+
+class TraceRecorder:
+    """Writes a trace record for every instruction a CPU runs."""
+
+    def __init__(self, f, block_size=TRACE_BLOCK_SIZE, max_blocks=0):
+        self.f = f
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.slot_size = BLOCK_HEADER.size + STATE_SIZE + block_size
+        self.slot = 0
+        self.steps = 0
+        self.buffer = bytearray()
+        self.records = 0
+        self.block_step = 0
+        self.block_state = None
+
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, block_size,
+                                  max_blocks))
+
+    def start_block(self, cpu):
+        self.block_step = self.steps
+        self.block_state = cpu.snapshot()
+        self.buffer.clear()
+        self.records = 0
+
+    def flush_block(self, final=False):
+        """
+        Write the current block into the next slot. Only the final block,
+        which holds the state at the end, is written without records.
+        """
+
+        if self.records == 0 and not final:
+            return
+
+        # one slot more than max_blocks, for the final block, so the ring
+        # keeps max_blocks blocks of records
+        if self.max_blocks:
+            self.f.seek(TRACE_HEADER.size + self.slot * self.slot_size)
+            self.slot = (self.slot + 1) % (self.max_blocks + 1)
+
+        self.f.write(BLOCK_HEADER.pack(self.block_step, self.records,
+                                       len(self.buffer)))
+        self.f.write(self.block_state)
+        self.f.write(self.buffer)
+
+        # keep slots a fixed size so they can be reused
+        if self.max_blocks:
+            self.f.write(bytes(self.block_size - len(self.buffer)))
+
+    def run(self, cpu, max_steps=None):
+        """
+        Run cpu until it halts, faults or has run max_steps instructions,
+        recording everything it does. Returns the RunResult.
+        """
+
+        # every instruction has to be recorded, so none can be memoized
+        if cpu.memo is not None:
+            cpu.disable_memoization()
+
+        cpu.running = True
+        decoded = cpu.decoded
+        ram = cpu.ram
+        register = cpu.register
+        buffer = self.buffer
+        limit = self.block_size - MAX_RECORD
+        # RAM writes, as address, value, address, value...
+        writes = bytearray()
+
+        real_write = cpu.ram_write
+
+        def ram_write(address, value):
+            writes.append(address)
+            writes.append(value & 0xff)
+            real_write(address, value)
+
+        cpu.ram_write = ram_write
+
+        self.start_block(cpu)
+        first_step = self.steps
+        steps = 0
+        # records in the block so far, kept in a local while running
+        records = 0
+        status = HALTED
+        fault = None
+
+        try:
+            while cpu.running:
+                batch = cpu.poll_interval
+
+                if max_steps is not None:
+                    batch = min(batch, max_steps - steps)
+
+                    if batch <= 0:
+                        status = BUDGET_EXHAUSTED
+                        break
+
+                before = bytes(register)
+                flag = cpu.flag
+                enabled = cpu.interrupts_enabled
+                pc = cpu.program_counter
+                cpu.poll()
+
+                if (cpu.program_counter != pc or register != before or writes
+                        or cpu.interrupts_enabled != enabled):
+                    self.record_any(cpu, pc, 0, 0, 0, before, flag, enabled,
+                                    writes, INFO_POLL)
+                    records += 1
+
+                for _ in repeat(None, batch):
+                    if len(buffer) > limit:
+                        self.records = records
+                        self.steps = first_step + steps
+                        self.flush_block()
+                        self.start_block(cpu)
+                        records = 0
+
+                    pc = cpu.program_counter
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+
+                    handler, operand_a, operand_b, next_pc = entry
+                    opcode = ram[pc]
+                    flag = cpu.flag
+                    kind = REGISTER_WRITES[opcode]
+
+                    if kind == WRITES_ANY:
+                        before = bytes(register)
+                        enabled = cpu.interrupts_enabled
+
+                    handler(operand_a, operand_b)
+
+                    if next_pc is not None:
+                        cpu.program_counter = next_pc
+
+                    steps += 1
+                    records += 1
+
+                    if kind == WRITES_ANY:
+                        self.record_any(cpu, pc, opcode, operand_a,
+                                        operand_b, before, flag, enabled,
+                                        writes, 0)
+
+                        if cpu.poll_now:
+                            break
+
+                        continue
+
+                    # the registers this kind of instruction writes
+                    if kind == WRITES_A:
+                        mask = 1 << operand_a
+                    elif kind == WRITES_A_SP:
+                        mask = (1 << operand_a) | 0x80
+                    else:
+                        mask = kind
+
+                    info = len(writes) << 2
+
+                    if cpu.flag != flag:
+                        info |= INFO_FLAG
+
+                    buffer += bytes((pc, opcode, operand_a, operand_b, mask,
+                                     info))
+
+                    for i in MASK_REGISTERS[mask]:
+                        buffer.append(register[i])
+
+                    if info & INFO_FLAG:
+                        buffer.append(cpu.flag)
+
+                    if writes:
+                        buffer += writes
+                        writes.clear()
+
+                    if cpu.poll_now:
+                        break
+
+        except Fault as e:
+            cpu.running = False
+            cpu.output.flush()
+            status = FAULTED
+            fault = e
+
+        finally:
+            del cpu.ram_write
+            self.records = records
+            self.steps = first_step + steps
+            self.flush_block()
+
+            # a last block with no records holds the final state
+            self.start_block(cpu)
+            self.flush_block(final=True)
+            self.f.flush()
+
+        return RunResult(status, steps, cpu.program_counter, fault)
+
+    def record_any(self, cpu, pc, opcode, a, b, before, flag, enabled,
+                   writes, info):
+        """Record whatever changed since before, flag and enabled."""
+
+        register = cpu.register
+        mask = 0
+
+        for i in range(8):
+            if register[i] != before[i]:
+                mask |= 1 << i
+
+        if cpu.flag != flag:
+            info |= INFO_FLAG
+
+        if cpu.interrupts_enabled != enabled:
+            info |= INFO_INTERRUPTS
+
+        self.buffer += bytes((pc, opcode, a, b, mask,
+                              info | (len(writes) << 2)))
+
+        for i in MASK_REGISTERS[mask]:
+            self.buffer.append(register[i])
+
+        if info & INFO_FLAG:
+            self.buffer.append(cpu.flag)
+
+        self.buffer += writes
+        writes.clear()
+
+
+class TraceRecord:
+    """One decoded record: an instruction, or the work between them."""
+
+    def __init__(self, step, pc, opcode, a, b, registers, flag, writes,
+                 poll, interrupts_toggled):
+        self.step = step
+        self.pc = pc
+        self.opcode = opcode
+        self.a = a
+        self.b = b
+        # register number -> new value
+        self.registers = registers
+        # new flag, or None if unchanged
+        self.flag = flag
+        # (address, value) RAM writes
+        self.writes = writes
+        self.poll = poll
+        self.interrupts_toggled = interrupts_toggled
+
+    def __str__(self):
+        if self.poll:
+            text = f"{self.step:>10}  {self.pc:02X}  (interrupts)"
+        else:
+            name = OPCODE_NAMES.get(self.opcode, f"{self.opcode:08b}")
+            text = (f"{self.step:>10}  {self.pc:02X}  {name:<5} "
+                    f"{self.a:02X} {self.b:02X}")
+
+        changes = [f"R{i}={value:02X}" for i, value in self.registers.items()]
+
+        if self.flag is not None:
+            changes.append(f"FL={self.flag:02X}")
+
+        changes += [f"[{address:02X}]={value:02X}"
+                    for address, value in self.writes]
+
+        return f"{text}  {' '.join(changes)}".rstrip()
+
+    def apply(self, cpu):
+        """Make the changes this record made on cpu."""
+
+        for i, value in self.registers.items():
+            cpu.register[i] = value
+
+        if self.flag is not None:
+            cpu.flag = self.flag
+
+        for address, value in self.writes:
+            cpu.ram_write(address, value)
+
+        if self.interrupts_toggled:
+            cpu.interrupts_enabled = not cpu.interrupts_enabled
+
+
+class TraceReader:
+    """Reads a trace file back."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        if len(data) < TRACE_HEADER.size:
+            raise LoadError(f"Invalid trace: {filename}")
+
+        magic, version, block_size, max_blocks = TRACE_HEADER.unpack_from(
+            data)
+
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise LoadError(f"Invalid trace: {filename}")
+
+        # (first step, record count, snapshot, records) of every block
+        self.blocks = []
+        offset = TRACE_HEADER.size
+
+        while offset + BLOCK_HEADER.size + STATE_SIZE <= len(data):
+            step, count, length = BLOCK_HEADER.unpack_from(data, offset)
+            offset += BLOCK_HEADER.size
+            state = data[offset:offset + STATE_SIZE]
+            offset += STATE_SIZE
+            self.blocks.append((step, count, state,
+                                data[offset:offset + length]))
+            offset += block_size if max_blocks else length
+
+        # ring slots come out of order
+        self.blocks.sort(key=lambda block: block[0])
+
+    def records(self, pc_range=None, opcodes=None):
+        """
+        Yield every record, or only instructions with a PC in pc_range
+        (low, high inclusive) and an opcode in opcodes.
+        """
+
+        for step, count, state, data in self.blocks:
+            for record in decode_records(step, data):
+                if pc_range is not None and not (
+                        pc_range[0] <= record.pc <= pc_range[1]):
+                    continue
+
+                if opcodes is not None and (
+                        record.poll or record.opcode not in opcodes):
+                    continue
+
+                yield record
+
+    def state_at(self, step):
+        """
+        Rebuild the machine as it was before instruction step ran, from the
+        nearest snapshot. Returns a CPU, or None if the trace doesn't
+        reach back that far.
+        """
+
+        start = None
+
+        for block in self.blocks:
+            if block[0] <= step:
+                start = block
+
+        if start is None:
+            return None
+
+        cpu = CPU()
+        cpu.restore(start[2])
+
+        for record in decode_records(start[0], start[3]):
+            if not record.poll and record.step >= step:
+                cpu.program_counter = record.pc
+                return cpu
+
+            record.apply(cpu)
+
+        # the end of the block: the next snapshot has the PC
+        later = [block for block in self.blocks if block[0] > start[0]]
+
+        if later:
+            cpu.program_counter = later[0][2][STATE_PC]
+
+        return cpu
+
+
+def decode_records(step, data):
+    """Yield the records in a block's data, numbering from step."""
+
+    offset = 0
+    end = len(data)
+
+    while offset < end:
+        pc, opcode, a, b, mask, info = data[offset:offset + 6]
+        offset += 6
+
+        registers = {}
+
+        for i in range(8):
+            if mask & (1 << i):
+                registers[i] = data[offset]
+                offset += 1
+
+        flag = None
+
+        if info & INFO_FLAG:
+            flag = data[offset]
+            offset += 1
+
+        writes = []
+
+        for _ in range(info >> 3):
+            writes.append((data[offset], data[offset + 1]))
+            offset += 2
+
+        poll = bool(info & INFO_POLL)
+
+        yield TraceRecord(step, pc, opcode, a, b, registers, flag, writes,
+                          poll, bool(info & INFO_INTERRUPTS))
+
+        if not poll:
+            step += 1
+
+
+def parse_range(text):
+    """Parse "LO-HI" or "ADDR" (hex) into a (low, high) pair."""
+
+    low, _, high = text.partition("-")
+    return int(low, 16), int(high or low, 16)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Record LS-8 execution traces and read them back.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="run a program with tracing")
+    record.add_argument("program", help=".ls8 or .ls8b file to run")
+    record.add_argument("trace", help="trace file to write")
+    record.add_argument(
+        "--block-size", type=int, default=TRACE_BLOCK_SIZE,
+        help="record bytes per block")
+    record.add_argument(
+        "--blocks", type=int, default=0,
+        help="keep only the latest N blocks (default: keep everything)")
+    record.add_argument(
+        "--max-steps", type=int, default=None,
+        help="stop after this many instructions")
+
+    show = commands.add_parser("show", help="print the records of a trace")
+    show.add_argument("trace")
+    show.add_argument("--pc", type=parse_range,
+                      help="only PCs in this hex range, like 10-1F")
+    show.add_argument("--opcode", action="append",
+                      help="only this instruction (may be repeated)")
+    show.add_argument("--state", type=int, metavar="STEP",
+                      help="print the machine state before STEP instead")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        if args.command == "record":
+            cpu = CPU()
+            cpu.load(args.program)
+
+            with open(args.trace, "wb") as f:
+                recorder = TraceRecorder(f, args.block_size, args.blocks)
+                result = recorder.run(cpu, args.max_steps)
+
+            cpu.output.flush()
+            print(f"{result.steps} instructions traced ({result.status})",
+                  file=sys.stderr)
+
+            if result.fault is not None:
+                print(result.fault, file=sys.stderr)
+
+            return 0
+
+        reader = TraceReader(args.trace)
+
+    except LoadError as e:
+        print(e, file=sys.stderr)
+        return e.code
+
+    if args.state is not None:
+        cpu = reader.state_at(args.state)
+
+        if cpu is None:
+            print(f"step {args.state} is not in the trace", file=sys.stderr)
+            return 1
+
+        cpu.trace()
+        return 0
+
+    opcodes = None
+
+    if args.opcode:
+        names = {name: opcode for opcode, name in OPCODE_NAMES.items()}
+        opcodes = {names[name.upper()] for name in args.opcode}
+
+    for record in reader.records(args.pc, opcodes):
+        print(record)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))